@@ -0,0 +1,140 @@
+# chat/admission.py
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict
+from common import MAX_FRAME_SIZE
+from metrics import REJECTED
+
+MAX_HANDSHAKES = 256 # рукопожатий одновременно, остальные подключения сразу закрываются
+HANDSHAKE_TIMEOUT = 10.0 # за сколько секунд клиент должен закончить рукопожатие и прислать имя
+CONN_RATE, CONN_BURST = 50.0, 100   # сообщений в секунду и запас для одного подключения
+USER_RATE, USER_BURST = 100.0, 200  # то же для всех подключений одного имени
+USER_BUCKETS = 65536 # для скольких имен помним ведро (давно молчавшие выбрасываются)
+
+REJECT_MAX_CLIENTS = "max_clients"
+REJECT_HANDSHAKES = "handshakes"
+REJECT_HANDSHAKE_TIMEOUT = "handshake_timeout"
+REJECT_IDLE = "idle_timeout"
+REJECT_FRAME_SIZE = "frame_size"
+REJECT_RATE = "rate_limited"
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst. Сообщение стоит один токен"""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class Deadline:
+    """Обрывает соединение, если touch() не вызывали timeout секунд.
+
+    Один таймер на подключение, touch только запоминает время, поэтому на каждый кадр
+    не создается ни задачи, ни таймера (как было бы с wait_for). После обрыва чтение
+    завершается ошибкой, а expired показывает, что причина - таймаут.
+    """
+
+    def __init__(self, transport: asyncio.BaseTransport, timeout: float) -> None:
+        self.timeout = timeout
+        self.expired = False
+        self._transport = transport
+        self._loop = asyncio.get_running_loop()
+        self.last = self._loop.time()
+        self._handle = self._loop.call_later(timeout, self._check)
+
+    def touch(self) -> None:
+        self.last = self._loop.time()
+
+    def _check(self) -> None:
+        left = self.last + self.timeout - self._loop.time()
+        if left > 0:
+            self._handle = self._loop.call_later(left, self._check)
+            return
+        self.expired = True
+        self._transport.abort()
+
+    def cancel(self) -> None:
+        self._handle.cancel()
+
+
+class Admission:
+    """Ограничения сервера: сколько клиентов и рукопожатий одновременно, таймауты,
+    размер кадра и частота сообщений (ведра токенов на подключение и на имя).
+
+    None в любом ограничении - ограничения нет. Каждый отказ считается в rejected
+    (и в метрике chat_rejected_total) по причине.
+    """
+
+    def __init__(self, max_clients: int | None = None, max_handshakes: int | None = MAX_HANDSHAKES,
+                 handshake_timeout: float | None = HANDSHAKE_TIMEOUT, idle_timeout: float | None = None,
+                 max_frame_size: int = MAX_FRAME_SIZE,
+                 conn_rate: float | None = CONN_RATE, conn_burst: int = CONN_BURST,
+                 user_rate: float | None = USER_RATE, user_burst: int = USER_BURST) -> None:
+        self.max_clients = max_clients
+        self.max_handshakes = max_handshakes
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.max_frame_size = max_frame_size
+        self.conn_rate, self.conn_burst = conn_rate, conn_burst
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.handshakes = 0 # рукопожатий сейчас
+        self.rejected: Dict[str, int] = {}
+        self._users: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def reject(self, reason: str) -> None:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        REJECTED.labels(reason).inc()
+
+    def admit(self, clients: int) -> bool:
+        """Можно ли начать рукопожатие с новым подключением. True - рукопожатие посчитано,
+        в конце нужно вызвать handshake_done"""
+        if self.max_clients is not None and clients + self.handshakes >= self.max_clients:
+            self.reject(REJECT_MAX_CLIENTS)
+            return False
+        if self.max_handshakes is not None and self.handshakes >= self.max_handshakes:
+            self.reject(REJECT_HANDSHAKES)
+            return False
+        self.handshakes += 1
+        return True
+
+    def handshake_done(self) -> None:
+        self.handshakes -= 1
+
+    def deadline(self, transport: asyncio.BaseTransport, timeout: float | None) -> Deadline | None:
+        return Deadline(transport, timeout) if timeout is not None else None
+
+    def connection_bucket(self) -> TokenBucket | None:
+        return TokenBucket(self.conn_rate, self.conn_burst) if self.conn_rate is not None else None
+
+    def allow(self, conn: TokenBucket | None, username: str) -> bool:
+        """Сообщение от подключения с ведром conn и именем username: False - лимит превышен"""
+        now = time.monotonic()
+        if conn is not None and not conn.take(now):
+            self.reject(REJECT_RATE)
+            return False
+        if self.user_rate is None:
+            return True
+        bucket = self._users.get(username)
+        if bucket is None:
+            bucket = self._users[username] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self._users) > USER_BUCKETS:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(username)
+        if bucket.take(now):
+            return True
+        self.reject(REJECT_RATE)
+        return False
@@ -0,0 +1,189 @@
+# chat/bench.py
+"""Нагрузочный тест: сервер и клиенты в одном процессе.
+
+Запускает ChatServer на свободном порту, подключает N клиентов (смесь plain и dh_modp),
+рассылает сообщения с заданной частотой и печатает JSON с результатами:
+рукопожатий в секунду, доставленных сообщений в секунду, задержки доставки
+p50/p99/p999 и RSS процесса (сервер и клиенты живут в одном процессе).
+
+Пример: python bench.py --clients 200 --dh-ratio 0.5 --rate 200 --duration 10 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import sys
+import time
+
+from client import AsyncChatClient
+from server import ChatServer
+from admission import Admission
+from transport import TRANSPORTS, TRANSPORT_STREAMS, use_uvloop
+
+PREFIX = "bench:" # формат сообщения: "bench:<номер>:<время отправки в нс>"
+
+
+def _json_params(params: dict) -> dict:
+    """Параметры для JSON результата: объекты (Admission, HandshakeExecutor...) записываем через repr"""
+    out = {}
+    for k, v in params.items():
+        try:
+            json.dumps(v)
+            out[k] = v
+        except TypeError:
+            out[k] = repr(v)
+    return out
+
+def _percentile(sorted_values: list, q: float) -> float | None:
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[i]
+
+
+def _rss_bytes() -> int:
+    """Текущий RSS процесса. Если /proc недоступен - максимальный RSS из getrusage"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+async def _connect_all(host: str, port: int, n: int, dh_ratio: float, concurrency: int,
+                       enc_alg: str = "dh") -> tuple[list, float]:
+    sem = asyncio.Semaphore(concurrency)
+    n_dh = int(round(n * dh_ratio))
+    clients = [AsyncChatClient() for _ in range(n)]
+
+    async def connect(i: int, c: AsyncChatClient) -> None:
+        async with sem:
+            await c.connect(host, port, f"bench{i}", alg=enc_alg if i < n_dh else "plain")
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(connect(i, c) for i, c in enumerate(clients)))
+    return clients, time.perf_counter() - t0
+
+
+async def run_bench(clients: int = 50, dh_ratio: float = 0.5, rate: float = 100.0, duration: float = 5.0,
+                    senders: int = 1, concurrency: int = 64, server_kwargs: dict | None = None,
+                    enc_alg: str = "dh", transport: str = TRANSPORT_STREAMS) -> dict:
+    kwargs = dict(server_kwargs or {})
+    # бенчмарк сам задает частоту сообщений, лимиты сервера искажали бы замер
+    kwargs.setdefault("admission", Admission(max_handshakes=None, conn_rate=None, user_rate=None))
+    srv = ChatServer(**kwargs)
+    server_obj = await srv.start("127.0.0.1", 0, transport=transport)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+
+    conns, connect_time = await _connect_all(host, port, clients, dh_ratio, concurrency, enc_alg)
+    while len(srv.clients) < clients: # ждем, пока сервер зарегистрирует всех
+        await asyncio.sleep(0.01)
+
+    latencies: list[int] = []
+    received = 0
+
+    async def reader(c: AsyncChatClient) -> None:
+        nonlocal received
+        while True:
+            line = await c.recv()
+            _, _, payload = line.partition(" > ")
+            if payload.startswith(PREFIX):
+                latencies.append(time.perf_counter_ns() - int(payload.rsplit(":", 1)[1]))
+                received += 1
+
+    readers = [asyncio.create_task(reader(c)) for c in conns]
+
+    senders = max(1, min(senders, clients))
+    interval = senders / rate if rate > 0 else 0.0
+    sent = 0
+
+    async def sender(c: AsyncChatClient) -> None:
+        nonlocal sent
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + duration
+        next_at = loop.time()
+        while loop.time() < deadline:
+            await c.send(f"{PREFIX}{sent}:{time.perf_counter_ns()}")
+            sent += 1
+            next_at += interval
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(sender(c) for c in conns[:senders]))
+    expected = sent * (clients - 1) # отправитель не получает свое сообщение
+    drain_deadline = time.perf_counter() + 5.0
+    while received < expected and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    rss = _rss_bytes()
+
+    for t in readers:
+        t.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    for c in conns:
+        await c.close()
+    close_deadline = time.perf_counter() + 2.0
+    while srv.clients and time.perf_counter() < close_deadline: # даем серверу закрыть соединения
+        await asyncio.sleep(0.01)
+    server_obj.close()
+    await server_obj.wait_closed()
+
+    latencies.sort()
+    ms = lambda ns: None if ns is None else ns / 1e6
+    return {
+        "python": platform.python_version(),
+        "params": {"clients": clients, "dh_ratio": dh_ratio, "rate": rate, "duration": duration,
+                   "senders": senders, "enc_alg": enc_alg, "transport": transport, "server": _json_params(server_kwargs or {})},
+        "handshakes_per_sec": clients / connect_time if connect_time > 0 else None,
+        "messages_sent": sent,
+        "messages_delivered": received,
+        "messages_expected": expected,
+        "delivered_per_sec": received / elapsed if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": ms(_percentile(latencies, 0.50)),
+            "p99": ms(_percentile(latencies, 0.99)),
+            "p999": ms(_percentile(latencies, 0.999)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "rss_bytes": rss,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Chat server load benchmark")
+    ap.add_argument("--clients", type=int, default=50)
+    ap.add_argument("--dh-ratio", type=float, default=0.5, help="доля клиентов с шифрованием, остальные plain")
+    ap.add_argument("--enc-alg", default="dh", help="алгоритм шифрованных клиентов: dh, x25519, auto")
+    ap.add_argument("--rate", type=float, default=100.0, help="сообщений в секунду суммарно от всех отправителей")
+    ap.add_argument("--duration", type=float, default=5.0)
+    ap.add_argument("--senders", type=int, default=1)
+    ap.add_argument("--concurrency", type=int, default=64, help="одновременных подключений при старте")
+    ap.add_argument("--transport", choices=TRANSPORTS, default=TRANSPORT_STREAMS, help="транспорт сервера")
+    ap.add_argument("--uvloop", action="store_true", help="цикл событий uvloop, если установлен")
+    ap.add_argument("--output", help="файл для JSON, по умолчанию stdout")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.CRITICAL) # логи сервера на каждое подключение искажают замеры
+    if args.uvloop and not use_uvloop():
+        ap.error("uvloop не установлен")
+
+    result = asyncio.run(run_bench(args.clients, args.dh_ratio, args.rate, args.duration,
+                                   args.senders, args.concurrency, enc_alg=args.enc_alg,
+                                   transport=args.transport))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# chat/bus.py
+import asyncio
+import logging
+import os
+import struct
+from typing import Awaitable, Callable, Dict
+from common import read_framed, pack_frame, close_writer, FRAMING_V2, FRAME_DATA
+from crypto.plain import PlainCodec
+from outbound import ClientSession, POLICY_DROP_OLDEST
+
+BUS_QUEUE_SIZE = 4096 # очередь сообщений к одному соседнему воркеру
+BUS_WRITE_TIMEOUT = 1.0
+BUS_RECONNECT_DELAY = 0.2
+
+# Сообщение шины: тип адресата (1 байт) + тип кадра для клиента (1 байт) + длина адресата (2 байта)
+# + длина имени отправителя (2 байта) + адресат + отправитель + данные.
+# Отправитель нужен для истории комнат: свои сообщения клиенту при досылке не возвращаются
+BUS_ROOM = 0 # адресат - комната
+BUS_USER = 1 # адресат - имена пользователей через запятую
+BUS_KEY = 2  # адресат - имя пользователя, данные - его публичный ключ E2E (пустые - ключ удален)
+_BUS_HEADER = struct.Struct(">BBHH")
+
+
+class UnixSocketBus:
+    """Шина рассылки между воркерами одного сервера через Unix domain sockets.
+
+    Каждый воркер слушает свой сокет directory/worker-<id>.sock и подключается
+    к сокетам всех остальных воркеров. publish отправляет сообщение с адресатом
+    (комната или пользователь) всем соседям, полученные от соседей сообщения
+    передаются в on_message(kind, target, payload, ftype, sender=...) и дальше не пересылаются.
+    Соединения к соседям - это ClientSession с plain кодеком, поэтому у каждого
+    соседа своя очередь и медленный воркер не задерживает рассылку.
+    """
+
+    def __init__(self, directory: str, worker_id: int, workers: int, queue_size: int = BUS_QUEUE_SIZE) -> None:
+        self.directory = directory
+        self.worker_id = worker_id
+        self.workers = workers
+        self.queue_size = queue_size
+        self.published = 0
+        self.received = 0
+        self._peers: Dict[int, ClientSession] = {}
+        self._server: asyncio.AbstractServer | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._inbound: set[asyncio.StreamWriter] = set()
+        self._on_message: Callable[..., Awaitable[None]] | None = None
+        self._closed = False
+
+    def path(self, worker_id: int) -> str:
+        return os.path.join(self.directory, f"worker-{worker_id}.sock")
+
+    @property
+    def connected(self) -> int:
+        """К скольким соседям сейчас есть соединение"""
+        return len(self._peers)
+
+    async def start(self, on_message: Callable[..., Awaitable[None]]) -> None:
+        self._on_message = on_message
+        path = self.path(self.worker_id)
+        if os.path.exists(path): # сокет мог остаться от прошлого запуска
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(self._handle_peer, path)
+        for i in range(self.workers):
+            if i != self.worker_id:
+                self._spawn(self._connect(i))
+
+    def _spawn(self, coro: Awaitable[None]) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _connect(self, worker_id: int) -> None:
+        """Подключаемся к соседу, пока он не поднимется"""
+        while not self._closed:
+            try:
+                _, writer = await asyncio.open_unix_connection(self.path(worker_id))
+                break
+            except OSError:
+                await asyncio.sleep(BUS_RECONNECT_DELAY)
+        else:
+            return
+        session = ClientSession(writer, f"worker-{worker_id}", PlainCodec(), self.queue_size,
+                                POLICY_DROP_OLDEST, BUS_WRITE_TIMEOUT, FRAMING_V2)
+        session.start(lambda s: self._lost(worker_id, s))
+        self._peers[worker_id] = session
+
+    def _lost(self, worker_id: int, session: ClientSession) -> None:
+        if self._peers.get(worker_id) is session:
+            del self._peers[worker_id]
+        if not self._closed:
+            logging.info("Потеряно соединение с воркером %d, переподключаемся", worker_id)
+            self._spawn(self._connect(worker_id))
+
+    def publish(self, kind: int, target: str, payload: bytes, ftype: int = FRAME_DATA, sender: str = "") -> None:
+        """Отправляем сообщение всем соседним воркерам. Кадр собирается один раз"""
+        if not self._peers:
+            return
+        t, s = target.encode("utf-8"), sender.encode("utf-8")
+        packed = pack_frame(b"".join((_BUS_HEADER.pack(kind, ftype, len(t), len(s)), t, s, payload)), FRAMING_V2)
+        for session in self._peers.values():
+            session.offer(packed)
+        self.published += 1
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._inbound.add(writer)
+        try:
+            while True:
+                data = await read_framed(reader, FRAMING_V2)
+                kind, ftype, tlen, slen = _BUS_HEADER.unpack_from(data)
+                start = _BUS_HEADER.size
+                target = data[start:start + tlen].decode("utf-8")
+                sender = data[start + tlen:start + tlen + slen].decode("utf-8")
+                self.received += 1
+                await self._on_message(kind, target, data[start + tlen + slen:], ftype, sender=sender)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logging.exception("Ошибка при чтении шины воркеров")
+        finally:
+            self._inbound.discard(writer)
+            await close_writer(writer)
+
+    async def close(self) -> None:
+        self._closed = True
+        for task in list(self._tasks):
+            task.cancel()
+        for session in list(self._peers.values()):
+            await session.close()
+        self._peers.clear()
+        for writer in list(self._inbound):
+            await close_writer(writer)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        try:
+            os.unlink(self.path(self.worker_id))
+        except OSError:
+            pass
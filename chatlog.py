@@ -0,0 +1,98 @@
+# chat/chatlog.py
+import sys
+import json
+import queue
+import random
+import logging
+import logging.handlers
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+MESSAGES_LOGGER = "chat.messages" # отдельный логгер для содержимого сообщений
+
+
+class LazyHex:
+    """Байты в hex только при форматировании записи, то есть если запись вообще пишется"""
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def __str__(self) -> str:
+        return self.data.hex()
+
+
+class _Redacted:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+    def __str__(self) -> str:
+        return f"<{len(self.text)} chars>"
+
+
+class MessageLogger:
+    """Лог содержимого сообщений чата.
+
+    Выборка (sample_rate) проверяется до создания записи, поэтому пропущенное сообщение
+    стоит один вызов random(). redact - вместо текста пишется только его длина.
+    """
+
+    def __init__(self, logger: logging.Logger, sample_rate: float = 1.0, redact: bool = False) -> None:
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.redact = redact
+
+    def received(self, username: str, text: str) -> None:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Получено сообщение от %s: %s", username, _Redacted(text) if self.redact else text,
+                             extra={"user": username, "chars": len(text)})
+
+
+MESSAGES = MessageLogger(logging.getLogger(MESSAGES_LOGGER))
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON. Поля из extra (user, chars) попадают в запись как есть"""
+    _FIELDS = ("user", "chars")
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {"ts": record.created, "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        for field in self._FIELDS:
+            if hasattr(record, field):
+                out[field] = getattr(record, field)
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Стандартный QueueHandler форматирует запись еще в потоке, который пишет лог.
+    Здесь запись уходит в очередь как есть: аргументы - строки и числа, форматирование
+    (и LazyHex) выполнит поток listener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level: int = logging.INFO, fmt: str = LOG_FORMAT, structured: bool = False,
+                  sample_rate: float = 1.0, redact: bool = False,
+                  handler: logging.Handler | None = None) -> logging.handlers.QueueListener:
+    """Логи через очередь: в event loop запись только кладется в очередь (QueueHandler),
+    форматирование и вывод делает поток QueueListener. Возвращает запущенный listener,
+    его нужно остановить (stop) при выходе, чтобы дописать оставшиеся записи"""
+    handler = handler or logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if structured else logging.Formatter(fmt))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_DeferredQueueHandler(records))
+    root.setLevel(level)
+    MESSAGES.sample_rate = sample_rate
+    MESSAGES.redact = redact
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -1,48 +1,238 @@
 import asyncio
-from common import read_message, write_message, close_writer
+import random
+from typing import Dict, Iterable
+from common import (read_typed_message, write_message, write_parts, frame_header, close_writer, sync_codec,
+                    compress_frame, unpack_room_message, valid_room_name, FRAMING_V2, BATCH_BYTES, FRAME_DATA, FRAME_ENVELOPE, FRAME_TICKET,
+                    FRAME_ROOM, DEFAULT_ROOM, valid_username, CMD_JOIN, CMD_LEAVE, CMD_ROOM_MSG, CMD_DIRECT, CMD_REPLAY,
+                    CMD_HISTORY, FRAME_THROTTLED)
 from crypto.negotiation import client_negotiate
+from crypto.executor import HandshakeExecutor
+from crypto.compression import COMPRESSION_PREFERENCE
 import logging
 
+# Переподключение: пауза растет вдвое после каждой неудачной попытки, от RECONNECT_DELAY
+# до RECONNECT_MAX_DELAY секунд (со случайным разбросом, чтобы клиенты не шли на сервер разом)
+RECONNECT_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5.0
+RECONNECT_ATTEMPTS = 10
+
 class AsyncChatClient:
-    def __init__(self) -> None:
+    def __init__(self, batch_delay: float | None = None, batch_bytes: int = BATCH_BYTES,
+                 offload_bytes: int | None = None, reconnect: bool = False,
+                 reconnect_attempts: int = RECONNECT_ATTEMPTS, compression: tuple = COMPRESSION_PREFERENCE) -> None:
+        """batch_delay - включает пакетную отправку: send копит кадры не дольше batch_delay секунд
+        (или до batch_bytes байт) и отправляет их одной записью с одним drain.
+        offload_bytes - сообщения от этого размера шифруются в пуле потоков.
+        reconnect - при обрыве соединения recv переподключается, возвращается в свои комнаты
+        и просит сервер дослать сообщения после последнего полученного номера.
+        compression - варианты сжатия длинных сообщений, которые клиент предлагает серверу, () - без сжатия"""
         self.reader: asyncio.StreamReader | None = None
         self.writer: asyncio.StreamWriter | None = None
         self.codec = None
+        self.framing = FRAMING_V2
+        self.batch_delay = batch_delay
+        self.batch_bytes = batch_bytes
+        self.offload_bytes = offload_bytes
+        self.compression = compression
+        self._pending: list = [] # заголовки и данные еще не отправленных кадров
+        self._pending_size = 0
+        self._flush_task: asyncio.Task | None = None
+        # (билет, алгоритм, секрет) от сервера: при следующем connect сессия возобновляется без DH.
+        # Переживает close(), поэтому для переподключения используется тот же объект клиента
+        self.ticket: tuple[bytes, str, bytes] | None = None
+        self.resumed = False # последнее подключение возобновлено по билету
+        self.reconnect = reconnect
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnects = 0 # сколько раз переподключались
+        self.throttled = 0 # сколько раз сервер сообщил, что выбросил наши сообщения сверх лимита частоты
+        self.rooms: set[str] = {DEFAULT_ROOM} # комнаты, в которые вернуться после переподключения
+        self.last_seq: Dict[str, int] = {} # комната -> номер последнего полученного сообщения
+        self._params: tuple | None = None # аргументы connect для переподключения
+        self._reconnect_task: asyncio.Task | None = None
 
-    async def connect(self, host: str, port: int, username: str, alg: str = "plain") -> None:
+    async def connect(self, host: str, port: int, username: str, alg: str = "plain",
+                      executor: HandshakeExecutor | None = None, framing: int = FRAMING_V2,
+                      resume: bool = True) -> None:
+        if not valid_username(username):
+            raise ValueError(f"Invalid username: {username!r}")
+        self._params = (host, port, username, alg, executor, framing)
         self.reader, self.writer = await asyncio.open_connection(host, port)
-        self.codec = await client_negotiate(self.reader, self.writer, alg=alg) #Клиент получает кодек от сервера
-        await write_message(self.writer, username.encode("utf-8"), self.codec)
+        ticket, self.ticket = (self.ticket if resume else None), None # билет одноразовый
+        #Клиент получает кодек и формат кадров от сервера
+        self.codec, self.framing = await client_negotiate(self.reader, self.writer, alg=alg, executor=executor,
+                                                          framing=framing, ticket=ticket,
+                                                          compression=self.compression)
+        self.resumed = self.codec.resumed
+        if not self.codec.passthrough:
+            self.codec.offload_bytes = self.offload_bytes
+        await write_message(self.writer, username.encode("utf-8"), self.codec, self.framing)
 
     async def send(self, message: str) -> None:
+        await self.send_frame(message.encode("utf-8"))
+
+    async def send_envelope(self, envelope: bytes) -> None:
+        """Двоичный конверт (common.pack_envelope), передается без перекодирования в текст. Только для v2"""
+        if self.framing != FRAMING_V2:
+            raise RuntimeError("Envelopes require v2 framing")
+        await self.send_frame(envelope, FRAME_ENVELOPE)
+
+    async def send_frame(self, data: bytes, ftype: int = FRAME_DATA) -> None:
+        if self._reconnect_task is not None:
+            await asyncio.shield(self._reconnect_task)
         if not self.writer:
             raise RuntimeError("Not connected")
-        await write_message(self.writer, message.encode("utf-8"), self.codec)
+        if self.batch_delay is None:
+            await write_message(self.writer, data, self.codec, self.framing, ftype)
+            return
+        ftype, data = compress_frame(self.codec, data, ftype)
+        data = self.codec.encode_sync(data) if sync_codec(self.codec, len(data)) else await self.codec.encode(data)
+        self._pending.append(frame_header(len(data), self.framing, ftype))
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.batch_bytes:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def join(self, room: str) -> None:
+        if not valid_room_name(room):
+            raise ValueError(f"Invalid room name: {room!r}")
+        await self.send(f"{CMD_JOIN}{room}")
+        self.rooms.add(room)
+
+    async def leave(self, room: str) -> None:
+        await self.send(f"{CMD_LEAVE}{room}")
+        self.rooms.discard(room)
+
+    async def history(self, room: str = DEFAULT_ROOM, before: int | None = None) -> None:
+        """Просим страницу истории комнаты до номера before (None - последние сообщения).
+        Сообщения придут через recv обычными сообщениями комнаты. Только для v2"""
+        await self.send(f"{CMD_HISTORY}{room}:{'' if before is None else before}")
+
+    async def send_room(self, room: str, message: str) -> None:
+        """Сообщение только участникам комнаты room"""
+        await self.send(f"{CMD_ROOM_MSG}{room}:{message}")
+
+    async def send_direct(self, username: str, message: str) -> None:
+        """Сообщение только пользователю username"""
+        await self.send_to([username], message)
+
+    async def send_to(self, usernames: Iterable[str], message: str) -> None:
+        """Сообщение только пользователям usernames, сервер не рассылает его остальным"""
+        await self.send(f"{CMD_DIRECT}{','.join(usernames)}:{message}")
+
+    async def flush(self) -> None:
+        """Отправляем накопленные кадры одной записью"""
+        if not self._pending or not self.writer:
+            return
+        parts, self._pending, self._pending_size = self._pending, [], 0
+        await write_parts(self.writer, parts)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.batch_delay)
+        self._flush_task = None
+        await self.flush()
+
+    async def recv_frame(self, timeout: float | None = None) -> tuple[int, bytes]:
+        """Следующий кадр любого типа: (тип кадра, данные). Билет сервера забираем себе,
+        уведомления о лимите частоты считаем в throttled"""
+        if timeout is not None:
+            return await asyncio.wait_for(self.recv_frame(), timeout=timeout)
+        while True:
+            if self._reconnect_task is not None: # recv мог прервать таймаут посреди переподключения
+                await asyncio.shield(self._reconnect_task)
+            if not self.reader:
+                raise RuntimeError("Not connected")
+            try:
+                ftype, data = await read_typed_message(self.reader, self.codec, self.framing)
+            except (OSError, EOFError):
+                if not self.reconnect or self._params is None:
+                    raise
+                logging.info("Соединение с сервером потеряно, переподключаемся")
+                self._reconnect_task = asyncio.create_task(self._reconnect())
+                continue
+            if ftype == FRAME_ROOM:
+                seq, room, text = unpack_room_message(data)
+                self.last_seq[room] = max(seq, self.last_seq.get(room, 0))
+                return FRAME_DATA, text
+            if ftype == FRAME_THROTTLED:
+                logging.warning("Сервер выбрасывает сообщения: превышен лимит частоты")
+                self.throttled += 1
+                continue
+            if ftype != FRAME_TICKET:
+                return ftype, data
+            if self.codec.resumption is not None:
+                self.ticket = (bytes(data), *self.codec.resumption)
+
+    async def _drop_connection(self) -> None:
+        self._pending, self._pending_size = [], 0 # неотправленное пропало вместе с соединением
+        if self.writer:
+            await close_writer(self.writer)
+        self.writer = self.reader = self.codec = None
+
+    async def _reconnect(self) -> None:
+        """Переподключение с растущей паузой. После него клиент возвращается в свои комнаты
+        и просит дослать сообщения, пропущенные за время обрыва"""
+        delay = RECONNECT_DELAY
+        try:
+            await self._drop_connection()
+            for attempt in range(self.reconnect_attempts):
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+                try:
+                    await self.connect(*self._params) # с билетом - без нового DH
+                    if DEFAULT_ROOM not in self.rooms:
+                        await write_message(self.writer, f"{CMD_LEAVE}{DEFAULT_ROOM}".encode("utf-8"), self.codec, self.framing)
+                    for room in self.rooms - {DEFAULT_ROOM}:
+                        await write_message(self.writer, f"{CMD_JOIN}{room}".encode("utf-8"), self.codec, self.framing)
+                    for room in self.rooms & self.last_seq.keys():
+                        await write_message(self.writer, f"{CMD_REPLAY}{room}:{self.last_seq[room]}".encode("utf-8"),
+                                            self.codec, self.framing)
+                except (OSError, EOFError, RuntimeError, ValueError) as e:
+                    logging.info("Попытка переподключения %d не удалась: %s", attempt + 1, e)
+                    await self._drop_connection()
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                    continue
+                self.reconnects += 1
+                return
+            raise ConnectionError("Reconnect failed")
+        finally:
+            self._reconnect_task = None
 
     async def recv(self, timeout: float | None = None) -> str:
-        if not self.reader:
-            raise RuntimeError("Not connected")
-        if timeout is None:
-            data = await read_message(self.reader, self.codec)
-        else:
-            data = await asyncio.wait_for(read_message(self.reader, self.codec), timeout=timeout)
-        return '\n' + data.decode("utf-8")
+        """Следующее текстовое сообщение. Двоичные конверты пропускаются"""
+        if timeout is not None:
+            return await asyncio.wait_for(self.recv(), timeout=timeout)
+        while True:
+            ftype, data = await self.recv_frame()
+            if ftype == FRAME_DATA:
+                return data.decode("utf-8")
 
     async def close(self) -> None:
+        self._params = None # после close не переподключаемся
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
         if self.writer:
+            try:
+                await self.flush()
+            except Exception:
+                pass
             await close_writer(self.writer)
             self.writer = None
             self.reader = None
             self.codec = None
 
 async def run_cli(host: str = "127.0.0.1", port: int = 1234, username: str = "user", alg: str = "plain") -> None:
-    client = AsyncChatClient() 
+    client = AsyncChatClient(reconnect=True)
     await client.connect(host, port, username, alg=alg) #тут идет handshake при вызове connect
 
     async def reader_task():
         try:
             while True:
-                print(await client.recv(), flush=True) #читаем если что-то есть
+                print('\n' + await client.recv(), flush=True) #читаем если что-то есть
         except Exception:
             pass
 
@@ -55,7 +245,18 @@ async def run_cli(host: str = "127.0.0.1", port: int = 1234, username: str = "us
                     break
                 if line.strip() == "":
                     continue
-                await client.send(line)
+                cmd, _, rest = line.partition(" ")
+                if cmd == "/join" and rest:
+                    await client.join(rest.strip())
+                elif cmd == "/leave" and rest:
+                    await client.leave(rest.strip())
+                elif cmd == "/history":
+                    await client.history(rest.strip() or DEFAULT_ROOM)
+                elif cmd in ("/room", "/msg") and " " in rest:
+                    to, msg = rest.split(" ", 1)
+                    await (client.send_room(to, msg) if cmd == "/room" else client.send_direct(to, msg))
+                else:
+                    await client.send(line)
         except Exception:
             pass
 
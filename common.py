@@ -1,35 +1,216 @@
 # chat/common.py
+import time
 import asyncio
+import struct
+from typing import Iterable
 from crypto.base import AsyncCodec
+from metrics import DECODE_SECONDS, ENCODE_SECONDS
+
+# Форматы кадров. Формат выбирается при подключении (см. crypto/negotiation.py)
+FRAMING_LEGACY = 1 # заголовок - 10 байт с длиной в десятичной записи ASCII
+FRAMING_V2 = 2     # заголовок - 4 байта длины (big-endian) + 1 байт типа/флагов
 
 HEADER_LENGTH = 10
+V2_HEADER = struct.Struct(">IB")
+FRAME_DATA = 0 # тип кадра v2: обычное сообщение
+FRAME_ENVELOPE = 1 # тип кадра v2: двоичный конверт (см. pack_envelope), только для v2
+FRAME_TICKET = 2 # тип кадра v2: билет возобновления сессии от сервера (crypto/tickets.py)
+FRAME_ROOM = 3 # тип кадра v2: сообщение комнаты с номером (pack_room_message), только для v2
+FRAME_THROTTLED = 4 # тип кадра v2: сервер выбросил сообщения клиента сверх лимита частоты (данные пустые)
+# Флаг в байте типа v2: данные кадра сжаты (crypto/compression.py) до шифрования.
+# Ставится, только если при подключении договорились о сжатии
+FRAME_COMPRESSED = 0x80
+# Не флаг протокола, в сеть не уходит: сжатие для этих данных уже пробовали (рассылка сжимает
+# один раз на всех), писатель очереди не сжимает их снова. compress_frame его снимает
+FRAME_NO_COMPRESS = 0x100
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # проверяется до выделения памяти под кадр
+
+# Пакетная отправка (по умолчанию выключена): кадры копятся не дольше BATCH_DELAY секунд
+# или до BATCH_BYTES байт и уходят одной записью с одним drain
+BATCH_DELAY = 0.002
+BATCH_BYTES = 64 * 1024
+
+# Служебные команды клиента серверу - текстовые сообщения с префиксом.
+# Обычное сообщение без префикса отправляется в комнату DEFAULT_ROOM.
+DEFAULT_ROOM = "lobby" # в нее клиент попадает при подключении
+CMD_JOIN = "__ROOM_JOIN__:"     # "__ROOM_JOIN__:room"
+CMD_LEAVE = "__ROOM_LEAVE__:"   # "__ROOM_LEAVE__:room"
+CMD_ROOM_MSG = "__ROOM_MSG__:"  # "__ROOM_MSG__:room:text" -> участникам комнаты "username [room] > text"
+CMD_DIRECT = "__DIRECT__:"      # "__DIRECT__:user1,user2:text" -> только указанным пользователям "username > text"
+CMD_REPLAY = "__REPLAY__:"      # "__REPLAY__:room:seq" -> досылка сообщений комнаты с номерами после seq
+CMD_HISTORY = "__HISTORY__:"    # "__HISTORY__:room:seq" -> страница истории комнаты до seq (пустой - последние)
+# Клиенту со старым форматом кадров вместо FRAME_THROTTLED приходит этот текст
+NOTICE_THROTTLED = "server > сообщение не доставлено: слишком часто, подождите"
+
+MAX_ROOM_NAME = 255 # байт, длина имени комнаты в кадре FRAME_ROOM - 1 байт
+MAX_USERNAME = 255 # байт, длина имени отправителя в конверте и в журнале сообщений - 1 байт
+
+def valid_room_name(room: str) -> bool:
+    """Имя комнаты непустое, без ":" (в CMD_ROOM_MSG оно отделяется от текста двоеточием)
+    и не длиннее MAX_ROOM_NAME байт"""
+    return bool(room) and ":" not in room and len(room.encode("utf-8")) <= MAX_ROOM_NAME
+
+def valid_username(username: str) -> bool:
+    """Имя клиента непустое и не длиннее MAX_USERNAME байт. Проверяется при подключении,
+    чтобы длинное имя не ломало конверты и журнал посреди сессии"""
+    return bool(username) and len(username.encode("utf-8")) <= MAX_USERNAME
+
+# Сообщение комнаты для клиентов v2 (кадр FRAME_ROOM): номер (8 байт), длина имени комнаты (1 байт),
+# комната, текст. По номеру клиент после переподключения просит дослать пропущенное (CMD_REPLAY)
+ROOM_HEADER = struct.Struct(">QB")
+
+def pack_room_message(seq: int, room: str, plaintext: bytes) -> bytes:
+    r = room.encode("utf-8")
+    return b"".join((ROOM_HEADER.pack(seq, len(r)), r, plaintext))
+
+def unpack_room_message(data: bytes) -> tuple[int, str, bytes]:
+    seq, rlen = ROOM_HEADER.unpack_from(data)
+    start = ROOM_HEADER.size
+    return seq, str(data[start:start + rlen], "utf-8"), data[start + rlen:]
+
+# Двоичный конверт (кадр FRAME_ENVELOPE): вид (1 байт), длина отправителя (1 байт),
+# длина получателя (2 байта), отправитель, получатель, данные.
+# Пустой получатель - рассылка в комнату DEFAULT_ROOM, иначе имена получателей через запятую.
+# Отправителя заполняет сервер, клиент оставляет его пустым.
+ENVELOPE_HEADER = struct.Struct(">BBH")
+
+def pack_envelope(kind: int, sender: str, recipient: str, body: bytes) -> bytes:
+    s, r = sender.encode("utf-8"), recipient.encode("utf-8")
+    return b"".join((ENVELOPE_HEADER.pack(kind, len(s), len(r)), s, r, body))
+
+def unpack_envelope(data: bytes) -> tuple[int, str, str, memoryview]:
+    """Разбор конверта. Данные возвращаются как memoryview, без копирования"""
+    kind, slen, rlen = ENVELOPE_HEADER.unpack_from(data)
+    view = memoryview(data)
+    start = ENVELOPE_HEADER.size
+    sender = str(view[start:start + slen], "utf-8")
+    recipient = str(view[start + slen:start + slen + rlen], "utf-8")
+    return kind, sender, recipient, view[start + slen + rlen:]
 
-async def read_framed(reader: asyncio.StreamReader) -> bytes:
-    header = await reader.readexactly(HEADER_LENGTH)
-    size = int(header.decode("utf-8").strip())
-    if size < 0:
-        raise ValueError("Invalid frame size")
-    return await reader.readexactly(size)
+# Каталог публичных ключей E2E на сервере. Конверты этих видов сервер обрабатывает сам
+# и никому не пересылает. Остальные виды конвертов выбирает клиент (см. e2e_mobp.py).
+KEY_PUBLISH = 64 # клиент -> сервер: данные - свой публичный ключ
+KEY_FETCH = 65   # клиент -> сервер: получатель - нужные имена через запятую (пустой - все),
+                 # сервер отвечает KEY_LIST и дальше присылает изменения этих ключей
+KEY_LIST = 66    # сервер -> клиент: данные - список ключей (pack_key_list)
+KEY_ENTRY = struct.Struct(">BH") # длина имени, длина ключа; пустой ключ - ключа нет
 
-async def write_framed(writer: asyncio.StreamWriter, data: bytes) -> None:
-    header = f"{len(data):<{HEADER_LENGTH}}".encode("utf-8")
-    writer.write(header + data)
+def pack_key_list(entries: Iterable[tuple[str, bytes]]) -> bytes:
+    parts = []
+    for name, key in entries:
+        n = name.encode("utf-8")
+        parts += (KEY_ENTRY.pack(len(n), len(key)), n, key)
+    return b"".join(parts)
+
+def unpack_key_list(data: bytes | memoryview) -> list[tuple[str, bytes]]:
+    view = memoryview(data)
+    entries = []
+    i = 0
+    while i < len(view):
+        nlen, klen = KEY_ENTRY.unpack_from(view, i)
+        i += KEY_ENTRY.size
+        entries.append((str(view[i:i + nlen], "utf-8"), bytes(view[i + nlen:i + nlen + klen])))
+        i += nlen + klen
+    return entries
+
+class FrameTooLarge(ValueError):
+    """Размер кадра в заголовке больше допустимого (или отрицательный)"""
+
+async def read_frame(reader: asyncio.StreamReader, framing: int = FRAMING_LEGACY,
+                     max_size: int = MAX_FRAME_SIZE) -> tuple[int, bytes]:
+    """Чтение кадра вместе с его типом. В старом формате тип всегда FRAME_DATA"""
+    if not isinstance(reader, asyncio.StreamReader): # transport.FrameProtocol разбирает кадры сам
+        return await reader.read_frame(framing, max_size)
+    if framing == FRAMING_V2:
+        size, ftype = V2_HEADER.unpack(await reader.readexactly(V2_HEADER.size))
+    else:
+        header = await reader.readexactly(HEADER_LENGTH)
+        size = int(header) # int() сам пропускает пробелы и понимает bytes
+        ftype = FRAME_DATA
+    if size < 0 or size > max_size:
+        raise FrameTooLarge("Invalid frame size")
+    return ftype, await reader.readexactly(size)
+
+async def read_framed(reader: asyncio.StreamReader, framing: int = FRAMING_LEGACY,
+                      max_size: int = MAX_FRAME_SIZE) -> bytes:
+    return (await read_frame(reader, framing, max_size))[1]
+
+def frame_header(size: int, framing: int = FRAMING_LEGACY, ftype: int = FRAME_DATA) -> bytes:
+    if framing == FRAMING_V2:
+        return V2_HEADER.pack(size, ftype)
+    if ftype != FRAME_DATA:
+        raise ValueError("Legacy framing carries data frames only")
+    return f"{size:<{HEADER_LENGTH}}".encode("utf-8")
+
+def pack_frame(data: bytes, framing: int = FRAMING_LEGACY, ftype: int = FRAME_DATA) -> bytes:
+    """Заголовок + данные одним буфером. Готовый кадр можно отправить нескольким клиентам"""
+    return frame_header(len(data), framing, ftype) + data
+
+async def write_packed(writer: asyncio.StreamWriter, packed: bytes) -> None:
+    writer.write(packed)
     await writer.drain() # flush
 
-async def read_message(reader: asyncio.StreamReader, codec: AsyncCodec|None=None) -> bytes:
-    data = await read_framed(reader)
+async def write_parts(writer: asyncio.StreamWriter, parts: list) -> None:
+    """Несколько буферов (заголовки и данные кадров) одной записью и одним drain"""
+    writer.writelines(parts)
+    await writer.drain()
+
+async def write_framed(writer: asyncio.StreamWriter, data: bytes, framing: int = FRAMING_LEGACY,
+                       ftype: int = FRAME_DATA) -> None:
+    if framing == FRAMING_V2:
+        # заголовок и данные передаем отдельными буферами, без копирования data в общий буфер
+        await write_parts(writer, [frame_header(len(data), framing, ftype), memoryview(data)])
+        return
+    await write_packed(writer, pack_frame(data, framing, ftype))
+
+def compress_frame(codec: AsyncCodec | None, data: bytes, ftype: int = FRAME_DATA) -> tuple[int, bytes]:
+    """Сжатие перед шифрованием, если сессия договорилась о нем и сообщение не короче порога.
+    Возвращает тип кадра (с FRAME_COMPRESSED, если сжали) и данные. Уже сжатое, FRAME_NO_COMPRESS
+    и конверты (там шифротекст, он не сжимается) не трогаем"""
+    compression = codec.compression if codec is not None else None
+    if ftype & FRAME_NO_COMPRESS:
+        return ftype & ~FRAME_NO_COMPRESS, data
+    if compression is None or ftype & FRAME_COMPRESSED or ftype == FRAME_ENVELOPE or len(data) < compression.threshold:
+        return ftype, data
+    packed = compression.compress(data)
+    return (ftype, data) if packed is None else (ftype | FRAME_COMPRESSED, packed)
+
+def sync_codec(codec: AsyncCodec, size: int) -> bool:
+    """encode_sync/decode_sync можно вызвать без await: кодек синхронный, и данные
+    не настолько большие, чтобы шифровать их в пуле потоков"""
+    return codec.sync and (codec.offload_bytes is None or size < codec.offload_bytes)
+
+async def read_typed_message(reader: asyncio.StreamReader, codec: AsyncCodec|None=None,
+                             framing: int = FRAMING_LEGACY, max_size: int = MAX_FRAME_SIZE) -> tuple[int, bytes]:
+    ftype, data = await read_frame(reader, framing, max_size)
     if codec is None:
-        return data
-    return await codec.decode(data)
+        return ftype, data
+    start = time.perf_counter()
+    data = codec.decode_sync(data) if sync_codec(codec, len(data)) else await codec.decode(data)
+    if ftype & FRAME_COMPRESSED:
+        if codec.compression is None:
+            raise ValueError("Compression was not negotiated")
+        data = codec.compression.decompress(data, max_size)
+        ftype &= ~FRAME_COMPRESSED
+    DECODE_SECONDS.labels(codec.name).observe(time.perf_counter() - start)
+    return ftype, data
+
+async def read_message(reader: asyncio.StreamReader, codec: AsyncCodec|None=None,
+                       framing: int = FRAMING_LEGACY, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    return (await read_typed_message(reader, codec, framing, max_size))[1]
 
-async def write_message(writer: asyncio.StreamWriter, data: bytes, codec: AsyncCodec|None=None) -> None:
+async def write_message(writer: asyncio.StreamWriter, data: bytes, codec: AsyncCodec|None=None,
+                        framing: int = FRAMING_LEGACY, ftype: int = FRAME_DATA) -> None:
     if codec is not None:
-        data = await codec.encode(data)
-    await write_framed(writer, data)
+        start = time.perf_counter()
+        ftype, data = compress_frame(codec, data, ftype)
+        data = codec.encode_sync(data) if sync_codec(codec, len(data)) else await codec.encode(data)
+        ENCODE_SECONDS.labels(codec.name).observe(time.perf_counter() - start)
+    await write_framed(writer, data, framing, ftype)
 
 async def close_writer(writer: asyncio.StreamWriter) -> None:
     try:
         writer.close()
         await writer.wait_closed()
     except Exception:
-        pass
\ No newline at end of file
+        pass
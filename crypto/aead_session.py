@@ -0,0 +1,104 @@
+# chat/crypto/aead_session.py
+import os
+import struct
+import asyncio
+from crypto.base import AsyncCodec
+
+ROLE_CLIENT = 1
+ROLE_SERVER = 2
+NONCE_LEN = 12
+TAG_LEN = 16
+REPLAY_WINDOW = 64 # насколько номер может отставать от наибольшего принятого (шифрование в пуле потоков)
+_NONCE = struct.Struct(">IQ") # направление (роль отправителя) + номер сообщения
+
+
+class AEADSession:
+    """Шифрование сессии одним AEAD ключом в обе стороны: кадр = nonce + шифротекст.
+
+    Если задана роль (ROLE_CLIENT/ROLE_SERVER), nonce не случайный, а счетчик своего
+    направления: в nonce входит роль отправителя, поэтому направления не пересекаются,
+    а urandom на каждое сообщение не нужен. Получатель помнит наибольший принятый номер
+    и окно из REPLAY_WINDOW номеров перед ним: повтор или слишком старый номер - ошибка.
+    Окно нужно, потому что сообщения, зашифрованные в пуле потоков, могут уйти не в порядке
+    номеров. Без роли nonce случайный, как раньше.
+
+    seal шифрует сразу в заранее выделенный буфер (encrypt_into), open работает с memoryview
+    и не копирует входные данные.
+    """
+
+    def __init__(self, aead: object, role: int | None = None) -> None:
+        if role not in (None, ROLE_CLIENT, ROLE_SERVER):
+            raise ValueError(f"Unknown role: {role}")
+        self._aead = aead
+        self._role = role
+        self._peer_role = None if role is None else ROLE_SERVER if role == ROLE_CLIENT else ROLE_CLIENT
+        self._send_counter = 0
+        self._recv_counter = -1 # наибольший принятый номер
+        self._recv_seen = 0 # бит i - принят номер _recv_counter - i
+        self._into = hasattr(aead, "encrypt_into") # есть в новых версиях cryptography
+
+    def next_nonce(self) -> bytes:
+        if self._role is None:
+            return os.urandom(NONCE_LEN)
+        nonce = _NONCE.pack(self._role, self._send_counter)
+        self._send_counter += 1
+        return nonce
+
+    def seal(self, plaintext: bytes, nonce: bytes | None = None) -> bytearray:
+        """nonce берется заранее (next_nonce), если seal выполняется не в потоке event loop"""
+        if nonce is None:
+            nonce = self.next_nonce()
+        buf = bytearray(NONCE_LEN + len(plaintext) + TAG_LEN)
+        buf[:NONCE_LEN] = nonce
+        view = memoryview(buf)
+        if self._into:
+            self._aead.encrypt_into(nonce, plaintext, None, view[NONCE_LEN:])
+        else:
+            view[NONCE_LEN:] = self._aead.encrypt(nonce, plaintext, None)
+        return buf
+
+    def open(self, data: bytes) -> bytes:
+        view = memoryview(data)
+        if len(view) < NONCE_LEN + TAG_LEN:
+            raise ValueError("Message too short")
+        nonce = view[:NONCE_LEN]
+        if self._role is None:
+            return self._aead.decrypt(nonce, view[NONCE_LEN:], None)
+        role, counter = _NONCE.unpack_from(view)
+        behind = self._recv_counter - counter
+        if role != self._peer_role or behind >= REPLAY_WINDOW or (behind >= 0 and self._recv_seen >> behind & 1):
+            raise ValueError("Replayed or reordered message")
+        plaintext = self._aead.decrypt(nonce, view[NONCE_LEN:], None)
+        if behind < 0: # только после успешной проверки тега
+            self._recv_seen = (self._recv_seen << -behind | 1) & ((1 << REPLAY_WINDOW) - 1)
+            self._recv_counter = counter
+        else:
+            self._recv_seen |= 1 << behind
+        return plaintext
+
+
+class AEADCodec(AsyncCodec):
+    """Общая часть кодеков с AEADSession: синхронный путь и шифрование больших данных в пуле потоков"""
+    sync = True
+    offload_bytes: int | None = None
+    _session: AEADSession
+
+    def encode_sync(self, plaintext: bytes) -> bytes:
+        return self._session.seal(plaintext) # nonce + шифротекст в одном буфере
+
+    def decode_sync(self, ciphertext: bytes) -> bytes:
+        return self._session.open(ciphertext)
+
+    def _offload(self, data: bytes) -> bool:
+        return self.offload_bytes is not None and len(data) >= self.offload_bytes
+
+    async def encode(self, plaintext: bytes) -> bytes:
+        if not self._offload(plaintext):
+            return self._session.seal(plaintext)
+        nonce = self._session.next_nonce() # номер берем в потоке event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self._session.seal, plaintext, nonce)
+
+    async def decode(self, ciphertext: bytes) -> bytes:
+        if not self._offload(ciphertext):
+            return self._session.open(ciphertext)
+        return await asyncio.get_running_loop().run_in_executor(None, self._session.open, ciphertext)
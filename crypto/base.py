@@ -1,8 +1,24 @@
 # chat/crypto/base.py
 import asyncio
-from typing import Protocol
+from typing import Protocol, TYPE_CHECKING
+if TYPE_CHECKING:
+    from crypto.compression import Compression
 
 class AsyncCodec(Protocol):
     name: str
+    passthrough: bool = False # True - encode ничего не меняет, кадр можно собрать один раз на всех получателей
+    # True - у кодека есть encode_sync/decode_sync, и common.py вызывает их без await.
+    # Асинхронные encode/decode остаются для кодеков, которым действительно нужно ждать
+    sync: bool = False
+    # Данные от offload_bytes байт синхронный кодек шифрует в пуле потоков через encode/decode
+    # (AEAD из cryptography отпускает GIL). None - всегда синхронно
+    offload_bytes: int | None = None
+    # (алгоритм, секрет) для билета возобновления сессии (crypto/tickets.py). None - возобновлять нечего
+    resumption: tuple[str, bytes] | None = None
+    resumed: bool = False # сессия возобновлена по билету, без обмена DH
+    # Сжатие, о котором договорились при подключении (common.compress_frame). None - без сжатия
+    compression: "Compression | None" = None
     async def encode(self, plaintext: bytes) -> bytes: ...
-    async def decode(self, ciphertext: bytes) -> bytes: ...
\ No newline at end of file
+    async def decode(self, ciphertext: bytes) -> bytes: ...
+    def encode_sync(self, plaintext: bytes) -> bytes: ...
+    def decode_sync(self, ciphertext: bytes) -> bytes: ...
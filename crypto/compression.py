@@ -0,0 +1,61 @@
+# chat/crypto/compression.py
+import zlib
+from typing import Dict
+from common import FrameTooLarge
+
+COMPRESS_THRESHOLD = 512 # сообщения короче не сжимаем: выигрыш меньше заголовка zlib и затрат на вызов
+COMPRESS_LEVEL = 6
+NAME_ZLIB = "zlib"
+NAME_ZLIB_CHAT = "zlib-chat1" # zlib с общим словарем CHAT_DICTIONARY. Словарь менять только вместе с именем
+
+# Заранее известный обеим сторонам словарь: с ним сжимаются и не очень длинные сообщения,
+# в которых еще мало повторов. Самое частое - в конце (до него ближе всего ссылки zlib)
+CHAT_DICTIONARY = "".join((
+    "Traceback (most recent call last):\n  File \"", "\", line ", ", in ", "raise ", "Exception", "Error: ",
+    "ERROR ", "WARNING ", "INFO ", "DEBUG ", "https://", "http://", "github.com/", ".py", ".json",
+    "import ", "from ", "def ", "class ", "async def ", "await ", "return ", "self.", "None", "True", "False",
+    "if __name__ == \"__main__\":\n", "function ", "const ", "console.log(", "null", "undefined", "{\n", "}\n",
+    "\n    ", "        ", " == ", " = ", "();\n", "):\n", "\n\n",
+    "пожалуйста", "спасибо", "сообщение", "сервер", "клиент", "ошибка", "работает", "сейчас", "только",
+    "может", "нужно", "вообще", "просто", "если ", "когда ", "почему ", "потому что ", "тоже ", "еще ",
+    "уже ", "там ", "так ", "все ", "вот ", "меня ", "тебя ", "было ", "есть ", "будет ", "надо ",
+    "привет", "Привет", "да ", "нет ", " как ", " что ", " это ", " не ", " на ", " по ", " с ", " и ", " в ",
+    "] > ", " [", " > ",
+)).encode("utf-8")
+
+
+class Compression:
+    """Сжатие содержимого кадра до шифрования. Каждое сообщение сжимается отдельно,
+    без общего состояния между сообщениями: кадр может быть выброшен из очереди (drop_oldest),
+    и получатель все равно разожмет следующий. Один объект на все сессии с этим вариантом"""
+
+    def __init__(self, name: str, zdict: bytes | None = None, level: int = COMPRESS_LEVEL,
+                 threshold: int = COMPRESS_THRESHOLD) -> None:
+        self.name = name
+        self.zdict = zdict
+        self.level = level
+        self.threshold = threshold
+
+    def compress(self, data: bytes) -> bytes | None:
+        """None - сжатие ничего не дало, отправлять как есть"""
+        z = zlib.compressobj(self.level, zdict=self.zdict) if self.zdict else zlib.compressobj(self.level)
+        out = z.compress(data) + z.flush()
+        return out if len(out) < len(data) else None
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        """Разжатый кадр тоже не больше max_size: маленький кадр не должен превращаться в гигабайты"""
+        z = zlib.decompressobj(zdict=self.zdict) if self.zdict else zlib.decompressobj()
+        out = z.decompress(data, max_size)
+        if z.unconsumed_tail:
+            raise FrameTooLarge("Decompressed frame is too large")
+        if not z.eof:
+            raise ValueError("Truncated compressed frame")
+        return out
+
+
+COMPRESSIONS: Dict[str, Compression] = {
+    NAME_ZLIB_CHAT: Compression(NAME_ZLIB_CHAT, CHAT_DICTIONARY),
+    NAME_ZLIB: Compression(NAME_ZLIB),
+}
+# Порядок предпочтения сервера и список, который клиент предлагает по умолчанию
+COMPRESSION_PREFERENCE = (NAME_ZLIB_CHAT, NAME_ZLIB)
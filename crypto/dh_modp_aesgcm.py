@@ -1,10 +1,12 @@
-import os
+import asyncio
 import secrets
 import logging
+from collections import deque
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from crypto.base import AsyncCodec
+from crypto.aead_session import AEADSession, AEADCodec
+from crypto.executor import HandshakeExecutor, default_executor
 
 #Выбираем большой простой модуль для построения кольца
 P_HEX = (
@@ -21,7 +23,9 @@ P = int(P_HEX, 16)
 
 G = 2 #генератор. В нашем случае будут степени двойки
 BLEN = (P.bit_length() + 7) // 8 #размер в байтах округленный вверх для ключей
-NONCE_LEN = 12 
+
+KEY_POOL_SIZE = 64 # сколько пар ключей держим про запас
+KEY_POOL_LOW_WATERMARK = 16 # при каком остатке начинаем пополнять запас
 
 def _i2b(x: int) -> bytes:
     return x.to_bytes(BLEN, "big") #переводим в байты (второй параметр - порядок байтов)
@@ -40,10 +44,28 @@ def _hkdf(shared: bytes, info: bytes) -> bytes:
     """
     return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(shared)
 
-class DHModpAESGCMCodec(AsyncCodec):
+def gen_keypair() -> tuple[int, bytes]:
+    """Генерация пары (секретный ключ, публичный ключ).
+
+    Функции уровня модуля, чтобы их можно было выполнять в пуле процессов
+    """
+    secret = DHModpAESGCMCodec._rand_secret()
+    return secret, DHModpAESGCMCodec.gen_pub(secret)
+
+def derive_key(secret: int, peer_pub_bytes: bytes, client_pub_bytes: bytes, server_pub_bytes: bytes) -> bytes:
+    """Вычисляем общий секрет с публичным ключом собеседника и хешируем его в ключ AESGCM"""
+    peer = int.from_bytes(peer_pub_bytes, "big")
+    if not (1 < peer < P - 1):
+        raise ValueError("Invalid peer public")
+    s = pow(peer, secret, P) # формируем серкетный ключ
+    return _hkdf(_i2b(s), b"MODP-2048-AESGCM-CHAT" + client_pub_bytes + server_pub_bytes) #хэшируем ключ с добавлением информации об алгоритме и публичных ключах
+
+class DHModpAESGCMCodec(AEADCodec):
     name = "DH-MODP14"
-    def __init__(self, key: bytes):
+    def __init__(self, key: bytes, role: int | None = None):
+        """role - ROLE_CLIENT/ROLE_SERVER: nonce-счетчики с защитой от повтора (см. AEADSession)"""
         self._aead = AESGCM(key) #создаем объект для шифрования с помощью ключа
+        self._session = AEADSession(self._aead, role)
 
     @staticmethod
     def _rand_secret() -> int:
@@ -55,23 +77,12 @@ class DHModpAESGCMCodec(AsyncCodec):
 
     @classmethod
     def derive_as_client(cls, a: int, server_pub_bytes: bytes, client_pub_bytes: bytes) -> "DHModpAESGCMCodec":
-        """Принимаем от сервера публичный ключ и генерируем секретный ключ"""
-        B = int.from_bytes(server_pub_bytes, "big") 
-        if not (1 < B < P - 1):
-            raise ValueError("Invalid server public")
-        s = pow(B, a, P) # формируем серкетный ключ
-        key = _hkdf(_i2b(s), b"MODP-2048-AESGCM-CHAT" + client_pub_bytes + server_pub_bytes)  #хэшируем ключ с добавлением информации об алгоритме и публичных ключах
-        # Таким обоазом 
-        return cls(key)
+        """Принимаем от сервера публичный ключ и генерируем секретный ключ"""
+        return cls(derive_key(a, server_pub_bytes, client_pub_bytes, server_pub_bytes))
 
     @classmethod
     def derive_as_server(cls, b: int, client_pub_bytes: bytes, server_pub_bytes: bytes) -> "DHModpAESGCMCodec":
-        A = int.from_bytes(client_pub_bytes, "big")
-        if not (1 < A < P - 1):
-            raise ValueError("Invalid client public")
-        s = pow(A, b, P)
-        key = _hkdf(_i2b(s), b"MODP-2048-AESGCM-CHAT" + client_pub_bytes + server_pub_bytes)
-        return cls(key)
+        return cls(derive_key(b, client_pub_bytes, client_pub_bytes, server_pub_bytes))
 
     @staticmethod
     def gen_pub(secret: int) -> bytes:
@@ -81,12 +92,66 @@ class DHModpAESGCMCodec(AsyncCodec):
         # logging.info("Генерация публичного ключа завершена: %s", result.hex())
         return result
 
-    async def encode(self, plaintext: bytes) -> bytes:
-        nonce = os.urandom(NONCE_LEN) #случайные байты
-        ct = self._aead.encrypt(nonce, plaintext, None)
-        return nonce + ct
 
-    async def decode(self, ciphertext: bytes) -> bytes:
-        nonce = ciphertext[:NONCE_LEN] #случайные байты
-        ct = ciphertext[NONCE_LEN:]
-        return self._aead.decrypt(nonce, ct, None)
\ No newline at end of file
+class EphemeralKeyPool:
+    """Запас заранее сгенерированных эфемерных пар ключей (секретный, публичный) MODP-14.
+
+    Сервер берет пару из запаса, поэтому при рукопожатии остается только одно
+    возведение в степень (общий секрет). Когда в запасе остается меньше low_watermark
+    пар, фоновая задача пополняет его до size через пул рукопожатий.
+    Каждая пара выдается только один раз.
+
+    hits/misses - сколько раз пара нашлась в запасе и сколько раз пришлось генерировать
+    ее во время рукопожатия. По ним подбирается размер запаса под частоту подключений.
+    """
+
+    def __init__(self, size: int = KEY_POOL_SIZE, low_watermark: int = KEY_POOL_LOW_WATERMARK,
+                 executor: HandshakeExecutor | None = None) -> None:
+        if not 0 <= low_watermark <= size:
+            raise ValueError("low_watermark must be between 0 and size")
+        self.size = size
+        self.low_watermark = low_watermark
+        self.executor = executor
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self._keys: deque[tuple[int, bytes]] = deque()
+        self._refill_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def take(self) -> tuple[int, bytes] | None:
+        """Берем пару из запаса. None - запас пуст, пару нужно сгенерировать на месте"""
+        pair = self._keys.popleft() if self._keys else None
+        if pair is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if len(self._keys) < self.low_watermark:
+            self.start()
+        return pair
+
+    def start(self) -> None:
+        """Запускаем фоновое пополнение, если оно еще не идет"""
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self.fill())
+
+    async def fill(self) -> None:
+        """Пополняем запас до size. Можно дождаться при старте сервера для прогрева"""
+        executor = self.executor or default_executor()
+        while len(self._keys) < self.size:
+            self._keys.append(await executor.run(gen_keypair))
+            self.generated += 1
+
+    async def close(self) -> None:
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+            self._refill_task = None
+
+    def stats(self) -> dict:
+        return {"size": len(self._keys), "hits": self.hits, "misses": self.misses, "generated": self.generated}
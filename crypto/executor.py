@@ -0,0 +1,86 @@
+# chat/crypto/executor.py
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+HANDSHAKE_WORKERS = 4
+MAX_INFLIGHT_HANDSHAKES = 64
+
+
+class HandshakeExecutor:
+    """Пул для тяжелых операций рукопожатия (возведение в степень по модулю и HKDF).
+
+    Вычисления выполняются вне event loop, поэтому рукопожатия не останавливают
+    доставку сообщений остальным клиентам. pow() для больших чисел не отпускает GIL,
+    поэтому настоящую параллельность дает только пул процессов (kind="process"),
+    пул потоков лишь дает event loop работать между операциями.
+
+    Количество одновременных рукопожатий ограничено max_inflight.
+    """
+
+    def __init__(self, kind: str = EXECUTOR_THREAD, workers: int = HANDSHAKE_WORKERS,
+                 max_inflight: int = MAX_INFLIGHT_HANDSHAKES) -> None:
+        if kind not in (EXECUTOR_THREAD, EXECUTOR_PROCESS):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self._pool: Executor | None = None
+        self._sem: asyncio.Semaphore | None = None
+        self._sem_loop: asyncio.AbstractEventLoop | None = None
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None: # пул создается при первом рукопожатии
+            if self.kind == EXECUTOR_PROCESS:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="handshake")
+        return self._pool
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._sem is None or self._sem_loop is not loop: # семафор привязан к своему event loop
+            self._sem = asyncio.Semaphore(self.max_inflight)
+            self._sem_loop = loop
+        return self._sem
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Выполняем fn(*args) в пуле. Для пула процессов fn должна быть функцией уровня модуля"""
+        return await asyncio.get_running_loop().run_in_executor(self._get_pool(), fn, *args)
+
+    def slot(self) -> "_Slot":
+        """Место для одного рукопожатия: async with executor.slot(): ..."""
+        return _Slot(self)
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+
+class _Slot:
+    def __init__(self, executor: HandshakeExecutor) -> None:
+        self._executor = executor
+        self._sem: asyncio.Semaphore | None = None
+
+    async def __aenter__(self) -> None:
+        self._sem = self._executor._semaphore()
+        await self._sem.acquire()
+        self._executor.inflight += 1
+
+    async def __aexit__(self, *exc: object) -> None:
+        self._executor.inflight -= 1
+        self._sem.release()
+
+
+_default: HandshakeExecutor | None = None
+
+def default_executor() -> HandshakeExecutor:
+    """Общий пул потоков для рукопожатий, если пул не передан явно"""
+    global _default
+    if _default is None:
+        _default = HandshakeExecutor()
+    return _default
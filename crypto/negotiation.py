@@ -1,67 +1,276 @@
+import os
 import asyncio
 import logging
-from cryptography.hazmat.primitives.asymmetric import x25519
-from cryptography.hazmat.primitives import serialization
-from common import read_framed, write_framed
+from common import read_framed, write_framed, FRAMING_LEGACY, FRAMING_V2
 from crypto.plain import PlainCodec
-from crypto.dh_modp_aesgcm import DHModpAESGCMCodec, BLEN as MODP14_BLEN
+from crypto.dh_modp_aesgcm import DHModpAESGCMCodec, EphemeralKeyPool, BLEN as MODP14_BLEN, gen_keypair, derive_key
+from crypto.executor import HandshakeExecutor, default_executor
+from crypto.aead_session import ROLE_CLIENT, ROLE_SERVER
+from crypto.x25519_aead import (X25519AEADCodec, AEAD_AESGCM, AEAD_CHACHA20,
+                                gen_keypair as x25519_keypair, derive_key as derive_x25519)
+from chatlog import LazyHex
+from crypto.tickets import TicketKeys, RESUME_NONCE_LEN, resumption_secret, resume_key
+from crypto.compression import COMPRESSIONS, COMPRESSION_PREFERENCE
 
 
 ALG_PLAIN = b"ALG:PLAIN"
 ALG_DHMP14 = b"ALG:DHMP14"
 ALG_DHMP14R = b"ALG:DHMP14R"
 
-async def client_negotiate(reader, writer, alg: str = "plain"):
-    a = alg.lower()
-    if a == "plain":
-        await write_framed(writer, ALG_PLAIN)
-        return PlainCodec()
+# Выбор из списка: клиент отправляет ALG:OFFER:<имена через запятую>\n<публичный ключ X25519>,
+# сервер отвечает ALG:SELECT:<имя>[\n<публичный ключ X25519>]. Для X25519 на этом рукопожатие
+# заканчивается, для dhmp14 дальше идет обычный обмен ALG:DHMP14, для plain - ничего.
+# Nonce-счетчики с защитой от повтора (crypto/aead_session.py) только у сессий, выбранных через
+# ALG:OFFER или возобновленных по билету. Старые клиенты сразу отправляют ALG:DHMP14 и шифруют
+# со случайными nonce, поэтому такое рукопожатие без списка по-прежнему дает случайные nonce.
+ALG_OFFER = b"ALG:OFFER:"
+ALG_SELECT = b"ALG:SELECT:"
+NAME_PLAIN = "plain"
+NAME_DHMP14 = "dhmp14"
+NAME_X25519_AESGCM = "x25519-aesgcm"
+NAME_X25519_CHACHA20 = "x25519-chacha20"
+X25519_AEADS = {NAME_X25519_AESGCM: AEAD_AESGCM, NAME_X25519_CHACHA20: AEAD_CHACHA20}
+# Сервер выбирает самый дешевый из шифрованных вариантов, plain - только если клиент больше ничего не умеет
+SERVER_PREFERENCE = (NAME_X25519_AESGCM, NAME_X25519_CHACHA20, NAME_DHMP14, NAME_PLAIN)
+CLIENT_OFFER = (NAME_X25519_AESGCM, NAME_X25519_CHACHA20, NAME_DHMP14) # alg="auto"
+DH_ALIASES = ("dh", "dh_modp", "modp14", "dh14")
+# Сжатие выбирается внутри ALG:OFFER: клиент добавляет в список алгоритмов варианты сжатия
+# z:<вариант>, сервер дописывает выбранный к имени алгоритма: ALG:SELECT:<имя>,z:<вариант>.
+# Серверы без сжатия незнакомые имена в списке просто пропускают. Поэтому при сжатии plain и dhmp14
+# тоже выбираются через ALG:OFFER. Флаг сжатия есть только в кадрах v2, в старом формате сжатия нет
+ALG_COMPRESSION = "z:"
+
+# Возобновление сессии: клиент с билетом от прошлого подключения первым отправляет
+# ALG:RESUME:<16 случайных байт><билет>. Если сервер принял билет, он отвечает ALG:RESUMED:<16 байт>,
+# и обе стороны выводят новый ключ через HKDF (см. tickets.resume_key) без обмена DH.
+# Иначе сервер отвечает ALG:RESUME-FAIL, и клиент в том же соединении делает полное рукопожатие.
+# Сжатие, о котором договорились в полном рукопожатии, записано в билете: если оно было,
+# сервер отвечает ALG:RESUMED:<16 байт>,z:<вариант>.
+ALG_RESUME = b"ALG:RESUME:"
+ALG_RESUMED = b"ALG:RESUMED:"
+ALG_RESUME_FAIL = b"ALG:RESUME-FAIL"
+
+# Выбор формата кадров. Клиент, который умеет v2, первым кадром (в старом формате)
+# отправляет PROTO_V2, сервер отвечает тем же, и дальше обе стороны используют v2.
+# Старые клиенты сразу отправляют ALG:..., для них остается старый формат.
+PROTO_V1 = b"PROTO:1"
+PROTO_V2 = b"PROTO:2"
+HANDSHAKE_MAX_FRAME = 4096 # кадры рукопожатия маленькие, больший размер в заголовке - ошибка клиента
+
+def _session_codec(name: str, key: bytes, role: int | None, resumed: bool = False):
+    """Кодек сессии по имени алгоритма. Запоминаем секрет, чтобы сервер мог выдать билет.
+    role None - случайные nonce, как у старых клиентов (только для dhmp14 без ALG:OFFER)"""
+    if name == NAME_DHMP14:
+        codec = DHModpAESGCMCodec(key, role)
+    else:
+        codec = X25519AEADCodec(key, X25519_AEADS[name], role)
+    codec.resumption = (name, resumption_secret(key))
+    codec.resumed = resumed
+    return codec
+
+def _with_compression(codec, zname: str | None):
+    """Сжатие, о котором договорились (crypto/compression.py). None или "" - без сжатия"""
+    codec.compression = COMPRESSIONS[zname] if zname else None
+    return codec
 
-    if a in ("dh_modp", "modp14", "dh14"):
-        sec = DHModpAESGCMCodec  # alias
-        x = sec._rand_secret() #секретный ключ на стороне клиента
-        A = sec.gen_pub(x) #публичный ключ
-        logging.info("Отправляем публичный ключ на сервер: %s", A.hex())
-        await write_framed(writer, ALG_DHMP14 + A) #отправляем публичный ключ на сервер
-        logging.info("Ключ отправлен.")
-
-        #ожидаем ответ ...
-        logging.info("Ожидаем ответ сервера.")
-        resp = await read_framed(reader) 
-        logging.info("Ответ от сервера получен.")
-
-        if not (len(resp) == len(ALG_DHMP14R) + MODP14_BLEN and resp.startswith(ALG_DHMP14R)):
-            """Одновременно должны выполняться 2 условия:
-            
-            1. длина ответа == ожидаемая длина заголовка + длина секретного ключа
-            2. Ответ начинается с правильного алгоритма
-            """
+def _selected_compression(selected: str, compression: tuple) -> str | None:
+    """Вариант сжатия из ответа сервера: "z:<вариант>" или пустая строка"""
+    if not selected:
+        return None
+    zname = selected[len(ALG_COMPRESSION):] if selected.startswith(ALG_COMPRESSION) else None
+    if zname not in compression:
+        raise RuntimeError("Server selected a compression that was not offered")
+    return zname
+
+async def client_negotiate(reader, writer, alg: str = "plain", executor: HandshakeExecutor | None = None,
+                           framing: int = FRAMING_V2, ticket: tuple[bytes, str, bytes] | None = None,
+                           compression: tuple = ()):
+    """Рукопожатие на стороне клиента. Возвращает (кодек, формат кадров).
+    ticket - (билет, алгоритм, секрет) от прошлого подключения: сначала пробуем возобновить сессию.
+    compression - варианты сжатия, которые клиент умеет (crypto/compression.py), только для v2"""
+    if framing == FRAMING_V2:
+        await write_framed(writer, PROTO_V2)
+        resp = await read_framed(reader)
+        if resp not in (PROTO_V1, PROTO_V2):
+            raise RuntimeError("Framing negotiation failed")
+        framing = FRAMING_V2 if resp == PROTO_V2 else FRAMING_LEGACY
+    compression = tuple(compression) if framing == FRAMING_V2 else ()
+    codec = await _client_alg(reader, writer, alg.lower(), executor or default_executor(), framing, ticket,
+                              compression)
+    return codec, framing
+
+async def _client_alg(reader, writer, a: str, executor: HandshakeExecutor, framing: int,
+                      ticket: tuple[bytes, str, bytes] | None, compression: tuple):
+    """Выбор алгоритма и сжатия и обмен ключами после выбора формата кадров. Возвращает кодек"""
+    if ticket is not None and a != "plain":
+        blob, name, secret = ticket
+        client_nonce = os.urandom(RESUME_NONCE_LEN)
+        await write_framed(writer, ALG_RESUME + client_nonce + blob, framing)
+        resp = await read_framed(reader, framing)
+        end = len(ALG_RESUMED) + RESUME_NONCE_LEN
+        if resp.startswith(ALG_RESUMED) and len(resp) >= end and resp[end:end + 1] in (b"", b","):
+            zname = _selected_compression(resp[end + 1:].decode(), compression)
+            logging.info("Сессия %s возобновлена по билету", name)
+            codec = _session_codec(name, resume_key(secret, client_nonce, resp[len(ALG_RESUMED):end], name),
+                                   ROLE_CLIENT, resumed=True)
+            return _with_compression(codec, zname)
+        if resp != ALG_RESUME_FAIL:
             raise RuntimeError("Handshake failed")
-        B = resp[len(ALG_DHMP14R):] 
-        return DHModpAESGCMCodec.derive_as_client(x, B, A)
+        logging.info("Сервер не принял билет, полное рукопожатие")
 
-    raise ValueError("Unknown algorithm")
+    if a == "plain" and not compression:
+        await write_framed(writer, ALG_PLAIN, framing)
+        return PlainCodec()
+
+    if a in DH_ALIASES and framing != FRAMING_V2: # старый формат кадров - старое рукопожатие, nonce случайные
+        return await _client_dhmp14(reader, writer, executor, framing, None)
 
-async def server_negotiate(reader, writer):
-    hello = await read_framed(reader)
-    logging.info("Клиент начинает рукопожатие: %s", hello)
+    if a == "plain": # сжатие и nonce-счетчики - только через список ALG:OFFER
+        offer = (NAME_PLAIN,)
+    elif a in DH_ALIASES:
+        offer = (NAME_DHMP14,)
+    elif a == "auto":
+        offer = CLIENT_OFFER
+    elif a in ("x25519", "x25519-aesgcm", "x25519-chacha20"):
+        offer = (NAME_X25519_AESGCM, NAME_X25519_CHACHA20) if a == "x25519" else (a,)
+    else:
+        raise ValueError("Unknown algorithm")
+
+    # Список алгоритмов: сервер выбирает из них самый дешевый по своему порядку предпочтения.
+    # Публичный ключ X25519 отправляем сразу, чтобы при выборе X25519 хватило одного обмена
+    private, client_pub = x25519_keypair()
+    names = offer + tuple(ALG_COMPRESSION + z for z in compression)
+    await write_framed(writer, ALG_OFFER + ",".join(names).encode() + b"\n" + client_pub, framing)
+    resp = await read_framed(reader, framing)
+    if not resp.startswith(ALG_SELECT):
+        raise RuntimeError("Handshake failed")
+    name, _, server_pub = resp[len(ALG_SELECT):].partition(b"\n")
+    name, _, selected = name.decode().partition(",")
+    if name not in offer:
+        raise RuntimeError("Server selected an algorithm that was not offered")
+    zname = _selected_compression(selected, compression)
+    logging.info("Сервер выбрал алгоритм %s, сжатие %s", name, zname)
+    if name == NAME_PLAIN:
+        return _with_compression(PlainCodec(), zname)
+    if name == NAME_DHMP14:
+        return _with_compression(await _client_dhmp14(reader, writer, executor, framing, ROLE_CLIENT), zname)
+    key = derive_x25519(private, server_pub, client_pub, server_pub, X25519_AEADS[name])
+    return _with_compression(_session_codec(name, key, ROLE_CLIENT), zname)
+
+async def _client_dhmp14(reader, writer, executor: HandshakeExecutor, framing: int,
+                         role: int | None) -> DHModpAESGCMCodec:
+    x, A = await executor.run(gen_keypair) #секретный и публичный ключ на стороне клиента
+    logging.debug("Отправляем публичный ключ на сервер: %s", LazyHex(A))
+    await write_framed(writer, ALG_DHMP14 + A, framing) #отправляем публичный ключ на сервер
+    logging.debug("Ключ отправлен.")
+
+    #ожидаем ответ ...
+    logging.debug("Ожидаем ответ сервера.")
+    resp = await read_framed(reader, framing)
+    logging.debug("Ответ от сервера получен.")
+
+    if not (len(resp) == len(ALG_DHMP14R) + MODP14_BLEN and resp.startswith(ALG_DHMP14R)):
+        """Одновременно должны выполняться 2 условия:
+        
+        1. длина ответа == ожидаемая длина заголовка + длина секретного ключа
+        2. Ответ начинается с правильного алгоритма
+        """
+        raise RuntimeError("Handshake failed")
+    B = resp[len(ALG_DHMP14R):] 
+    return _session_codec(NAME_DHMP14, await executor.run(derive_key, x, B, A, B), role)
+
+async def server_negotiate(reader, writer, executor: HandshakeExecutor | None = None,
+                           key_pool: EphemeralKeyPool | None = None, preference: tuple = SERVER_PREFERENCE,
+                           tickets: TicketKeys | None = None, compression: tuple = COMPRESSION_PREFERENCE):
+    """Рукопожатие на стороне сервера. Возвращает (кодек, формат кадров).
+    preference - порядок выбора из списка алгоритмов клиента (ALG:OFFER),
+    tickets - ключи билетов возобновления, None - билеты не принимаются,
+    compression - порядок выбора сжатия из вариантов клиента, пустой - без сжатия"""
+    framing = FRAMING_LEGACY
+    hello = await read_framed(reader, max_size=HANDSHAKE_MAX_FRAME)
+    if hello == PROTO_V2:
+        await write_framed(writer, PROTO_V2)
+        framing = FRAMING_V2
+        hello = await read_framed(reader, framing, HANDSHAKE_MAX_FRAME)
+    codec = await _server_alg(reader, writer, hello, framing, executor or default_executor(), key_pool,
+                              preference, tickets, compression if framing == FRAMING_V2 else ())
+    return codec, framing
+
+async def _server_alg(reader, writer, hello: bytes, framing: int, executor: HandshakeExecutor,
+                      key_pool: EphemeralKeyPool | None, preference: tuple, tickets: TicketKeys | None,
+                      compression: tuple):
+    """Выбор алгоритма и сжатия по первому кадру hello после выбора формата кадров. Возвращает кодек"""
+    zname = None
+    role = None # ALG:DHMP14 без списка - старый клиент со случайными nonce
+    logging.debug("Клиент начинает рукопожатие: %s", hello[:16])
+
+    if hello.startswith(ALG_RESUME):
+        client_nonce = hello[len(ALG_RESUME):len(ALG_RESUME) + RESUME_NONCE_LEN]
+        opened = tickets.open(hello[len(ALG_RESUME) + RESUME_NONCE_LEN:]) if tickets is not None else None
+        if opened is not None and opened[0] in preference and len(client_nonce) == RESUME_NONCE_LEN:
+            name, secret, zname = opened
+            zname = zname if zname in compression else None
+            server_nonce = os.urandom(RESUME_NONCE_LEN)
+            key = resume_key(secret, client_nonce, server_nonce, name)
+            await write_framed(writer, ALG_RESUMED + server_nonce + (f",{ALG_COMPRESSION}{zname}".encode() if zname else b""),
+                               framing)
+            logging.debug("Сессия %s возобновлена по билету", name)
+            return _with_compression(_session_codec(name, key, ROLE_SERVER, resumed=True), zname)
+        await write_framed(writer, ALG_RESUME_FAIL, framing)
+        hello = await read_framed(reader, framing, HANDSHAKE_MAX_FRAME) # клиент начинает полное рукопожатие
 
     if hello == ALG_PLAIN:
         return PlainCodec()
 
-    logging.info("длина заголовка: %d, ожидаемая длина заголовка: %d", len(hello), len(ALG_DHMP14) + MODP14_BLEN)
+    if hello.startswith(ALG_OFFER):
+        names, _, client_pub = hello[len(ALG_OFFER):].partition(b"\n")
+        offered = set(names.decode().split(","))
+        name = next((n for n in preference if n in offered), None)
+        algs = [n for n in offered if not n.startswith(ALG_COMPRESSION)]
+        if name is None and algs in ([NAME_PLAIN], [NAME_DHMP14]):
+            name = algs[0] # клиент с явным alg="plain"/"dh": принимаем, как ALG:PLAIN и ALG:DHMP14
+        if name is None:
+            raise ValueError("No common algorithm")
+        zname = next((z for z in compression if ALG_COMPRESSION + z in offered), None)
+        logging.debug("Выбран алгоритм %s, сжатие %s", name, zname)
+        selected = ALG_SELECT + (f"{name},{ALG_COMPRESSION}{zname}" if zname else name).encode()
+        if name == NAME_PLAIN:
+            await write_framed(writer, selected, framing)
+            return _with_compression(PlainCodec(), zname)
+        if name == NAME_DHMP14:
+            await write_framed(writer, selected, framing)
+            role = ROLE_SERVER
+            hello = await read_framed(reader, framing, HANDSHAKE_MAX_FRAME) # дальше обычное рукопожатие MODP-14
+        else:
+            aead = X25519_AEADS[name]
+            private, server_pub = x25519_keypair()
+            key = derive_x25519(private, client_pub, client_pub, server_pub, aead)
+            await write_framed(writer, selected + b"\n" + server_pub, framing)
+            return _with_compression(_session_codec(name, key, ROLE_SERVER), zname)
+
+    logging.debug("длина заголовка: %d, ожидаемая длина заголовка: %d", len(hello), len(ALG_DHMP14) + MODP14_BLEN)
     if hello.startswith(ALG_DHMP14) and len(hello) == len(ALG_DHMP14) + MODP14_BLEN:
         client_pub = hello[len(ALG_DHMP14):] #Получаем публичный ключ клиента
-        sec = DHModpAESGCMCodec
-        logging.info("Генерируем секретный ключ")
-        y = sec._rand_secret() #секретный ключ на стороне сервера
-        logging.info("Секретный ключ сгенерирован")
+        return _with_compression(await _server_dhmp14(writer, client_pub, executor, key_pool, framing, role),
+                                 zname)
+
+    raise ValueError("Unknown algorithm")
 
-        B = sec.gen_pub(y) #публичный ключ
-        logging.info("Отправляем свой публичный ключ клиенту: %s", B.hex())
-        await write_framed(writer, ALG_DHMP14R + B) #отправляем публичный ключ клиенту
-        logging.info("Ключ отправлен.")
+async def _server_dhmp14(writer, client_pub: bytes, executor: HandshakeExecutor,
+                         key_pool: EphemeralKeyPool | None, framing: int, role: int | None) -> DHModpAESGCMCodec:
+    async with executor.slot(): # ограничиваем число одновременных рукопожатий
+        pair = key_pool.take() if key_pool is not None else None #берем готовую пару из запаса
+        if pair is None:
+            logging.debug("Генерируем секретный ключ")
+            pair = await executor.run(gen_keypair)
+            logging.debug("Секретный ключ сгенерирован")
+        y, B = pair #секретный и публичный ключ на стороне сервера
+        # Ключ сессии вычисляем до ответа: когда клиент закончит рукопожатие, сервер уже
+        # готов принять его имя, и сообщения, отправленные после connect(), до него дойдут
+        key = await executor.run(derive_key, y, client_pub, client_pub, B)
 
-        return DHModpAESGCMCodec.derive_as_server(y, client_pub, B)
+        logging.debug("Отправляем свой публичный ключ клиенту: %s", LazyHex(B))
+        await write_framed(writer, ALG_DHMP14R + B, framing) #отправляем публичный ключ клиенту
+        logging.debug("Ключ отправлен.")
 
-    raise ValueError("Unknown algorithm")
\ No newline at end of file
+        return _session_codec(NAME_DHMP14, key, role)
@@ -3,7 +3,13 @@ from crypto.base import AsyncCodec
 
 class PlainCodec(AsyncCodec):
     name = "PLAIN"
+    passthrough = True
+    sync = True
+    def encode_sync(self, plaintext: bytes) -> bytes:
+        return plaintext
+    def decode_sync(self, ciphertext: bytes) -> bytes:
+        return ciphertext
     async def encode(self, plaintext: bytes) -> bytes:
         return plaintext
     async def decode(self, ciphertext: bytes) -> bytes:
-        return ciphertext
\ No newline at end of file
+        return ciphertext
@@ -0,0 +1,89 @@
+# chat/crypto/tickets.py
+import os
+import time
+import struct
+from typing import Dict, Tuple
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+TICKET_LIFETIME = 600.0 # сколько секунд после выдачи билетом можно возобновить сессию
+TICKET_KEY_ROTATION = 3600.0 # как часто сервер меняет ключ билетов
+RESUME_NONCE_LEN = 16
+_KEY_ID_LEN = 4
+_NONCE_LEN = 12
+_TICKET_HEADER = struct.Struct(">dBB") # время выдачи, длина имени алгоритма, длина имени сжатия
+
+
+def _hkdf(secret: bytes, info: bytes, salt: bytes | None = None) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(secret)
+
+def resumption_secret(session_key: bytes) -> bytes:
+    """Секрет для возобновления, выводится из ключа сессии. Сам ключ сессии в билет не попадает"""
+    return _hkdf(session_key, b"CHAT-RESUMPTION")
+
+def resume_key(secret: bytes, client_nonce: bytes, server_nonce: bytes, alg: str) -> bytes:
+    """Новый ключ сессии при возобновлении: только HKDF, без возведения в степень.
+    Случайные числа обеих сторон делают ключ каждого возобновления свежим"""
+    return _hkdf(secret, b"CHAT-RESUME|" + alg.encode(), salt=client_nonce + server_nonce)
+
+
+class TicketKeys:
+    """Ключи сервера для билетов возобновления сессии.
+
+    Билет - зашифрованные ключом сервера (алгоритм, сжатие, секрет возобновления, время выдачи),
+    хранить сессии на сервере не нужно. Ключ меняется раз в rotation секунд, предыдущий
+    ключ остается для билетов, выданных до смены, пока они не истекут.
+    """
+
+    def __init__(self, lifetime: float = TICKET_LIFETIME, rotation: float = TICKET_KEY_ROTATION) -> None:
+        if rotation < lifetime:
+            raise ValueError("rotation must not be shorter than lifetime")
+        self.lifetime = lifetime
+        self.rotation = rotation
+        self.issued = 0
+        self.resumed = 0
+        self.rejected = 0
+        self._keys: Dict[bytes, AESGCM] = {}
+        self._current: bytes = b""
+        self._rotated_at = 0.0
+        self.rotate()
+
+    def rotate(self) -> None:
+        key_id = os.urandom(_KEY_ID_LEN)
+        if self._current in self._keys: # оставляем только текущий и предыдущий ключ
+            self._keys = {self._current: self._keys[self._current]}
+        self._keys[key_id] = AESGCM(AESGCM.generate_key(bit_length=256))
+        self._current = key_id
+        self._rotated_at = time.monotonic()
+
+    def issue(self, alg: str, secret: bytes, compression: str = "") -> bytes:
+        if time.monotonic() - self._rotated_at >= self.rotation:
+            self.rotate()
+        name, zname = alg.encode(), compression.encode()
+        plaintext = _TICKET_HEADER.pack(time.time(), len(name), len(zname)) + name + zname + secret
+        nonce = os.urandom(_NONCE_LEN)
+        self.issued += 1
+        return self._current + nonce + self._keys[self._current].encrypt(nonce, plaintext, self._current)
+
+    def open(self, ticket: bytes) -> Tuple[str, bytes, str] | None:
+        """(алгоритм, секрет возобновления, сжатие) или None, если билет чужой, поврежден или истек.
+        Сжатие - пустая строка, если в исходной сессии его не было"""
+        key_id, nonce = ticket[:_KEY_ID_LEN], ticket[_KEY_ID_LEN:_KEY_ID_LEN + _NONCE_LEN]
+        aead = self._keys.get(key_id)
+        try:
+            if aead is None:
+                raise InvalidTag
+            plaintext = aead.decrypt(nonce, ticket[_KEY_ID_LEN + _NONCE_LEN:], key_id)
+        except InvalidTag:
+            self.rejected += 1
+            return None
+        issued_at, nlen, zlen = _TICKET_HEADER.unpack_from(plaintext)
+        if not 0 <= time.time() - issued_at <= self.lifetime:
+            self.rejected += 1
+            return None
+        start = _TICKET_HEADER.size
+        self.resumed += 1
+        return (plaintext[start:start + nlen].decode(), plaintext[start + nlen + zlen:],
+                plaintext[start + nlen:start + nlen + zlen].decode())
@@ -1,29 +1,31 @@
 # chat/e2e_client.py
 import asyncio
-from typing import Iterable, Optional, Tuple
+import getpass
+from collections import deque
+from typing import Iterable, Optional
 import logging
 
 from client import AsyncChatClient
+from common import unpack_envelope, FRAMING_V2, FRAME_ENVELOPE
+from e2e_keystore import E2EKeyStore
 from e2e_mobp import E2EModpManager
 
-def _split_sender(line: str) -> Tuple[Optional[str], str]:
-    # формат с сервера: "username > message"
-    sep = " > "
-    i = line.find(sep)
-    if i == -1:
-        return None, line
-    return line[:i].strip(), line[i + len(sep):].strip()
-
 class E2EChatClient:
-    def __init__(self) -> None:
+    def __init__(self, keystore: Optional[E2EKeyStore] = None) -> None:
+        """keystore - загруженное хранилище ключей: тот же E2E ключ и парные ключи после перезапуска"""
         self.base = AsyncChatClient()
+        self.keystore = keystore
         self.username: Optional[str] = None
         self.e2e: Optional[E2EModpManager] = None
+        self._ready: deque = deque() # расшифрованные, но еще не отданные из recv сообщения
 
     async def connect(self, host: str, port: int, username: str, alg: str = "plain") -> None:
         await self.base.connect(host, port, username, alg=alg)
+        if self.base.framing != FRAMING_V2: # конверты E2E передаются только двоичными кадрами
+            await self.base.close()
+            raise RuntimeError("E2E requires v2 framing")
         self.username = username
-        self.e2e = E2EModpManager(self.base, username)
+        self.e2e = E2EModpManager(self.base, username, self.keystore)
         await self.e2e.announce()
 
     async def send_plain(self, text: str) -> None:
@@ -34,10 +36,17 @@ class E2EChatClient:
             raise RuntimeError("E2E not initialized")
         await self.e2e.send_private(text, recipients=[to_user])
 
-    async def send_private_group(self, recipients: Iterable[str], text: str) -> None:
+    async def send_private_group(self, recipients: Iterable[str], text: str, group: Optional[str] = None) -> None:
+        """Групповое сообщение шифруется один раз ключом группы (sender key)"""
         if not self.e2e:
             raise RuntimeError("E2E not initialized")
-        await self.e2e.send_private(text, recipients=recipients)
+        await self.e2e.send_group(text, recipients=recipients, group=group)
+
+    async def fetch_keys(self, names: Optional[Iterable[str]] = None) -> None:
+        """Запрос ключей из каталога сервера (None - всех) с подпиской на их изменения"""
+        if not self.e2e:
+            raise RuntimeError("E2E not initialized")
+        await self.e2e.fetch(names)
 
     async def reannounce(self) -> None:
         if not self.e2e:
@@ -45,33 +54,34 @@ class E2EChatClient:
         await self.e2e.announce()
 
     async def recv(self, timeout: float | None = None) -> str:
-        # Пропускаем служебные E2E сообщения и возвращаем только отображаемые
-        while True:
-            line = await (self.base.recv() if timeout is None else asyncio.wait_for(self.base.recv(), timeout=timeout))
-            sender, payload = _split_sender(line)
-            if sender is None or not self.e2e:
-                return line
-            handled, plaintext = await self.e2e.handle_incoming(sender, payload)
-            if not handled:
-                return line
-            if plaintext is not None:
-                return f"{sender} [E2E] > {plaintext}"
-            # handled == True и plaintext == None -> это служебное E2E сообщение; читаем дальше
+        # Пропускаем служебные E2E конверты и возвращаем только отображаемые сообщения
+        while not self._ready:
+            ftype, data = await self.base.recv_frame(timeout)
+            if ftype != FRAME_ENVELOPE:
+                return data.decode("utf-8")
+            if self.e2e:
+                self._ready.extend(await self.e2e.handle_envelope(*unpack_envelope(data)))
+        sender, plaintext = self._ready.popleft()
+        return f"{sender} [E2E] > {plaintext}"
 
     async def close(self) -> None:
+        if self.e2e:
+            self.e2e.save()
         await self.base.close()
         self.e2e = None
         self.username = None
 
 
-async def run_e2e_cli(host: str = "127.0.0.1", port: int = 1234, username: str = "user", alg: str = "plain") -> None:
-    c = E2EChatClient()
+async def run_e2e_cli(host: str = "127.0.0.1", port: int = 1234, username: str = "user", alg: str = "plain",
+                      keystore: Optional[E2EKeyStore] = None) -> None:
+    c = E2EChatClient(keystore)
     await c.connect(host, port, username, alg=alg)
+    await c.fetch_keys() # для /all и /users нужны ключи всех пользователей
 
     async def reader_task():
         try:
             while True:
-                print(await c.recv(), flush=True)
+                print('\n' + await c.recv(), flush=True)
         except Exception:
             pass
 
@@ -105,7 +115,7 @@ async def run_e2e_cli(host: str = "127.0.0.1", port: int = 1234, username: str =
                     try:
                         _, msg = line.split(" ", 1)
                         recips = c.e2e.get_users()
-                        await c.send_private_group(recips, msg)
+                        await c.send_private_group(recips, msg, group="all")
                     except ValueError:
                         print("Usage: /all <message>")
                     continue
@@ -129,4 +139,10 @@ async def run_e2e_cli(host: str = "127.0.0.1", port: int = 1234, username: str =
     await c.close()
 
 if __name__ == "__main__":
-    asyncio.run(run_e2e_cli(username=input("Username: ")))
\ No newline at end of file
+    username = input("Username: ")
+    keystore = None
+    path = input("Keystore file (empty - no keystore): ").strip()
+    if path:
+        keystore = E2EKeyStore(path, getpass.getpass("Keystore passphrase: ").encode("utf-8"))
+        keystore.load()
+    asyncio.run(run_e2e_cli(username=username, keystore=keystore))
\ No newline at end of file
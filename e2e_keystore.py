@@ -0,0 +1,120 @@
+# chat/e2e_keystore.py
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+KEYSTORE_MAX_PEERS = 1024 # сколько парных ключей хранится в файле
+KEYSTORE_MAGIC = b"E2EKS1"
+SALT_LEN = 16
+NONCE_LEN = 12
+
+
+class LRUDict(OrderedDict):
+    """Словарь с ограниченным размером: при переполнении выбрасывается запись,
+    к которой дольше всего не обращались"""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key: Any) -> Any:
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def fingerprint(peer: str, peer_pub: bytes) -> str:
+    """Отпечаток собеседника: имя входит в HKDF info, поэтому и в отпечаток"""
+    return hashlib.sha256(peer.encode("utf-8") + b"|" + peer_pub).hexdigest()
+
+
+class E2EKeyStore:
+    """Файл с постоянным E2E ключом клиента и кешем парных ключей, зашифрованный паролем.
+
+    Хранит свой секрет a и публичный ключ A (после перезапуска не нужно заново считать pow)
+    и парные ключи отправки/приема по отпечатку собеседника (имя + его публичный ключ),
+    поэтому после перезапуска не нужно заново считать общий секрет и HKDF.
+    Ключ файла получается из пароля через scrypt, содержимое шифруется AES-GCM.
+    Формат файла: KEYSTORE_MAGIC + salt + nonce + шифротекст JSON.
+    """
+
+    def __init__(self, path: str, passphrase: bytes, max_peers: int = KEYSTORE_MAX_PEERS) -> None:
+        self.path = path
+        self._passphrase = passphrase
+        self._salt = os.urandom(SALT_LEN)
+        self._file_key: bytes | None = None
+        self.owner: Optional[str] = None
+        self.identity: Optional[Tuple[int, bytes]] = None # (секрет a, публичный ключ A)
+        self.peers: LRUDict = LRUDict(max_peers) # отпечаток -> (ключ отправки, ключ приема)
+        self.dirty = False
+
+    def _key(self) -> AESGCM:
+        if self._file_key is None: # scrypt медленный намеренно, считаем один раз
+            self._file_key = Scrypt(salt=self._salt, length=32, n=2 ** 14, r=8, p=1).derive(self._passphrase)
+        return AESGCM(self._file_key)
+
+    def load(self) -> bool:
+        """Читаем файл, если он есть. ValueError - неверный пароль или файл поврежден"""
+        try:
+            with open(self.path, "rb") as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return False
+        if not blob.startswith(KEYSTORE_MAGIC):
+            raise ValueError("Not a keystore file")
+        i = len(KEYSTORE_MAGIC)
+        self._salt, nonce = blob[i:i + SALT_LEN], blob[i + SALT_LEN:i + SALT_LEN + NONCE_LEN]
+        self._file_key = None
+        try:
+            data = json.loads(self._key().decrypt(nonce, blob[i + SALT_LEN + NONCE_LEN:], KEYSTORE_MAGIC))
+        except InvalidTag:
+            raise ValueError("Wrong keystore passphrase or corrupted file") from None
+        self.owner = data["owner"]
+        self.identity = (int(data["a"], 16), bytes.fromhex(data["A"]))
+        self.peers.clear()
+        for fp, k_send, k_recv in data["peers"]: # в файле в порядке LRU
+            self.peers[fp] = (bytes.fromhex(k_send), bytes.fromhex(k_recv))
+        self.dirty = False
+        return True
+
+    def reset(self, owner: str, a: int, A: bytes) -> None:
+        """Новый ключ клиента, старые парные ключи с ним больше не годятся"""
+        self.owner = owner
+        self.identity = (a, A)
+        self.peers.clear()
+        self.dirty = True
+
+    def put(self, fp: str, k_send: bytes, k_recv: bytes) -> None:
+        self.peers[fp] = (k_send, k_recv)
+        self.dirty = True
+
+    def save(self) -> None:
+        """Запись через временный файл, чтобы не потерять хранилище при сбое посередине"""
+        if self.identity is None:
+            return
+        a, A = self.identity
+        data = {"owner": self.owner, "a": format(a, "x"), "A": A.hex(),
+                "peers": [[fp, ks.hex(), kr.hex()] for fp, (ks, kr) in self.peers.items()]}
+        nonce = os.urandom(NONCE_LEN)
+        ct = self._key().encrypt(nonce, json.dumps(data).encode(), KEYSTORE_MAGIC)
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(KEYSTORE_MAGIC + self._salt + nonce + ct)
+        os.replace(tmp, self.path)
+        self.dirty = False
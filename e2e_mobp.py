@@ -1,5 +1,7 @@
 import os
-import base64
+import asyncio
+import struct
+import hashlib
 import secrets
 from typing import Dict, Tuple, Optional, Iterable
 
@@ -7,11 +9,24 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from client import AsyncChatClient
+from e2e_keystore import E2EKeyStore, LRUDict, fingerprint
+from common import pack_envelope, unpack_key_list, KEY_PUBLISH, KEY_FETCH, KEY_LIST
 
-HELLO = "__E2E1_HELLO__:"
-REPLY = "__E2E1_REPLY__:"
-MSG = "__E2E1_MSG__:"  # "__E2E1_MSG__:recipient:b64(nonce+ciphertext)"
+# Виды двоичных конвертов E2E (common.pack_envelope). Ключи и шифротексты передаются
+# как есть, без base64, получателя указывает конверт, отправителя подставляет сервер.
+# Публичные ключи хранит каталог на сервере (KEY_PUBLISH/KEY_FETCH/KEY_LIST в common.py).
+MSG = 1    # данные: nonce + шифротекст парным ключом
+# Групповые сообщения (sender key): каждый участник один раз рассылает свой ключ группы
+# по парным каналам, после чего сообщение шифруется один раз и отправляется одним кадром
+SKEY = 2   # данные: nonce + шифротекст парным ключом (группа + номер ключа + ключ группы)
+GMSG = 3   # данные: группа + номер ключа + nonce + шифротекст ключом группы
+KEY_FETCH_TIMEOUT = 2.0 # сколько ждем ответа каталога на запрос ключей (потом запрашиваем снова)
+MAX_DEFERRED = 64 # сколько конвертов храним от одного отправителя, пока ждем его ключ
+MAX_PEERS = 1024 # сколько собеседников (публичных и парных ключей) держим в памяти
+MAX_GROUP_KEYS = 4096 # сколько ключей групп держим в памяти
 NONCE_LEN = 12
+GROUP_ID_LEN = 8
+_GROUP_HEADER = struct.Struct(f">{GROUP_ID_LEN}sI") # группа + номер ключа
 P_HEX = (
     "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1"
     "29024E088A67CC74020BBEA63B139B22514A08798E3404DD"
@@ -24,12 +39,6 @@ P = int(P_HEX, 16)
 G = 2
 BLEN = (P.bit_length() + 7) // 8
 
-def _b64e(b: bytes) -> str:
-    return base64.urlsafe_b64encode(b).decode("ascii")
-
-def _b64d(s: str) -> bytes:
-    return base64.urlsafe_b64decode(s.encode("ascii"))
-
 def _hkdf(shared_bytes: bytes, info: bytes, length: int = 32) -> bytes:
     return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=info).derive(shared_bytes)
 
@@ -37,110 +46,262 @@ def _i2b(x: int) -> bytes:
     return x.to_bytes(BLEN, "big")
 
 class E2EModpManager:
-    def __init__(self, client: AsyncChatClient, username: str):
+    def __init__(self, client: AsyncChatClient, username: str, keystore: Optional[E2EKeyStore] = None):
+        """keystore - файл с постоянным ключом клиента и кешем парных ключей (уже загруженный).
+        Без него ключ новый при каждом запуске"""
         self.client = client
         self.username = username
+        self.keystore = keystore
+
+        if keystore is not None and keystore.owner == username and keystore.identity is not None:
+            self._a, self._Ab = keystore.identity
+            self._A = int.from_bytes(self._Ab, "big")
+        else:
+            self._a = secrets.randbelow(P - 2) + 2
+            self._A = pow(G, self._a, P)
+            self._Ab = _i2b(self._A)
+            if keystore is not None:
+                keystore.reset(username, self._a, self._Ab)
+
+        # Запоминаем публичные ключи других пользователей (давно не нужные вытесняются,
+        # при необходимости ключ снова запрашивается у каталога)
+        self._peer_pub: LRUDict = LRUDict(MAX_PEERS)
+
+        # Запоминаем секретные ключи для шифрования с определенными пользователями: (отправка, прием)
+        self._aead: LRUDict = LRUDict(MAX_PEERS)
+
+        # Свои ключи групп: группа -> (номер ключа, ключ, участники, которым ключ разослан)
+        self._group_send: LRUDict = LRUDict(MAX_GROUP_KEYS)
+        # Ключи групп других участников: (отправитель, группа, номер ключа) -> ключ
+        self._group_recv: LRUDict = LRUDict(MAX_GROUP_KEYS)
+
+        # Запрошенные у каталога ключи: имя -> ответ получен
+        self._key_waiters: Dict[str, asyncio.Future] = {}
+        # Конверты от отправителей, чей ключ запрошен у каталога: имя -> [(вид, получатель, данные)]
+        self._deferred: Dict[str, list] = {}
+        # Когда запросили ключ отложенного отправителя: запрос или ответ мог потеряться
+        self._deferred_fetch: Dict[str, float] = {}
 
-        self._a = secrets.randbelow(P - 2) + 2
-        self._A = pow(G, self._a, P)
-        self._Ab = _i2b(self._A)
+    def _forget_keys(self, peer: str) -> None:
+        """Забываем парные ключи с собеседником и ключи групп, в которых он состоит"""
+        self._aead.pop(peer, None)
+        for gid, (_, _, members) in list(self._group_send.items()):
+            if peer in members:
+                del self._group_send[gid]
 
-        # Запоминаем публичные ключи других пользователей
-        self._peer_pub: Dict[str, int] = {}
-        self._peer_pub_bytes: Dict[str, bytes] = {}
+    def _set_peer(self, peer: str, pb: bytes) -> None:
+        """Запоминаем публичный ключ собеседника. Если ключ сменился (собеседник перезапустился),
+        старые ключи с ним больше не годятся"""
+        if self._peer_pub.get(peer, pb) != pb:
+            self._forget_keys(peer)
+        self._peer_pub[peer] = pb
 
-        # Запоминаем секретные ключи для шифрования с определенными пользователями
-        self._aead_send: Dict[str, AESGCM] = {}
-        self._aead_recv: Dict[str, AESGCM] = {}
+    def _drop_peer(self, peer: str) -> None:
+        """Собеседник отключился, его ключа больше нет в каталоге"""
+        self._forget_keys(peer)
+        self._peer_pub.pop(peer, None)
 
     def get_users(self) -> Iterable[str]:
         return self._peer_pub.keys()
 
+    async def _send(self, kind: int, recipient: str, body: bytes) -> None:
+        await self.client.send_envelope(pack_envelope(kind, "", recipient, body))
+
     async def announce(self) -> None:
-        """Через broadcast сервер передем свой публичный ключ"""
-        await self.client.send(f"{HELLO}{_b64e(self._Ab)}")
+        """Публикуем свой публичный ключ в каталоге на сервере. Другим клиентам он не рассылается,
+        его получат только те, кто запросит (или уже подписан на все ключи)"""
+        await self._send(KEY_PUBLISH, "", self._Ab)
+
+    async def fetch(self, names: Optional[Iterable[str]] = None) -> None:
+        """Запрашиваем ключи names (None - все ключи каталога) и подписываемся на их изменения.
+        Ответ придет конвертом KEY_LIST, его разберет handle_envelope"""
+        await self._send(KEY_FETCH, "" if names is None else ",".join(names), b"")
 
-    async def _reply(self) -> None:
-        """Через broadcast сервер передем свой публичный ключ"""
-        await self.client.send(f"{REPLY}{_b64e(self._Ab)}")
+    async def _ensure_peers(self, names: Iterable[str]) -> None:
+        """Запрашиваем у каталога ключи тех собеседников, которых еще не знаем, и ждем ответа.
+        Ответ читает тот, кто вызывает recv (handle_envelope), поэтому чтение должно идти параллельно"""
+        missing = [n for n in names if n not in self._peer_pub and n != self.username]
+        if not missing:
+            return
+        loop = asyncio.get_running_loop()
+        waiters = [self._key_waiters.setdefault(n, loop.create_future()) for n in missing]
+        await self.fetch(missing)
+        await asyncio.wait(waiters, timeout=KEY_FETCH_TIMEOUT)
+        for n in missing:
+            self._key_waiters.pop(n, None)
 
-    def _derive_aead_pair(self, peer: str) -> Tuple[AESGCM, AESGCM]:
+    def _derive_aead_pair(self, peer: str) -> Tuple[bytes, bytes]:
         """Вычисляем секретные ключи для шифрования с определенными пользователями"""
-        B = self._peer_pub[peer]
+        pk_self, pk_peer = (self._Ab, self._peer_pub[peer])
+        B = int.from_bytes(pk_peer, "big")
         if not (1 < B < P - 1):
             raise ValueError("Invalid peer public")
         s = pow(B, self._a, P)
         sb = _i2b(s)
-        pk_self, pk_peer = (self._Ab, self._peer_pub_bytes[peer])
 
         info_send = b"E2E1-MODP14|" + self.username.encode() + b"->" + peer.encode() + b"|" + pk_self + pk_peer
         info_recv = b"E2E1-MODP14|" + peer.encode() + b"->" + self.username.encode() + b"|" + pk_peer + pk_self
 
         k_send = _hkdf(sb, info_send)
         k_recv = _hkdf(sb, info_recv)
-        return AESGCM(k_send), AESGCM(k_recv)
+        return k_send, k_recv
+
+    def _ensure_keys(self, peer: str) -> Tuple[AESGCM, AESGCM]:
+        """Парные ключи (отправка, прием): из памяти, из хранилища или вычисляем заново"""
+        pair = self._aead.get(peer)
+        if pair is None:
+            cached = None
+            if self.keystore is not None:
+                fp = fingerprint(peer, self._peer_pub[peer])
+                cached = self.keystore.peers.get(fp)
+            if cached is None:
+                cached = self._derive_aead_pair(peer)
+                if self.keystore is not None:
+                    self.keystore.put(fp, *cached)
+            pair = self._aead[peer] = (AESGCM(cached[0]), AESGCM(cached[1]))
+        return pair
 
-    def _ensure_keys(self, peer: str) -> None:
-        if peer not in self._aead_send or peer not in self._aead_recv:
-            a_s, a_r = self._derive_aead_pair(peer)
-            self._aead_send[peer] = a_s
-            self._aead_recv[peer] = a_r
+    def save(self) -> None:
+        """Сохраняем хранилище ключей, если в нем что-то изменилось"""
+        if self.keystore is not None and self.keystore.dirty:
+            self.keystore.save()
 
     async def send_private(self, message: str, recipients: Optional[Iterable[str]] = None) -> None:
         if recipients is None:
             recipients = [u for u in self._peer_pub.keys() if u != self.username]
+        else:
+            recipients = list(recipients)
+            await self._ensure_peers(recipients)
         data = message.encode("utf-8")
         for r in recipients:
             if r not in self._peer_pub: #пользователь мог пропасть
                 continue
-            self._ensure_keys(r) #генерируем секретные ключи
-            nonce = os.urandom(NONCE_LEN)
-            aad = (self.username + "->" + r).encode()
-            ct = self._aead_send[r].encrypt(nonce, data, aad) #укзаываем, кому отправляем
-            await self.client.send(f"{MSG}{r}:{_b64e(nonce + ct)}")
-
-    async def handle_incoming(self, sender: str, text: str):
-        """Функция вызывается при получении любого сообщения на сервере"""
-        if text.startswith(HELLO): #Если это инициирование общения
-            try:
-                pb = _b64d(text[len(HELLO):]) #Получаем публичный ключ
-                if len(pb) == BLEN:
-                    B = int.from_bytes(pb, "big")
-                    if 1 < B < P - 1:
-                        self._peer_pub[sender] = B #Сохраняем публичный ключ TODO: зачем? 
-                        self._peer_pub_bytes[sender] = pb #Сохраняем публичный ключ в байтах
-                        await self._reply() # сразу запускам процесс ответа
-            except Exception:
-                pass
-            return True, None
-
-        if text.startswith(REPLY): #Если пришел чей-то ответ
-            try:
-                pb = _b64d(text[len(REPLY):])
-                if len(pb) == BLEN:
-                    B = int.from_bytes(pb, "big")
-                    if 1 < B < P - 1:
-                        self._peer_pub[sender] = B
-                        self._peer_pub_bytes[sender] = pb
-            except Exception:
-                pass
-            return True, None
-
-        if text.startswith(MSG): #Если пришло приватное сообщение, то зная публичный ключ отправителя и свой секретный ключ, можно расшифровать сообщение
-            try:
-                rest = text[len(MSG):]
-                to_user, b64 = rest.split(":", 1)
-                if to_user != self.username:
-                    return True, None
-                if sender not in self._peer_pub:
-                    return True, None
-                self._ensure_keys(sender) #Создаем секретные ключи с пользователем (на чтение и на запись сообщений)
-                blob = _b64d(b64)
-                nonce, ct = blob[:NONCE_LEN], blob[NONCE_LEN:]
-                aad = (sender + "->" + self.username).encode() #В тег AES было добавлено при отправке, поэтому тут проверяем
-                pt = self._aead_recv[sender].decrypt(nonce, ct, aad)
-                return True, pt.decode("utf-8")
-            except Exception:
-                return True, None
-
-        return False, None
\ No newline at end of file
+            await self._send(MSG, r, self._pairwise_encrypt(r, data)) #сервер доставит сообщение только получателю
+
+    def _pairwise_encrypt(self, peer: str, data: bytes, label: str = "") -> bytes:
+        """Шифрование для одного собеседника парным ключом: nonce + шифротекст"""
+        aead_send, _ = self._ensure_keys(peer) #генерируем секретные ключи
+        nonce = os.urandom(NONCE_LEN)
+        aad = (self.username + "->" + peer + label).encode()
+        return nonce + aead_send.encrypt(nonce, data, aad) #укзаываем, кому отправляем
+
+    def _pairwise_decrypt(self, peer: str, blob: memoryview, label: str = "") -> bytes:
+        _, aead_recv = self._ensure_keys(peer)
+        aad = (peer + "->" + self.username + label).encode()
+        return aead_recv.decrypt(blob[:NONCE_LEN], blob[NONCE_LEN:], aad)
+
+    @staticmethod
+    def group_id(members: Iterable[str]) -> bytes:
+        """Идентификатор группы по составу участников (включая отправителя)"""
+        return hashlib.sha256(",".join(sorted(set(members))).encode()).digest()[:GROUP_ID_LEN]
+
+    async def send_group(self, message: str, recipients: Optional[Iterable[str]] = None,
+                         group: Optional[str] = None) -> None:
+        """Групповое сообщение через sender key.
+
+        Сообщение шифруется один раз своим ключом группы и отправляется одним кадром всем участникам.
+        Ключ группы рассылается участникам по парным каналам при первой отправке и заново
+        (с новым номером) при изменении состава группы.
+        """
+        if recipients is None:
+            recipients = self._peer_pub.keys()
+        else:
+            recipients = list(recipients)
+            await self._ensure_peers(recipients)
+        members = frozenset(r for r in recipients if r in self._peer_pub and r != self.username)
+        if not members:
+            return
+        if group is None:
+            gid = self.group_id(members | {self.username})
+        else:
+            gid = hashlib.sha256(b"group:" + group.encode()).digest()[:GROUP_ID_LEN]
+
+        state = self._group_send.get(gid)
+        if state is None or state[2] != members: # новая группа или изменился состав - новый ключ
+            key_id = state[0] + 1 if state else 1
+            key = AESGCM.generate_key(bit_length=256)
+            state = (key_id, AESGCM(key), members)
+            self._group_send[gid] = state
+            payload = _GROUP_HEADER.pack(gid, key_id) + key
+            for r in members:
+                await self._send(SKEY, r, self._pairwise_encrypt(r, payload, "|SKEY"))
+
+        key_id, aead, _ = state
+        header = _GROUP_HEADER.pack(gid, key_id)
+        nonce = os.urandom(NONCE_LEN)
+        ct = aead.encrypt(nonce, message.encode("utf-8"), self.username.encode() + b"|" + header)
+        await self._send(GMSG, ",".join(members), header + nonce + ct)
+
+    def _accept_public(self, sender: str, body: bytes) -> bool:
+        if len(body) != BLEN:
+            return False
+        B = int.from_bytes(body, "big")
+        if not (1 < B < P - 1):
+            return False
+        self._set_peer(sender, bytes(body)) #Сохраняем публичный ключ
+        return True
+
+    def _update_keys(self, body: memoryview) -> list[Tuple[str, str]]:
+        """Ключи из каталога: ответ на запрос или изменение ключа, на который подписаны.
+        Сообщения, которые ждали ключа отправителя, расшифровываем сразу"""
+        opened = []
+        for name, key in unpack_key_list(body):
+            if name == self.username:
+                continue
+            deferred = self._deferred.pop(name, ())
+            self._deferred_fetch.pop(name, None)
+            if key and self._accept_public(name, key): #Сохраняем публичный ключ
+                for kind, recipient, data in deferred:
+                    opened += self._open(kind, name, recipient, memoryview(data))
+            else:
+                self._drop_peer(name)
+            waiter = self._key_waiters.pop(name, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+        return opened
+
+    def _open(self, kind: int, sender: str, recipient: str, body: memoryview) -> list[Tuple[str, str]]:
+        """Расшифровка конверта от собеседника, чей ключ уже известен"""
+        try:
+            if kind == MSG: #Если пришло приватное сообщение, то зная публичный ключ отправителя и свой секретный ключ, можно расшифровать сообщение
+                if recipient == self.username:
+                    return [(sender, self._pairwise_decrypt(sender, body).decode("utf-8"))] #В тег AES было добавлено, кому сообщение, поэтому тут проверяем
+
+            elif kind == SKEY: #Ключ группы от участника, зашифрованный парным ключом
+                if recipient == self.username:
+                    payload = self._pairwise_decrypt(sender, body, "|SKEY")
+                    gid, key_id = _GROUP_HEADER.unpack_from(payload)
+                    self._group_recv[(sender, gid, key_id)] = AESGCM(payload[_GROUP_HEADER.size:])
+
+            elif kind == GMSG: #Групповое сообщение, расшифровываем ключом группы отправителя
+                gid, key_id = _GROUP_HEADER.unpack_from(body)
+                aead = self._group_recv.get((sender, gid, key_id))
+                if aead is not None:
+                    blob = body[_GROUP_HEADER.size:]
+                    aad = sender.encode() + b"|" + bytes(body[:_GROUP_HEADER.size])
+                    return [(sender, aead.decrypt(blob[:NONCE_LEN], blob[NONCE_LEN:], aad).decode("utf-8"))]
+        except Exception:
+            pass
+        return []
+
+    async def handle_envelope(self, kind: int, sender: str, recipient: str,
+                              body: memoryview) -> list[Tuple[str, str]]:
+        """Функция вызывается при получении конверта E2E. Возвращает расшифрованные сообщения
+        (отправитель, текст): пустой список для служебных и чужих конвертов, несколько сообщений -
+        если пришел ключ отправителя, чьи сообщения ждали этого ключа"""
+        if kind == KEY_LIST:
+            return [] if sender else self._update_keys(body) # KEY_LIST с отправителем - подделка другого клиента
+        if kind not in (MSG, SKEY, GMSG) or not sender:
+            return []
+        if sender in self._deferred or sender not in self._peer_pub:
+            # Ключа отправителя еще нет: откладываем конверт и запрашиваем ключ у каталога
+            deferred = self._deferred.setdefault(sender, [])
+            if len(deferred) < MAX_DEFERRED:
+                deferred.append((kind, recipient, bytes(body)))
+            now = asyncio.get_running_loop().time()
+            fetched = self._deferred_fetch.get(sender)
+            if fetched is None or now - fetched >= KEY_FETCH_TIMEOUT:
+                self._deferred_fetch[sender] = now # ответа нет дольше KEY_FETCH_TIMEOUT - запрашиваем снова
+                await self.fetch([sender])
+            return []
+        return self._open(kind, sender, recipient, body)
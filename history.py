@@ -0,0 +1,65 @@
+# chat/history.py
+import time
+from collections import OrderedDict, deque
+from typing import Deque
+
+HISTORY_SIZE = 256 # сколько последних сообщений хранится в каждой комнате
+HISTORY_ROOMS = 1024 # для скольких комнат хранится история (дольше всех молчавшие выбрасываются)
+
+
+class RoomHistory:
+    """Кольцевые буферы последних сообщений комнат с номерами, для досылки после переподключения.
+
+    Номер общий на все комнаты сервера и только растет, поэтому выброс комнаты из истории
+    не сбрасывает ее нумерацию. Начальный номер - время в микросекундах: после перезапуска
+    сервера номера продолжают расти, и клиент не примет новые сообщения за старые.
+
+    У воркеров multiworker.py нумерация своя (сообщения с шины каждый воркер нумерует сам),
+    поэтому номер несет воркер: номера воркера worker дают остаток worker при делении на workers.
+    По owns сервер узнает номер, выданный другим воркером, и не досылает по нему.
+    """
+
+    def __init__(self, size: int = HISTORY_SIZE, max_rooms: int = HISTORY_ROOMS,
+                 worker: int = 0, workers: int = 1) -> None:
+        self.size = size
+        self.max_rooms = max_rooms
+        self.worker = worker
+        self.workers = workers
+        self.seq = time.time_ns() // 1000 * workers + worker
+        self._rooms: OrderedDict[str, Deque[tuple[int, str, bytes]]] = OrderedDict() # (номер, отправитель, текст)
+
+    def advance(self, seq: int) -> None:
+        """Следующие номера будут больше seq (продолжение журнала после перезапуска)"""
+        if seq > self.seq:
+            self.seq += (seq - self.seq + self.workers - 1) // self.workers * self.workers
+
+    def owns(self, seq: int) -> bool:
+        return seq % self.workers == self.worker
+
+    def append(self, room: str, sender: str, plaintext: bytes) -> int:
+        self.seq += self.workers
+        ring = self._rooms.get(room)
+        if ring is None:
+            ring = self._rooms[room] = deque(maxlen=self.size)
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        else:
+            self._rooms.move_to_end(room)
+        ring.append((self.seq, sender, plaintext))
+        return self.seq
+
+    def last_seq(self, room: str) -> int:
+        ring = self._rooms.get(room)
+        return ring[-1][0] if ring else 0
+
+    def since(self, room: str, after: int, upto: int | None = None) -> list[tuple[int, str, bytes]]:
+        """Сообщения комнаты с номерами после after (и не больше upto), по порядку.
+        Если after старше буфера, досылается только то, что в нем осталось"""
+        out = []
+        for entry in reversed(self._rooms.get(room, ())):
+            if entry[0] <= after:
+                break
+            if upto is None or entry[0] <= upto:
+                out.append(entry)
+        out.reverse()
+        return out
@@ -0,0 +1,53 @@
+# chat/keydir.py
+from typing import Dict, Iterable
+from outbound import ClientSession
+
+
+class KeyDirectory:
+    """Каталог публичных ключей E2E на сервере: имя -> ключ и подписки на изменения.
+
+    Клиент публикует свой ключ один раз (KEY_PUBLISH), а ключи собеседников запрашивает
+    сам и только нужные (KEY_FETCH). Вместе с запросом клиент подписывается на изменения
+    этих ключей, поэтому подключение нового клиента не вызывает рассылки ключей всем.
+    Сервер ключи не проверяет, это делают клиенты.
+    """
+
+    def __init__(self) -> None:
+        self.keys: Dict[str, bytes] = {}
+        self._subs: Dict[str, set[ClientSession]] = {} # имя -> подписчики на его ключ
+        self._subs_all: set[ClientSession] = set() # подписчики на все ключи
+        self._watching: Dict[ClientSession, set[str]] = {} # подписчик -> имена, на которые подписан
+
+    def set(self, name: str, key: bytes) -> set[ClientSession] | None:
+        """Сохраняем (пустой key - удаляем) ключ. Возвращаем подписчиков, которым нужно сообщить,
+        или None, если ничего не изменилось"""
+        if key:
+            if self.keys.get(name) == key:
+                return None
+            self.keys[name] = key
+        elif self.keys.pop(name, None) is None:
+            return None
+        return self._subs.get(name, set()) | self._subs_all
+
+    def subscribe(self, session: ClientSession, names: Iterable[str] | None) -> list[tuple[str, bytes]]:
+        """Подписка на ключи names (None - на все, в том числе будущие). Возвращаем текущие ключи,
+        для неизвестных имен - пустой ключ, чтобы клиент не ждал ответа"""
+        if names is None:
+            self._subs_all.add(session)
+            return list(self.keys.items())
+        watching = self._watching.setdefault(session, set())
+        entries = []
+        for name in names:
+            self._subs.setdefault(name, set()).add(session)
+            watching.add(name)
+            entries.append((name, self.keys.get(name, b"")))
+        return entries
+
+    def unsubscribe(self, session: ClientSession) -> None:
+        self._subs_all.discard(session)
+        for name in self._watching.pop(session, ()):
+            subs = self._subs.get(name)
+            if subs is not None:
+                subs.discard(session)
+                if not subs:
+                    del self._subs[name]
@@ -0,0 +1,177 @@
+# chat/metrics.py
+import asyncio
+import bisect
+import logging
+import os
+from typing import Callable, Dict
+
+METRICS_PORT = 9100 # порт текстовой страницы метрик в формате Prometheus
+SNAPSHOT_INTERVAL = 60.0 # как часто метрики пишутся в лог
+# Границы корзин гистограмм времени, секунды
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, n: int = 1) -> None:
+        self.value += n
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: observe - один bisect и три сложения"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # последняя корзина - больше всех границ
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам (верхняя граница корзины), для лога"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Family:
+    """Метрика с метками: labels(значения) возвращает счетчик или гистограмму для этих значений.
+    Без меток сама метрика одна, она же возвращается из Registry.counter/histogram"""
+
+    def __init__(self, name: str, doc: str, kind: str, labelnames: tuple, make: Callable[[], object]) -> None:
+        self.name = name
+        self.doc = doc
+        self.kind = kind
+        self.labelnames = labelnames
+        self.children: Dict[tuple, object] = {}
+        self._make = make
+
+    def labels(self, *values: str) -> object:
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._make()
+        return child
+
+
+class Registry:
+    """Набор метрик процесса. Обновление метрики - обычное сложение в потоке event loop,
+    без блокировок; текст для Prometheus собирается только при запросе"""
+
+    def __init__(self) -> None:
+        self._families: Dict[str, Family] = {}
+        self._gauges: Dict[str, tuple[str, Callable[[], float]]] = {}
+
+    def counter(self, name: str, doc: str, labels: tuple = ()) -> Family | Counter:
+        return self._register(Family(name, doc, "counter", labels, Counter))
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = TIME_BUCKETS) -> Family | Histogram:
+        return self._register(Family(name, doc, "histogram", labels, lambda: Histogram(buckets)))
+
+    def gauge(self, name: str, doc: str, fn: Callable[[], float]) -> None:
+        """Значение считается при запросе. Повторная регистрация заменяет функцию (новый ChatServer)"""
+        self._gauges[name] = (doc, fn)
+
+    def _register(self, family: Family) -> Family | Counter | Histogram:
+        self._families[family.name] = family
+        return family if family.labelnames else family.labels()
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus 0.0.4"""
+        lines = []
+        for f in self._families.values():
+            lines += (f"# HELP {f.name} {f.doc}", f"# TYPE {f.name} {f.kind}")
+            for values, child in f.children.items():
+                labels = ",".join(f'{k}="{v}"' for k, v in zip(f.labelnames, values))
+                if f.kind == "counter":
+                    lines.append(f"{f.name}{{{labels}}} {child.value}" if labels else f"{f.name} {child.value}")
+                    continue
+                sep = "," if labels else ""
+                cumulative = 0
+                for bound, n in zip(child.buckets + (float("inf"),), child.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{f.name}_bucket{{{labels}{sep}le="{le}"}} {cumulative}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines += (f"{f.name}_sum{suffix} {child.sum}", f"{f.name}_count{suffix} {child.count}")
+        for name, (doc, fn) in self._gauges.items():
+            lines += (f"# HELP {name} {doc}", f"# TYPE {name} gauge", f"{name} {fn()}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> str:
+        """Короткая строка для лога: счетчики, gauge и число/p50/p99 гистограмм"""
+        parts = []
+        for f in self._families.values():
+            for values, child in f.children.items():
+                name = f.name + (f"[{','.join(values)}]" if values else "")
+                if f.kind == "counter":
+                    parts.append(f"{name}={child.value}")
+                elif child.count:
+                    parts.append(f"{name}=n:{child.count},p50:{child.quantile(0.5)},p99:{child.quantile(0.99)}")
+        parts += (f"{name}={fn()}" for name, (_, fn) in self._gauges.items())
+        return " ".join(parts)
+
+
+REGISTRY = Registry()
+
+# Метрики горячего пути. Имена меток - алгоритм рукопожатия / имя кодека, их немного
+HANDSHAKE_SECONDS = REGISTRY.histogram("chat_handshake_seconds", "Server handshake duration", ("alg",))
+HANDSHAKE_FAILURES = REGISTRY.counter("chat_handshake_failures_total", "Failed handshakes")
+DECODE_SECONDS = REGISTRY.histogram("chat_decode_seconds", "Frame decode time", ("codec",))
+ENCODE_SECONDS = REGISTRY.histogram("chat_encode_seconds", "Frame encode time", ("codec",))
+MESSAGES_RECEIVED = REGISTRY.counter("chat_messages_received_total", "Frames received from clients")
+FANOUT_SECONDS = REGISTRY.histogram("chat_fanout_seconds", "Time to enqueue one message for all recipients")
+FANOUT_RECIPIENTS = REGISTRY.histogram("chat_fanout_recipients", "Recipients per message", buckets=SIZE_BUCKETS)
+COMPRESSION_SAVED = REGISTRY.counter("chat_compression_saved_bytes_total",
+                                     "Bytes saved by compressing messages sent to clients")
+DROPPED = REGISTRY.counter("chat_dropped_messages_total", "Messages dropped by drop_oldest policy")
+DISCONNECTS = REGISTRY.counter("chat_disconnects_total", "Client disconnects by reason", ("reason",))
+REJECTED = REGISTRY.counter("chat_rejected_total", "Connections and messages rejected by admission control",
+                            ("reason",))
+
+
+async def _serve_http(registry: Registry, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Минимальный HTTP: на любой GET отдаем метрики и закрываем соединение"""
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5.0)
+        if request.startswith(b"GET "):
+            body = registry.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        else:
+            writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(host: str = "127.0.0.1", port: int = METRICS_PORT, path: str | None = None,
+                               registry: Registry = REGISTRY) -> asyncio.AbstractServer:
+    """Страница метрик на отдельном порту (или Unix сокете path), чтобы ее не было видно клиентам чата"""
+    def handler(r, w):
+        return _serve_http(registry, r, w)
+    if path is not None:
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(handler, path)
+    return await asyncio.start_server(handler, host, port)
+
+async def log_snapshots(interval: float = SNAPSHOT_INTERVAL, registry: Registry = REGISTRY) -> None:
+    """Периодически пишем метрики в лог. Запускается отдельной задачей"""
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("Метрики: %s", registry.snapshot())
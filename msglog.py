@@ -0,0 +1,299 @@
+# chat/msglog.py
+import os
+import mmap
+import struct
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SEGMENT_BYTES = 64 * 1024 * 1024 # после этого размера начинается новый сегмент
+COMMIT_DELAY = 0.005 # сколько копим записи перед общей записью на диск
+HISTORY_PAGE = 50 # сколько сообщений отдает один запрос истории
+MAX_SCAN = 10000 # сколько записей комнаты может пройти один запрос истории
+# Запись: номер, длина комнаты, длина отправителя, длина текста, смещение предыдущей записи
+# той же комнаты в этом сегменте + 1 (0 - это первая), затем комната, отправитель, текст
+RECORD_HEADER = struct.Struct(">QBBIQ")
+INDEX_ENTRY = struct.Struct(">QQ") # номер записи, смещение записи в файле сегмента
+ROOM_ENTRY = struct.Struct(">BQ") # файл последних записей комнат: длина комнаты, смещение, комната
+
+
+class _Segment:
+    """Сегмент журнала: <первый номер>.log с записями, <первый номер>.idx с индексом смещений
+    и, у закрытых сегментов, <первый номер>.rooms со смещением последней записи каждой комнаты.
+    От последней записи комнаты по ссылкам на предыдущие читаются только записи этой комнаты"""
+
+    def __init__(self, directory: str, first_seq: int) -> None:
+        self.first_seq = first_seq
+        base = os.path.join(directory, f"{first_seq:020d}")
+        self.log_path = base + ".log"
+        self.idx_path = base + ".idx"
+        self.rooms_path = base + ".rooms"
+        self.size = 0 # байт записей, на которые есть индекс
+        self.last_seq = 0
+        self.tails: dict[bytes, int] = {} # комната -> смещение ее последней записи
+        self._map: mmap.mmap | None = None # только у закрытых сегментов, они не меняются
+
+    def recover(self) -> None:
+        """Отрезаем хвост, не попавший в индекс (запись оборвалась посередине), и заново
+        собираем последние записи комнат"""
+        self.size = self.last_seq = 0
+        with open(self.idx_path, "r+b") as idx:
+            count = os.fstat(idx.fileno()).st_size // INDEX_ENTRY.size
+            idx.truncate(count * INDEX_ENTRY.size)
+            if count:
+                idx.seek((count - 1) * INDEX_ENTRY.size)
+                self.last_seq, offset = INDEX_ENTRY.unpack(idx.read(INDEX_ENTRY.size))
+        with open(self.log_path, "r+b") as log:
+            if count:
+                log.seek(offset)
+                _, rlen, slen, tlen, _ = RECORD_HEADER.unpack(log.read(RECORD_HEADER.size))
+                self.size = offset + RECORD_HEADER.size + rlen + slen + tlen
+            log.truncate(self.size)
+        self.tails = self._scan_tails()
+
+    def _scan_tails(self) -> dict[bytes, int]:
+        tails: dict[bytes, int] = {}
+        if not self.size:
+            return tails
+        with open(self.log_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            offset = 0
+            while offset < self.size:
+                _, rlen, slen, tlen, _ = RECORD_HEADER.unpack_from(log, offset)
+                start = offset + RECORD_HEADER.size
+                tails[log[start:start + rlen]] = offset
+                offset = start + rlen + slen + tlen
+        return tails
+
+    def load(self) -> None:
+        """Закрытый сегмент при открытии журнала: последние записи комнат из .rooms, без чтения записей"""
+        with open(self.idx_path, "rb") as idx:
+            if os.fstat(idx.fileno()).st_size < INDEX_ENTRY.size:
+                return
+            idx.seek(-INDEX_ENTRY.size, os.SEEK_END)
+            self.last_seq, _ = INDEX_ENTRY.unpack(idx.read(INDEX_ENTRY.size))
+        self.size = os.path.getsize(self.log_path)
+        if not os.path.exists(self.rooms_path): # сегмент не успели закрыть
+            self.tails = self._scan_tails()
+            self.seal()
+            return
+        with open(self.rooms_path, "rb") as f:
+            data = f.read()
+        i = 0
+        while i < len(data):
+            rlen, offset = ROOM_ENTRY.unpack_from(data, i)
+            i += ROOM_ENTRY.size
+            self.tails[data[i:i + rlen]] = offset
+            i += rlen
+
+    def seal(self) -> None:
+        """Сегмент больше не пишется: сохраняем последние записи комнат"""
+        tmp = self.rooms_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(ROOM_ENTRY.pack(len(r), offset) + r for r, offset in self.tails.items()))
+        os.replace(tmp, self.rooms_path)
+
+    def view(self, sealed: bool) -> mmap.mmap:
+        """mmap записей. Закрытый сегмент отображается один раз, открытый - на каждое чтение"""
+        if self._map is not None:
+            return self._map
+        with open(self.log_path, "rb") as log:
+            m = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        if sealed:
+            self._map = m
+        return m
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class MessageLog:
+    """Журнал сообщений комнат на диске, только дописывается.
+
+    Журнал разбит на сегменты по SEGMENT_BYTES, у каждого сегмента индекс номер -> смещение
+    с записями фиксированной длины (по нему журнал восстанавливается после обрыва записи).
+    Каждая запись ссылается на предыдущую запись своей комнаты, а сегмент помнит последнюю,
+    поэтому история тихой комнаты читается без просмотра чужих записей.
+    append только кладет запись в память; записи, накопленные за COMMIT_DELAY, пишутся на диск
+    одной записью (и одним fsync, если он включен) в отдельном потоке, event loop не ждет диск.
+    История читается через mmap: в память попадают только прочитанные страницы, а не сегменты целиком.
+    Номера задает вызывающий (RoomHistory), они должны только расти.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = SEGMENT_BYTES, commit_delay: float = COMMIT_DELAY,
+                 fsync: bool = False) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_delay = commit_delay
+        self.fsync = fsync
+        self.commits = 0 # сколько раз писали на диск
+        os.makedirs(directory, exist_ok=True)
+        self._segments: list[_Segment] = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".log") and os.path.exists(os.path.join(directory, name[:-4] + ".idx")):
+                self._segments.append(_Segment(directory, int(name[:-4])))
+        for segment in self._segments[:-1]:
+            segment.load()
+        if self._segments:
+            self._segments[-1].recover()
+        self._pending: list[tuple[int, bytes, bytes, bytes]] = [] # (номер, комната, отправитель, текст), еще не на диске
+        self._flush_task: asyncio.Task | None = None
+        self.closed = False
+        # список сегментов, их размер и последние записи комнат меняет поток записи, читают потоки чтения
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="msglog")
+
+    @property
+    def last_seq(self) -> int:
+        """Номер последней записи на диске, 0 - журнал пуст. Новый сегмент может быть
+        еще пустым (запись в него не удалась), тогда номер берется из предыдущего"""
+        return next((s.last_seq for s in reversed(self._segments) if s.last_seq), 0)
+
+    def append(self, seq: int, room: str, sender: str, plaintext: bytes) -> None:
+        if self.closed: # поток записи уже остановлен, запись потерялась бы в фоновой задаче
+            raise RuntimeError("Message log is closed")
+        self._pending.append((seq, room.encode("utf-8"), sender.encode("utf-8"), plaintext))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.commit_delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Пишем все накопленное. Пока идет запись, новые записи копятся для следующей"""
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                await loop.run_in_executor(self._writer, self._write, batch)
+        finally:
+            self._flush_task = None
+
+    def _write(self, batch: list[tuple[int, bytes, bytes, bytes]]) -> None:
+        """Выполняется в потоке записи. Размер сегмента и последние записи комнат меняются
+        только после удачной записи на диск"""
+        segment = self._segments[-1] if self._segments else None
+        size = segment.size if segment is not None else 0
+        records, entries, tails = [], [], {}
+        last = 0
+        try:
+            for seq, r, s, plaintext in batch:
+                if segment is None or size >= self.segment_bytes:
+                    if records:
+                        self._commit(segment, records, entries, tails, size, last)
+                        records, entries, tails = [], [], {}
+                    if segment is not None:
+                        segment.seal()
+                    segment = _Segment(self.directory, seq)
+                    for path in (segment.log_path, segment.idx_path):
+                        open(path, "ab").close()
+                    with self._lock:
+                        self._segments.append(segment)
+                    size = 0
+                prev = tails.get(r, segment.tails.get(r, -1))
+                try:
+                    header = RECORD_HEADER.pack(seq, len(r), len(s), len(plaintext), prev + 1)
+                except struct.error: # не помещается в заголовок: теряем только эту запись, а не всю пачку
+                    logging.error("Сообщение %d не помещается в запись журнала, пропускаем", seq)
+                    continue
+                record = b"".join((header, r, s, plaintext))
+                records.append(record)
+                entries.append(INDEX_ENTRY.pack(seq, size))
+                tails[r] = size
+                size += len(record)
+                last = seq
+            if records:
+                self._commit(segment, records, entries, tails, size, last)
+        except OSError:
+            logging.exception("Не удалось записать журнал сообщений")
+            if segment is not None:
+                try: # файлы обратно к тому, на что есть индекс
+                    with self._lock:
+                        segment.recover()
+                except OSError:
+                    logging.exception("Не удалось восстановить сегмент журнала %s", segment.log_path)
+        self.commits += 1
+
+    def _commit(self, segment: _Segment, records: list[bytes], entries: list[bytes], tails: dict[bytes, int],
+                size: int, last: int) -> None:
+        # индекс пишем после записей: все, на что есть индекс, уже целиком в файле
+        for path, data in ((segment.log_path, records), (segment.idx_path, entries)):
+            with open(path, "ab") as f:
+                f.write(b"".join(data))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        with self._lock:
+            segment.size = size
+            segment.last_seq = last
+            segment.tails.update(tails)
+
+    async def history(self, room: str, after: int = 0, before: int | None = None,
+                      limit: int = HISTORY_PAGE) -> list[tuple[int, str, bytes]]:
+        """read в пуле потоков: чтение с диска не останавливает event loop"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.read, room, after, before, limit)
+
+    def read(self, room: str, after: int = 0, before: int | None = None,
+             limit: int = HISTORY_PAGE) -> list[tuple[int, str, bytes]]:
+        """Последние limit сообщений комнаты с номерами после after и до before, по порядку.
+        Формат как у RoomHistory.since: (номер, отправитель, текст). Один запрос проходит
+        не больше MAX_SCAN записей комнаты, при глубокой прокрутке страница может быть неполной"""
+        r = room.encode("utf-8")
+        with self._lock: # последние записи берем до mmap: все, на что они ссылаются, уже в файле
+            segments = [(segment, segment.tails.get(r)) for segment in self._segments]
+        out: list[tuple[int, str, bytes]] = []
+        budget = MAX_SCAN
+        for i in range(len(segments) - 1, -1, -1):
+            segment, tail = segments[i]
+            if before is not None and segment.first_seq >= before:
+                continue
+            if tail is not None:
+                sealed = i < len(segments) - 1
+                if sealed:
+                    with self._lock:
+                        log = segment.view(sealed)
+                else:
+                    log = segment.view(sealed)
+                try:
+                    done, budget = self._follow(log, tail, after, before, limit, out, budget)
+                finally:
+                    if not sealed:
+                        log.close()
+                if done:
+                    break
+            if segment.first_seq <= after:
+                break
+        out.reverse()
+        return out
+
+    @staticmethod
+    def _follow(log: mmap.mmap, offset: int, after: int, before: int | None, limit: int,
+                out: list, budget: int) -> tuple[bool, int]:
+        """Идем по записям комнаты от новых к старым. (True - больше искать не нужно, остаток MAX_SCAN)"""
+        while offset >= 0:
+            if budget <= 0:
+                return True, 0
+            budget -= 1
+            seq, rlen, slen, tlen, prev = RECORD_HEADER.unpack_from(log, offset)
+            if seq <= after:
+                return True, budget
+            if before is None or seq < before:
+                start = offset + RECORD_HEADER.size + rlen
+                out.append((seq, str(log[start:start + slen], "utf-8"), log[start + slen:start + slen + tlen]))
+                if len(out) >= limit:
+                    return True, budget
+            offset = prev - 1
+        return False, budget
+
+    async def close(self) -> None:
+        self.closed = True
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        self._writer.shutdown(wait=True)
+        for segment in self._segments:
+            segment.close()
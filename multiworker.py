@@ -0,0 +1,98 @@
+# chat/multiworker.py
+"""Многопроцессный сервер: K воркеров слушают один порт через SO_REUSEPORT.
+
+Ядро распределяет подключения между воркерами, поэтому каждый воркер владеет
+своей частью клиентов. Рассылка между воркерами идет через UnixSocketBus.
+
+Запуск: python multiworker.py --workers 4 --port 1234 [--metrics-port 9100] [--transport streams] [--uvloop]
+(метрики воркера i - на порту metrics-port + i)
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from bus import UnixSocketBus
+from crypto.dh_modp_aesgcm import EphemeralKeyPool
+from crypto.executor import HandshakeExecutor
+from server import ChatServer
+from transport import TRANSPORTS, TRANSPORT_PROTOCOL, use_uvloop
+from metrics import start_metrics_server, log_snapshots
+from chatlog import setup_logging
+
+
+async def _worker_main(worker_id: int, workers: int, host: str, port: int, bus_dir: str,
+                       metrics_port: int | None, transport: str) -> None:
+    # Воркеров и так несколько, поэтому рукопожатия считаем в пуле потоков своего процесса
+    executor = HandshakeExecutor()
+    server = ChatServer(handshake_executor=executor, key_pool=EphemeralKeyPool(executor=executor),
+                        bus=UnixSocketBus(bus_dir, worker_id, workers))
+    srv = await server.start(host, port, reuse_port=True, transport=transport)
+    logging.info("Воркер %d (pid %d) слушает %s:%d", worker_id, os.getpid(), host, port)
+    snapshots = None
+    if metrics_port is not None:
+        await start_metrics_server(host, metrics_port + worker_id)
+        snapshots = asyncio.create_task(log_snapshots())
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        if snapshots is not None:
+            snapshots.cancel()
+        await server.close()
+
+
+def _worker(worker_id: int, workers: int, host: str, port: int, bus_dir: str, metrics_port: int | None,
+            log_opts: dict, transport: str, uvloop: bool) -> None:
+    listener = setup_logging(logging.INFO, fmt=f"[worker {worker_id}] %(levelname)s %(message)s", **log_opts)
+    if uvloop and not use_uvloop():
+        logging.warning("uvloop не установлен, воркер %d работает на стандартном цикле событий", worker_id)
+    try:
+        asyncio.run(_worker_main(worker_id, workers, host, port, bus_dir, metrics_port, transport))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
+
+
+def run_workers(workers: int, host: str = "127.0.0.1", port: int = 1234, metrics_port: int | None = None,
+                log_opts: dict | None = None, transport: str = TRANSPORT_PROTOCOL, uvloop: bool = False) -> None:
+    """log_opts - параметры chatlog.setup_logging: structured, sample_rate, redact.
+    transport - см. ChatServer.start, uvloop - воркеры на uvloop, если он установлен"""
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    procs = [multiprocessing.Process(target=_worker, daemon=True,
+                                     args=(i, workers, host, port, bus_dir, metrics_port, log_opts or {},
+                                           transport, uvloop))
+             for i in range(workers)]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.join()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Multi-process chat server")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=1234)
+    ap.add_argument("--metrics-port", type=int, default=None)
+    ap.add_argument("--transport", choices=TRANSPORTS, default=TRANSPORT_PROTOCOL)
+    ap.add_argument("--uvloop", action="store_true", help="цикл событий uvloop, если установлен")
+    ap.add_argument("--log-json", action="store_true", help="логи одной строкой JSON на запись")
+    ap.add_argument("--log-sample", type=float, default=1.0, help="доля сообщений чата, попадающих в лог")
+    ap.add_argument("--log-redact", action="store_true", help="писать в лог длину сообщения вместо текста")
+    args = ap.parse_args()
+    run_workers(args.workers, args.host, args.port, args.metrics_port,
+                {"structured": args.log_json, "sample_rate": args.log_sample, "redact": args.log_redact},
+                args.transport, args.uvloop)
@@ -0,0 +1,147 @@
+# chat/outbound.py
+import time
+import asyncio
+import logging
+from typing import Callable
+from common import (write_message, write_packed, write_parts, frame_header, close_writer, sync_codec,
+                    compress_frame, FRAMING_LEGACY, FRAME_DATA)
+from metrics import ENCODE_SECONDS, DROPPED, DISCONNECTS
+
+# Политики обработки медленного клиента, у которого переполнилась очередь отправки
+POLICY_DROP_OLDEST = "drop_oldest"   # выбрасываем самое старое сообщение из очереди
+POLICY_DISCONNECT = "disconnect"     # отключаем клиента
+POLICY_BACKPRESSURE = "backpressure" # отправитель ждет, пока в очереди появится место
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DISCONNECT, POLICY_BACKPRESSURE)
+
+
+class ClientSession:
+    """Подключенный клиент: имя, кодек и собственная очередь исходящих сообщений.
+
+    Рассылка только кладет сообщение в очередь, а отдельная задача-писатель
+    отправляет сообщения в сокет. Так медленный клиент не задерживает остальных.
+
+    Если задан batch_delay, писатель собирает сообщения из очереди в пакет
+    (не дольше batch_delay секунд и не больше batch_bytes байт) и отправляет
+    их одной записью с одним drain.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, username: str, codec: object,
+                 maxsize: int, policy: str, write_timeout: float, framing: int = FRAMING_LEGACY,
+                 batch_delay: float | None = None, batch_bytes: int = 0) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow client policy: {policy}")
+        self.writer = writer
+        self.username = username
+        self.codec = codec
+        self.framing = framing
+        # Для кодеков без преобразования (plain) очередь хранит готовые кадры,
+        # собранные один раз на всех получателей, иначе - открытый текст
+        # (или пару (тип кадра, открытый текст) для кадров не FRAME_DATA и для уже сжатых)
+        self.passthrough = getattr(codec, "passthrough", False)
+        self.policy = policy
+        self.write_timeout = write_timeout
+        self.batch_delay = batch_delay
+        self.batch_bytes = batch_bytes
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize)
+        self.rooms: set[str] = set() # комнаты, в которых состоит клиент
+        self.joined_seq: dict[str, int] = {} # комната -> номер ее последнего сообщения на момент входа
+        self.dropped = 0 # сколько сообщений выброшено по политике drop_oldest
+        self.closed = False
+        self._task: asyncio.Task | None = None
+
+    def start(self, on_failure: Callable[["ClientSession"], None]) -> None:
+        """Запускаем задачу-писатель. on_failure вызывается, если запись в сокет не удалась"""
+        self._task = asyncio.create_task(self._run(on_failure))
+
+    def offer(self, data: bytes) -> bool:
+        """Неблокирующая постановка сообщения в очередь.
+
+        Возвращает False, если очередь переполнена и по политике клиента сообщение
+        не может быть поставлено без ожидания (disconnect или backpressure).
+        """
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            if self.policy != POLICY_DROP_OLDEST:
+                return False
+        self.queue.get_nowait()
+        self.dropped += 1
+        DROPPED.inc()
+        self.queue.put_nowait(data)
+        return True
+
+    async def put(self, data: bytes, timeout: float) -> bool:
+        """Ожидание места в очереди (политика backpressure). False - клиент не успел за timeout"""
+        try:
+            await asyncio.wait_for(self.queue.put(data), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _run(self, on_failure: Callable[["ClientSession"], None]) -> None:
+        try:
+            # close() ставит closed до отмены задачи: если wait_for проглотит отмену
+            # (запись завершилась одновременно с ней), цикл все равно закончится
+            while not self.closed:
+                data = await self.queue.get()
+                if self.batch_delay is not None:
+                    parts = await self._collect_batch(data)
+                    await asyncio.wait_for(write_parts(self.writer, parts), timeout=self.write_timeout)
+                elif self.passthrough:
+                    await asyncio.wait_for(write_packed(self.writer, data), timeout=self.write_timeout)
+                else:
+                    ftype, data = data if isinstance(data, tuple) else (FRAME_DATA, data)
+                    await asyncio.wait_for(write_message(self.writer, data, self.codec, self.framing, ftype),
+                                           timeout=self.write_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.info("Не удалось отправить сообщение клиенту %s, отключаем", self.username)
+            self.closed = True
+            DISCONNECTS.labels("write_error").inc()
+            on_failure(self)
+            await close_writer(self.writer)
+
+    async def _frame_parts(self, data: bytes) -> list:
+        if self.passthrough: # в очереди уже готовый кадр
+            return [data]
+        ftype, data = data if isinstance(data, tuple) else (FRAME_DATA, data)
+        start = time.perf_counter()
+        ftype, data = compress_frame(self.codec, data, ftype)
+        data = self.codec.encode_sync(data) if sync_codec(self.codec, len(data)) else await self.codec.encode(data)
+        ENCODE_SECONDS.labels(self.codec.name).observe(time.perf_counter() - start)
+        return [frame_header(len(data), self.framing, ftype), data]
+
+    async def _collect_batch(self, first: bytes) -> list:
+        """Собираем пакет кадров, начиная с first, пока не истечет batch_delay или не наберется batch_bytes"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_delay
+        parts = await self._frame_parts(first)
+        size = sum(len(p) for p in parts)
+        while size < self.batch_bytes:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    data = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                data = self.queue.get_nowait()
+            more = await self._frame_parts(data)
+            parts.extend(more)
+            size += sum(len(p) for p in more)
+        return parts
+
+    async def close(self) -> None:
+        self.closed = True
+        task = self._task
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        await close_writer(self.writer)
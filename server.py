@@ -1,38 +1,373 @@
 # chat/server.py
+import time
 import asyncio
 import logging
-from typing import Dict, Tuple
-from common import read_message, write_message, close_writer
-from crypto.negotiation import server_negotiate
+from typing import Dict, Iterable
+from common import (read_message, read_typed_message, close_writer, pack_frame, compress_frame, FrameTooLarge,
+                    BATCH_BYTES, FRAMING_V2, FRAME_DATA, FRAME_COMPRESSED, FRAME_NO_COMPRESS, FRAME_ENVELOPE, FRAME_TICKET, FRAME_ROOM,
+                    FRAME_THROTTLED, NOTICE_THROTTLED,
+                    pack_envelope, unpack_envelope, valid_room_name, valid_username, KEY_PUBLISH, KEY_FETCH, KEY_LIST, pack_key_list, pack_room_message,
+                    DEFAULT_ROOM, CMD_JOIN, CMD_LEAVE, CMD_ROOM_MSG, CMD_DIRECT, CMD_REPLAY, CMD_HISTORY)
+from crypto.negotiation import server_negotiate, SERVER_PREFERENCE, HANDSHAKE_MAX_FRAME
+from crypto.executor import HandshakeExecutor, EXECUTOR_PROCESS
+from crypto.dh_modp_aesgcm import EphemeralKeyPool
+from crypto.tickets import TicketKeys
+from crypto.compression import COMPRESSION_PREFERENCE
+from bus import UnixSocketBus, BUS_ROOM, BUS_USER, BUS_KEY
+from keydir import KeyDirectory
+from history import RoomHistory, HISTORY_SIZE
+from msglog import MessageLog, HISTORY_PAGE
+from outbound import ClientSession, POLICY_DROP_OLDEST, POLICY_BACKPRESSURE
+from chatlog import MESSAGES, setup_logging
+from transport import FrameProtocol, TRANSPORT_STREAMS, TRANSPORT_PROTOCOL, TRANSPORTS, use_uvloop
+from admission import Admission, REJECT_HANDSHAKE_TIMEOUT, REJECT_IDLE, REJECT_FRAME_SIZE
+from metrics import (REGISTRY, HANDSHAKE_SECONDS, HANDSHAKE_FAILURES, MESSAGES_RECEIVED, FANOUT_SECONDS,
+                     FANOUT_RECIPIENTS, DISCONNECTS, COMPRESSION_SAVED, start_metrics_server, log_snapshots)
 
-BROADCAST_TIMEOUT = 1.0
+BROADCAST_TIMEOUT = 1.0 # сколько ждем записи одного сообщения клиенту (и места в очереди при backpressure)
+SEND_QUEUE_SIZE = 1024 # размер очереди исходящих сообщений одного клиента
+SLOW_CLIENT_POLICY = POLICY_DROP_OLDEST
+# Служебные команды не рассылаются другим клиентам, лимит частоты на них не действует
+CONTROL_COMMANDS = tuple(c.encode("utf-8") for c in (CMD_JOIN, CMD_LEAVE, CMD_REPLAY, CMD_HISTORY))
 
 class ChatServer:
-    def __init__(self) -> None:
-        self.clients: Dict[asyncio.StreamWriter, Tuple[str, object]] = {}
+    def __init__(self, queue_size: int = SEND_QUEUE_SIZE, slow_client_policy: str = SLOW_CLIENT_POLICY,
+                 handshake_executor: HandshakeExecutor | None = None,
+                 key_pool: EphemeralKeyPool | None = None,
+                 batch_delay: float | None = None, batch_bytes: int = BATCH_BYTES,
+                 bus: UnixSocketBus | None = None, alg_preference: tuple = SERVER_PREFERENCE,
+                 offload_bytes: int | None = None, tickets: TicketKeys | None = None,
+                 history_size: int = HISTORY_SIZE, log: MessageLog | None = None,
+                 admission: Admission | None = None, compression: tuple = COMPRESSION_PREFERENCE) -> None:
+        self.clients: Dict[asyncio.StreamWriter, ClientSession] = {}
+        self.rooms: Dict[str, set[ClientSession]] = {} # комната -> участники
+        self.by_name: Dict[str, set[ClientSession]] = {} # имя -> подключения с этим именем
+        self.keys = KeyDirectory() # публичные ключи E2E клиентов
+        # последние сообщения комнат для досылки после переподключения, у воркеров нумерация своя
+        self.history = RoomHistory(history_size, worker=bus.worker_id if bus is not None else 0,
+                                   workers=bus.workers if bus is not None else 1)
+        self.log = log # журнал сообщений комнат на диске, None - история только в памяти
+        if log is not None: # номера продолжают журнал, даже если часы отстали
+            self.history.advance(log.last_seq)
+        self.queue_size = queue_size
+        self.slow_client_policy = slow_client_policy
+        self.handshake_executor = handshake_executor # None - общий пул потоков
+        self.key_pool = key_pool # запас эфемерных ключей DH для рукопожатий
+        self.batch_delay = batch_delay # None - каждое сообщение отправляется сразу
+        self.batch_bytes = batch_bytes
+        self.alg_preference = alg_preference # порядок выбора алгоритма из списка клиента
+        self.offload_bytes = offload_bytes # сообщения от этого размера шифруются в пуле потоков
+        self.compression = compression # варианты сжатия по предпочтению (crypto/compression.py), () - без сжатия
+        # Ключи билетов возобновления сессии. У каждого воркера свои, поэтому билет другого
+        # воркера не примется, и клиент просто сделает полное рукопожатие
+        self.tickets = tickets if tickets is not None else TicketKeys()
+        self.bus = bus # шина для рассылки клиентам других воркеров (см. multiworker.py)
+        self.admission = admission if admission is not None else Admission() # лимиты подключений и сообщений
         self._server: asyncio.Server | None = None
+        self._handlers: set[asyncio.Task] = set() # задачи подключений, close() завершает их до журнала
+        REGISTRY.gauge("chat_clients", "Connected clients", lambda: len(self.clients))
+        REGISTRY.gauge("chat_rooms", "Non-empty rooms", lambda: len(self.rooms))
+        REGISTRY.gauge("chat_queue_depth_max", "Longest outbound queue",
+                       lambda: max((s.queue.qsize() for s in self.clients.values()), default=0))
+        REGISTRY.gauge("chat_queue_depth_total", "Messages waiting in all outbound queues",
+                       lambda: sum(s.queue.qsize() for s in self.clients.values()))
 
-    async def start(self, host: str = "127.0.0.1", port: int = 1234) -> asyncio.Server:
-        self._server = await asyncio.start_server(self._handle_client, host, port)
+    async def start(self, host: str = "127.0.0.1", port: int = 1234, reuse_port: bool = False,
+                    transport: str = TRANSPORT_STREAMS) -> asyncio.Server:
+        """reuse_port - несколько процессов слушают один порт (SO_REUSEPORT), ядро распределяет подключения.
+        transport - TRANSPORT_STREAMS (asyncio.start_server) или TRANSPORT_PROTOCOL (transport.FrameProtocol),
+        обработка подключений у них общая"""
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        if self.key_pool is not None:
+            self.key_pool.start()
+        if self.bus is not None:
+            await self.bus.start(self._deliver_local) # сообщения от других воркеров рассылаем только своим клиентам
+        if transport == TRANSPORT_PROTOCOL:
+            loop = asyncio.get_running_loop()
+            self._server = await loop.create_server(lambda: FrameProtocol(self._handle_client), host, port,
+                                                    reuse_port=reuse_port or None)
+        else:
+            self._server = await asyncio.start_server(self._handle_client, host, port, reuse_port=reuse_port or None)
         return self._server
 
-    async def _broadcast(self, plaintext: bytes) -> None:
-        """Функция рассылки сообщений всем клиентам.
+    async def close(self) -> None:
+        """Перестаем принимать подключения, отключаем клиентов и шину и только потом
+        дописываем журнал на диск: после этого новых записей в журнал уже не будет"""
+        if self._server is not None:
+            self._server.close()
+        handlers = list(self._handlers)
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        if self.bus is not None:
+            await self.bus.close()
+        if self.log is not None:
+            await self.log.close()
 
-        В параметрах функции plaintext - сообщение, которое нужно отправить всем клиентам
+    def _register(self, session: ClientSession) -> None:
+        self.clients[session.writer] = session
+        self.by_name.setdefault(session.username, set()).add(session)
+        self._join(session, DEFAULT_ROOM)
+
+    def _forget(self, session: ClientSession) -> None:
+        self.clients.pop(session.writer, None)
+        for room in list(session.rooms):
+            self._leave(session, room)
+        self.keys.unsubscribe(session)
+        named = self.by_name.get(session.username)
+        if named is not None:
+            named.discard(session)
+            if not named:
+                del self.by_name[session.username]
+                self._set_key(session.username, b"") # ключ отключившегося клиента больше не нужен
+
+    def _join(self, session: ClientSession, room: str) -> None:
+        if not valid_room_name(room):
+            return
+        self.rooms.setdefault(room, set()).add(session)
+        session.rooms.add(room)
+        # все, что новее, клиент получит обычной рассылкой, досылать нужно только до этого номера
+        session.joined_seq[room] = self.history.last_seq(room)
+
+    def _leave(self, session: ClientSession, room: str) -> None:
+        session.rooms.discard(room)
+        session.joined_seq.pop(room, None)
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(session)
+            if not members: # пустые комнаты не храним
+                del self.rooms[room]
+
+    async def _broadcast(self, plaintext: bytes, origin: ClientSession | None = None, room: str = DEFAULT_ROOM,
+                         ftype: int = FRAME_DATA, sender: str = "") -> None:
+        """Рассылка сообщения участникам комнаты room (кроме отправителя origin).
+        Текстовые сообщения запоминаются в истории комнаты, клиенты v2 получают их с номером.
+        sender - имя отправителя сообщения с шины, у которого нет origin"""
+        room_body = None
+        if ftype == FRAME_DATA:
+            if origin is not None:
+                sender = origin.username
+            seq = self.history.append(room, sender, plaintext)
+            if self.log is not None:
+                self.log.append(seq, room, sender, plaintext)
+            room_body = pack_room_message(seq, room, plaintext)
+        await self._fanout(plaintext, self.rooms.get(room, ()), origin, ftype, room_body)
+
+    async def _replay(self, session: ClientSession, room: str, after: int) -> None:
+        """Досылка сообщений комнаты, пропущенных клиентом, начиная с номера после after.
+        Свои сообщения клиенту не возвращаются, как и при обычной рассылке"""
+        entries = self.history.since(room, after, session.joined_seq.get(room))
+        await self._send_entries(session, room, [e for e in entries if e[1] != session.username])
+
+    async def _scrollback(self, session: ClientSession, room: str, before: int | None) -> None:
+        """Последние HISTORY_PAGE сообщений комнаты до номера before: из журнала на диске,
+        а без журнала - сколько осталось в памяти"""
+        if self.log is not None:
+            entries = await self.log.history(room, before=before)
+        else:
+            entries = self.history.since(room, 0, None if before is None else before - 1)[-HISTORY_PAGE:]
+        await self._send_entries(session, room, entries)
+
+    @staticmethod
+    async def _send_entries(session: ClientSession, room: str, entries: list[tuple[int, str, bytes]]) -> None:
+        for seq, _, plaintext in entries:
+            ftype, body = compress_frame(session.codec, pack_room_message(seq, room, plaintext), FRAME_ROOM)
+            item = pack_frame(body, session.framing, ftype) if session.passthrough else (ftype | FRAME_NO_COMPRESS, body)
+            if not await session.put(item, BROADCAST_TIMEOUT):
+                return
+
+    async def _send_to_users(self, plaintext: bytes, usernames: Iterable[str], origin: ClientSession | None = None,
+                             ftype: int = FRAME_DATA) -> None:
+        """Доставка сообщения только подключениям пользователей usernames"""
+        targets: set[ClientSession] = set()
+        for name in usernames:
+            targets.update(self.by_name.get(name, ()))
+        await self._fanout(plaintext, targets, origin, ftype)
+
+    async def _deliver_local(self, kind: int, target: str, plaintext: bytes, ftype: int = FRAME_DATA,
+                             origin: ClientSession | None = None, sender: str = "") -> None:
+        """Доставка сообщения своим клиентам: в комнату (BUS_ROOM) или пользователям (BUS_USER,
+        имена через запятую). Так же доставляются сообщения, пришедшие по шине от других воркеров,
+        для них sender - имя отправителя"""
+        if kind == BUS_KEY:
+            self._set_key(target, bytes(plaintext), publish=False)
+        elif kind == BUS_USER:
+            await self._send_to_users(plaintext, target.split(","), origin, ftype)
+        else:
+            await self._broadcast(plaintext, origin, target, ftype, sender)
+
+    async def _publish(self, kind: int, target: str, plaintext: bytes, origin: ClientSession,
+                       ftype: int = FRAME_DATA) -> None:
+        """Доставка своим клиентам и, если есть шина, клиентам других воркеров"""
+        await self._deliver_local(kind, target, plaintext, ftype, origin)
+        if self.bus is not None:
+            self.bus.publish(kind, target, plaintext, ftype, origin.username)
+
+    @staticmethod
+    def _offer_envelope(session: ClientSession, envelope: bytes) -> None:
+        """Служебный конверт от сервера одному клиенту, без ожидания места в очереди"""
+        session.offer(pack_frame(envelope, session.framing, FRAME_ENVELOPE) if session.passthrough
+                      else (FRAME_ENVELOPE, envelope))
+
+    def _set_key(self, name: str, key: bytes, publish: bool = True) -> None:
+        """Обновляем ключ в каталоге и сообщаем о нем подписчикам (и другим воркерам, если publish)"""
+        subscribers = self.keys.set(name, key)
+        if subscribers is None:
+            return
+        if subscribers:
+            out = pack_envelope(KEY_LIST, "", "", pack_key_list([(name, key)]))
+            for s in subscribers:
+                if s.username != name:
+                    self._offer_envelope(s, out)
+        if publish and self.bus is not None:
+            self.bus.publish(BUS_KEY, name, key)
+
+    def _key_directory(self, session: ClientSession, kind: int, recipient: str, body: memoryview) -> None:
+        """Запросы к каталогу ключей: публикация своего ключа и запрос (с подпиской) чужих"""
+        if kind == KEY_PUBLISH:
+            self._set_key(session.username, bytes(body))
+            return
+        names = [n for n in recipient.split(",") if n] if recipient else None
+        entries = self.keys.subscribe(session, names)
+        self._offer_envelope(session, pack_envelope(KEY_LIST, "", "", pack_key_list(entries)))
+
+    async def _route_envelope(self, session: ClientSession, data: bytes) -> None:
+        """Двоичный конверт: сервер подставляет имя отправителя и доставляет конверт
+        получателям из конверта (или в комнату по умолчанию, если получатель пустой).
+        Содержимое конверта сервер не разбирает, кроме запросов к каталогу ключей"""
+        kind, _, recipient, body = unpack_envelope(data)
+        if kind in (KEY_PUBLISH, KEY_FETCH):
+            self._key_directory(session, kind, recipient, body)
+            return
+        out = pack_envelope(kind, session.username, recipient, body)
+        if recipient:
+            await self._publish(BUS_USER, recipient, out, session, FRAME_ENVELOPE)
+        elif DEFAULT_ROOM in session.rooms:
+            await self._publish(BUS_ROOM, DEFAULT_ROOM, out, session, FRAME_ENVELOPE)
+
+    @staticmethod
+    def _rate_limited(ftype: int, msg: bytes) -> bool:
+        """Действует ли на кадр лимит частоты: только на то, что рассылается другим клиентам.
+        Служебные команды и запросы к каталогу ключей не ограничиваются, иначе клиент
+        молча остался бы без комнаты, досылки или ключа собеседника"""
+        if ftype == FRAME_ENVELOPE:
+            return not msg or msg[0] not in (KEY_PUBLISH, KEY_FETCH)
+        return not msg.startswith(CONTROL_COMMANDS)
+
+    @staticmethod
+    def _notify_throttled(session: ClientSession) -> None:
+        if session.framing == FRAMING_V2:
+            item, ftype = b"", FRAME_THROTTLED
+        else:
+            item, ftype = NOTICE_THROTTLED.encode("utf-8"), FRAME_DATA
+        session.offer(pack_frame(item, session.framing, ftype) if session.passthrough
+                      else item if ftype == FRAME_DATA else (ftype, item))
+
+    async def _dispatch(self, session: ClientSession, text: str) -> None:
+        """Разбор сообщения клиента: служебная команда или сообщение в комнату по умолчанию"""
+        username = session.username
+        if text.startswith(CMD_JOIN):
+            self._join(session, text[len(CMD_JOIN):])
+        elif text.startswith(CMD_LEAVE):
+            self._leave(session, text[len(CMD_LEAVE):])
+        elif text.startswith(CMD_ROOM_MSG):
+            room, _, body = text[len(CMD_ROOM_MSG):].partition(":")
+            if room in session.rooms: # писать можно только в свои комнаты
+                await self._publish(BUS_ROOM, room, f"{username} [{room}] > {body}".encode("utf-8"), session)
+        elif text.startswith(CMD_REPLAY):
+            room, _, after = text[len(CMD_REPLAY):].rpartition(":")
+            if room in session.rooms and session.framing == FRAMING_V2 and after.isdigit():
+                if self.history.owns(int(after)):
+                    await self._replay(session, room, int(after))
+                else: # клиент переподключился к другому воркеру, его номер из чужой нумерации
+                    logging.info("Клиент %s просит досылку по номеру другого воркера, досылки нет", username)
+        elif text.startswith(CMD_HISTORY):
+            room, _, before = text[len(CMD_HISTORY):].rpartition(":")
+            if room in session.rooms and session.framing == FRAMING_V2 and (before.isdigit() or not before):
+                await self._scrollback(session, room, int(before) if before else None)
+        elif text.startswith(CMD_DIRECT):
+            # адресная доставка: сообщение получают только указанные пользователи
+            to_users, _, body = text[len(CMD_DIRECT):].partition(":")
+            await self._publish(BUS_USER, to_users, f"{username} > {body}".encode("utf-8"), session)
+        elif DEFAULT_ROOM in session.rooms:
+            await self._publish(BUS_ROOM, DEFAULT_ROOM, f"{username} > {text}".encode("utf-8"), session)
+
+    async def _fanout(self, plaintext: bytes, targets: Iterable[ClientSession], origin: ClientSession | None = None,
+                      ftype: int = FRAME_DATA, room_body: bytes | None = None) -> None:
+        """Функция рассылки сообщений клиентам.
+
+        В параметрах функции plaintext - сообщение, targets - получатели,
+        origin - отправитель, ему сообщение не возвращается, ftype - тип кадра
+        (кадры не FRAME_DATA получают только клиенты с форматом v2),
+        room_body - то же сообщение с номером для клиентов v2 (кадр FRAME_ROOM).
+        Сообщение только кладется в очереди клиентов, запись в сокеты делают их задачи-писатели.
+        Для клиентов без шифрования кадр собирается один раз и один и тот же буфер
+        отправляется всем, шифрование делается только для каждого AES-GCM клиента отдельно.
+        Сжатие (если клиент о нем договорился) тоже делается один раз на каждый вариант сжатия,
+        шифруются уже сжатые данные; если сжатие не помогло, писатели очередей его не повторяют.
         """
-        targets = [(w, self.clients[w][1]) for w in list(self.clients.keys())]
-        async def send_one(w, codec):
-            try:
-                await asyncio.wait_for(write_message(w, plaintext, codec), timeout=BROADCAST_TIMEOUT)
-                return True
-            except Exception:
-                return False
-        results = await asyncio.gather(*(send_one(w, c) for w, c in targets)) # распараллеливаем отправку сообщений
-        for (w, _), ok in zip(targets, results):
-            if not ok: #если кому-то отправка не удалась, то отключаем его
-                self.clients.pop(w, None)
-                await close_writer(w)
+        start = time.perf_counter()
+        recipients = 0
+        saved = 0
+        waiting = []
+        slow = []
+        packed: Dict[tuple, bytes] = {} # готовый кадр для каждого формата кадров и варианта сжатия
+        compressed: Dict[str, tuple[int, bytes]] = {} # вариант сжатия -> (тип кадра, сжатые данные)
+        for session in list(targets):
+            if session is origin or (ftype != FRAME_DATA and session.framing != FRAMING_V2):
+                continue
+            body, ft = (room_body, FRAME_ROOM) if room_body is not None and session.framing == FRAMING_V2 \
+                else (plaintext, ftype)
+            compression = session.codec.compression
+            if compression is not None: # только у v2, у них у всех один и тот же body
+                z = compressed.get(compression.name)
+                if z is None:
+                    z = compressed[compression.name] = compress_frame(session.codec, body, ft)
+                if z[0] & FRAME_COMPRESSED:
+                    saved += len(body) - len(z[1])
+                    ft, body = z
+                elif not session.passthrough: # не помогло - писатель очереди не пробует снова
+                    ft |= FRAME_NO_COMPRESS
+            if session.passthrough:
+                key = (session.framing, compression.name if compression is not None else None)
+                item = packed.get(key)
+                if item is None:
+                    item = packed[key] = pack_frame(body, session.framing, ft)
+            else:
+                item = body if ft == FRAME_DATA else (ft, body)
+            recipients += 1
+            if session.offer(item):
+                continue
+            if session.policy == POLICY_BACKPRESSURE:
+                waiting.append((session, item))
+            else:
+                slow.append(session)
+        if waiting: # ждем только тех, у кого переполнена очередь, всех сразу: общий срок BROADCAST_TIMEOUT
+            placed = await asyncio.gather(*(session.put(item, BROADCAST_TIMEOUT) for session, item in waiting))
+            slow.extend(session for (session, _), ok in zip(waiting, placed) if not ok)
+        for session in slow: #если кто-то не успевает принимать сообщения, то отключаем его
+            logging.info("Клиент %s не успевает принимать сообщения, отключаем", session.username)
+            DISCONNECTS.labels("slow").inc()
+            self._forget(session)
+            await session.close()
+        FANOUT_RECIPIENTS.observe(recipients)
+        if saved:
+            COMPRESSION_SAVED.inc(saved)
+        FANOUT_SECONDS.observe(time.perf_counter() - start)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> tuple:
+        """Рукопожатие и имя клиента: (кодек, формат кадров, имя)"""
+        start = time.perf_counter()
+        codec, framing = await server_negotiate(reader, writer, self.handshake_executor, self.key_pool,
+                                                self.alg_preference, self.tickets, self.compression)
+        HANDSHAKE_SECONDS.labels(codec.name).observe(time.perf_counter() - start)
+        if not codec.passthrough:
+            codec.offload_bytes = self.offload_bytes
+        username = (await read_message(reader, codec, framing, HANDSHAKE_MAX_FRAME)).decode("utf-8")
+        if not valid_username(username):
+            raise ValueError("Invalid username")
+        return codec, framing, username
 
     async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
         """Функция обработки подключения клиента. Функция передается в asyncio.start_server в качестве callback метода. 
@@ -40,42 +375,108 @@ class ChatServer:
         В параметрах функции reader - объект для чтения данных из сокета, writer - объект для записи данных в сокет
         """
 
-        try:
-            codec = await server_negotiate(reader, writer)
-        except Exception:
+        admission = self.admission
+        if not admission.admit(len(self.clients)):
             await close_writer(writer)
             return
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            await self._serve_client(reader, writer)
+        except asyncio.CancelledError: # close(): задача подключения завершается без ошибки
+            pass
+        finally:
+            self._handlers.discard(task)
 
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        admission = self.admission
+        # молчащий клиент не должен вечно занимать место среди рукопожатий
+        deadline = admission.deadline(writer.transport, admission.handshake_timeout)
         try:
-            username = (await read_message(reader, codec)).decode("utf-8")
+            codec, framing, username = await self._accept(reader, writer)
         except Exception:
+            if deadline is not None and deadline.expired:
+                admission.reject(REJECT_HANDSHAKE_TIMEOUT)
+            HANDSHAKE_FAILURES.inc()
             await close_writer(writer)
             return
+        except asyncio.CancelledError: # сервер останавливается посреди рукопожатия
+            await close_writer(writer)
+            raise
+        finally:
+            admission.handshake_done()
+            if deadline is not None:
+                deadline.cancel()
 
-        self.clients[writer] = (username, codec)
+        session = ClientSession(writer, username, codec, self.queue_size, self.slow_client_policy,
+                                BROADCAST_TIMEOUT, framing, self.batch_delay, self.batch_bytes)
+        self._register(session)
+        session.start(self._forget)
+        if framing == FRAMING_V2 and codec.resumption is not None: # билет для следующего подключения
+            zname = codec.compression.name if codec.compression is not None else ""
+            session.offer((FRAME_TICKET, self.tickets.issue(*codec.resumption, zname)))
+        bucket = admission.connection_bucket()
+        idle = admission.deadline(writer.transport, admission.idle_timeout)
+        max_size = admission.max_frame_size
+        throttled = False
         try:
             while True:
-                msg = await read_message(reader, codec)
-                logging.info("Получено сообщение от %s: %s", username, msg.decode("utf-8"))
-                out = f"{username} > {msg.decode('utf-8')}".encode("utf-8")
-                await self._broadcast(out)
+                ftype, msg = await read_typed_message(reader, codec, framing, max_size)
+                if idle is not None:
+                    idle.touch()
+                MESSAGES_RECEIVED.inc()
+                if self._rate_limited(ftype, msg):
+                    if not admission.allow(bucket, username): # сверх лимита сообщение выбрасываем, до рассылки
+                        if not throttled: # сообщаем один раз на серию выброшенных
+                            self._notify_throttled(session)
+                        throttled = True
+                        continue
+                    throttled = False
+                if ftype == FRAME_ENVELOPE:
+                    await self._route_envelope(session, msg)
+                    continue
+                text = msg.decode("utf-8") # декодируем один раз и для лога, и для разбора
+                MESSAGES.received(username, text)
+                await self._dispatch(session, text)
+        except FrameTooLarge:
+            logging.info("Клиент %s прислал слишком большой кадр, отключаем", username)
+            admission.reject(REJECT_FRAME_SIZE)
         except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
-            logging.error("ОШИБКА: Потеряно соединение с клиентом %s", username)
-            pass
+            if idle is not None and idle.expired:
+                logging.info("Клиент %s долго молчит, отключаем", username)
+                admission.reject(REJECT_IDLE)
+            else:
+                logging.error("ОШИБКА: Потеряно соединение с клиентом %s", username)
+                if not session.closed: # медленных и сломавшихся на записи уже посчитали
+                    DISCONNECTS.labels("closed").inc()
         except Exception:
             logging.exception("Произошла ошибка в обработке клиента %s. ", username)
-            pass
+            if not session.closed:
+                DISCONNECTS.labels("error").inc()
         finally:
-            self.clients.pop(writer, None)
+            if idle is not None:
+                idle.cancel()
+            self._forget(session)
             logging.info("Клиент %s отключился", username)
-            await close_writer(writer)
+            await session.close()
 
 async def amain() -> None:
-    server = ChatServer()
-    srv = await server.start("127.0.0.1", 1234)
-    async with srv:
-        await srv.serve_forever()
+    executor = HandshakeExecutor(EXECUTOR_PROCESS)
+    server = ChatServer(handshake_executor=executor, key_pool=EphemeralKeyPool(executor=executor))
+    srv = await server.start("127.0.0.1", 1234, transport=TRANSPORT_PROTOCOL)
+    await start_metrics_server("127.0.0.1") # метрики для Prometheus: http://127.0.0.1:9100/metrics
+    snapshots = asyncio.create_task(log_snapshots())
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        snapshots.cancel()
+        await server.close()
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    asyncio.run(amain())
\ No newline at end of file
+    listener = setup_logging(logging.INFO)
+    use_uvloop() # если uvloop установлен
+    try:
+        asyncio.run(amain())
+    finally:
+        listener.stop()
@@ -1,26 +1,56 @@
 # tests/test_chat.py
+import io
+import os
+import json
+import time
 import asyncio
+import logging
+import threading
 import pytest
 
 from server import ChatServer
+from common import (valid_room_name, valid_username, write_message, read_framed, write_framed, read_frame, pack_frame, pack_envelope, unpack_envelope, sync_codec, FrameTooLarge, KEY_LIST,
+                    FRAMING_LEGACY, FRAMING_V2, V2_HEADER, FRAME_ENVELOPE, KEY_FETCH, NOTICE_THROTTLED)
 from client import AsyncChatClient
+from e2e_client import E2EChatClient
+from e2e_keystore import E2EKeyStore, LRUDict
+from e2e_mobp import MSG, SKEY, GMSG, E2EModpManager
+from crypto.executor import HandshakeExecutor, EXECUTOR_PROCESS, default_executor
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from crypto.dh_modp_aesgcm import EphemeralKeyPool, DHModpAESGCMCodec, gen_keypair, derive_key
+from crypto.aead_session import ROLE_CLIENT, ROLE_SERVER
+from crypto.plain import PlainCodec
+from crypto.tickets import TicketKeys
+from crypto.compression import COMPRESSIONS, NAME_ZLIB, NAME_ZLIB_CHAT, CHAT_DICTIONARY
+from crypto.negotiation import (SERVER_PREFERENCE, NAME_DHMP14, NAME_X25519_AESGCM, NAME_X25519_CHACHA20, PROTO_V2,
+                                ALG_DHMP14, ALG_DHMP14R,
+                                client_negotiate, _server_alg)
+from bus import UnixSocketBus
+from history import RoomHistory
+from msglog import MessageLog
+from chatlog import MESSAGES, setup_logging
+from admission import Admission, TokenBucket
+from metrics import (REGISTRY, Histogram, HANDSHAKE_SECONDS, FANOUT_RECIPIENTS, COMPRESSION_SAVED,
+                     start_metrics_server)
+from transport import FrameProtocol, TRANSPORTS, TRANSPORT_STREAMS
+from outbound import ClientSession, POLICY_DROP_OLDEST, POLICY_DISCONNECT, POLICY_BACKPRESSURE
 
 pytestmark = pytest.mark.asyncio
 
-async def start_server():
+async def start_server(transport=TRANSPORT_STREAMS):
     srv = ChatServer()
-    server_obj = await srv.start("127.0.0.1", 0)
+    server_obj = await srv.start("127.0.0.1", 0, transport=transport)
     host, port = server_obj.sockets[0].getsockname()[:2]
     return srv, server_obj, host, port
 
-@pytest.fixture
-async def running_server():
-    srv, server_obj, host, port = await start_server()
+@pytest.fixture(params=TRANSPORTS)
+async def running_server(request):
+    srv, server_obj, host, port = await start_server(request.param)
     yield srv, host, port
     server_obj.close()
     await server_obj.wait_closed()
 
-@pytest.mark.parametrize("alg", ["plain", "dh"])
+@pytest.mark.parametrize("alg", ["plain", "dh", "x25519", "auto"])
 async def test_broadcast_to_multiple_clients(running_server, alg):
     _, host, port = running_server
     c1, c2, c3 = AsyncChatClient(), AsyncChatClient(), AsyncChatClient()
@@ -61,7 +91,7 @@ async def test_client_disconnect_does_not_break_broadcast(running_server, alg):
     await c1.close()
     await c3.close()
 
-@pytest.mark.parametrize("alg", ["plain", "dh"])
+@pytest.mark.parametrize("alg", ["plain", "dh", "x25519-chacha20"])
 async def test_unicode_messages(running_server, alg):
     _, host, port = running_server
     c1, c2 = AsyncChatClient(), AsyncChatClient()
@@ -74,4 +104,966 @@ async def test_unicode_messages(running_server, alg):
     assert m2 == f"алиса > {txt}"
 
     await c1.close()
-    await c2.close()
\ No newline at end of file
+    await c2.close()
+
+async def test_slow_client_policies():
+    s1 = ClientSession(None, "slow", None, 2, POLICY_DROP_OLDEST, 1.0)
+    for m in (b"1", b"2", b"3"):
+        assert s1.offer(m)
+    assert s1.dropped == 1
+    assert [s1.queue.get_nowait(), s1.queue.get_nowait()] == [b"2", b"3"]
+
+    s2 = ClientSession(None, "slow", None, 1, POLICY_DISCONNECT, 1.0)
+    assert s2.offer(b"1")
+    assert not s2.offer(b"2")
+
+
+async def test_backpressure_waits_for_slow_clients_concurrently(monkeypatch):
+    monkeypatch.setattr("server.BROADCAST_TIMEOUT", 0.3)
+    srv = ChatServer()
+    sessions = [ClientSession(object(), f"u{i}", PlainCodec(), 1, POLICY_BACKPRESSURE, 1.0) for i in range(4)]
+    for s in sessions:
+        srv._register(s)
+        s.offer(b"old") # очереди полны, писатели не запущены
+    async def drain(): # u0 освобождает место, остальные так и не читают
+        await asyncio.sleep(0.1)
+        sessions[0].queue.get_nowait()
+    drainer = asyncio.create_task(drain())
+    start = time.perf_counter()
+    await srv._fanout(b"hi", sessions)
+    assert time.perf_counter() - start < 0.6 # один срок на всех, а не 0.3 на каждого медленного
+    await drainer
+    assert sessions[0].queue.get_nowait() == b"2         hi"
+    assert [s.username for s in srv.clients.values()] == ["u0"]
+
+
+async def test_handshake_in_process_pool():
+    executor = HandshakeExecutor(EXECUTOR_PROCESS, workers=2, max_inflight=1)
+    srv = ChatServer(handshake_executor=executor)
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    c1, c2 = AsyncChatClient(), AsyncChatClient()
+    await asyncio.gather(c1.connect(host, port, "alice", alg="dh"), c2.connect(host, port, "bob", alg="dh"))
+    await asyncio.sleep(0.1)
+    await c1.send("hi")
+    assert await c2.recv(timeout=2.0) == "alice > hi"
+    assert executor.inflight == 0
+
+    await c1.close()
+    await c2.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+    executor.shutdown()
+
+
+async def test_ephemeral_key_pool():
+    pool = EphemeralKeyPool(size=2, low_watermark=0)
+    await pool.fill()
+    srv = ChatServer(key_pool=pool)
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    clients = [AsyncChatClient() for _ in range(3)]
+    for i, c in enumerate(clients):
+        await c.connect(host, port, f"user{i}", alg="dh")
+    await asyncio.sleep(0.1)
+    await clients[0].send("hi")
+    assert await clients[2].recv(timeout=2.0) == "user0 > hi"
+    assert (pool.hits, pool.misses) == (2, 1)
+
+    for c in clients:
+        await c.close()
+    await pool.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+
+async def test_broadcast_packs_plain_frame_once():
+    srv = ChatServer()
+    sessions = [ClientSession(object(), f"u{i}", PlainCodec(), 4, POLICY_DROP_OLDEST, 1.0) for i in range(3)]
+    for s in sessions:
+        srv._register(s)
+    await srv._broadcast(b"hello", origin=sessions[0])
+    assert sessions[0].queue.empty()
+    f1, f2 = sessions[1].queue.get_nowait(), sessions[2].queue.get_nowait()
+    assert f1 is f2
+    assert f1 == b"5         hello"
+
+
+@pytest.mark.parametrize("alg", ["plain", "dh"])
+async def test_legacy_and_v2_framing_clients(running_server, alg):
+    _, host, port = running_server
+    old, new = AsyncChatClient(), AsyncChatClient()
+    await old.connect(host, port, "old", alg=alg, framing=FRAMING_LEGACY)
+    await new.connect(host, port, "new", alg=alg, framing=FRAMING_V2)
+    assert (old.framing, new.framing) == (FRAMING_LEGACY, FRAMING_V2)
+    await asyncio.sleep(0.1)
+
+    await old.send("from old")
+    assert await new.recv(timeout=2.0) == "old > from old"
+    await new.send("from new")
+    assert await old.recv(timeout=2.0) == "new > from new"
+
+    await old.close()
+    await new.close()
+
+async def test_frame_size_checked_before_read():
+    reader = asyncio.StreamReader()
+    reader.feed_data(V2_HEADER.pack(1 << 30, 0))
+    with pytest.raises(ValueError):
+        await read_framed(reader, FRAMING_V2)
+
+
+async def test_batched_send_and_delivery():
+    srv = ChatServer(batch_delay=0.005)
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    bot, c2 = AsyncChatClient(batch_delay=0.005), AsyncChatClient()
+    await bot.connect(host, port, "bot", alg="dh")
+    await c2.connect(host, port, "bob", alg="dh")
+    await asyncio.sleep(0.1)
+
+    for i in range(50):
+        await bot.send(f"line {i}")
+    assert bot._pending
+    for i in range(50):
+        assert await c2.recv(timeout=2.0) == f"bot > line {i}"
+
+    await bot.close()
+    await c2.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+
+async def test_broadcast_between_workers(tmp_path):
+    servers, objs = [], []
+    for i in range(2):
+        srv = ChatServer(bus=UnixSocketBus(str(tmp_path), i, 2))
+        objs.append(await srv.start("127.0.0.1", 0))
+        servers.append(srv)
+    while any(s.bus.connected < 1 for s in servers):
+        await asyncio.sleep(0.01)
+
+    c1, c2, c3 = AsyncChatClient(), AsyncChatClient(), AsyncChatClient()
+    await c1.connect("127.0.0.1", objs[0].sockets[0].getsockname()[1], "alice")
+    await c2.connect("127.0.0.1", objs[1].sockets[0].getsockname()[1], "bob", alg="dh")
+    await c3.connect("127.0.0.1", objs[0].sockets[0].getsockname()[1], "carol", alg="dh")
+    await asyncio.sleep(0.1)
+
+    await c1.send("across")
+    assert await c2.recv(timeout=2.0) == "alice > across"
+    assert await c3.recv(timeout=2.0) == "alice > across"
+    with pytest.raises(asyncio.TimeoutError):
+        await c1.recv(timeout=0.3)
+    # отправитель приходит по шине вместе с сообщением
+    assert [e[1] for e in servers[1].history.since("lobby", 0)] == ["alice"]
+    # номер первого воркера второй не досылает: нумерации у них разные
+    await c2.send(f"__REPLAY__:lobby:{servers[0].history.last_seq('lobby') - 2}")
+    with pytest.raises(asyncio.TimeoutError):
+        await c2.recv(timeout=0.3)
+
+    for c in (c1, c2, c3):
+        await c.close()
+    for srv, obj in zip(servers, objs):
+        await srv.bus.close()
+        obj.close()
+        await obj.wait_closed()
+
+
+@pytest.mark.parametrize("alg", ["plain", "dh"])
+async def test_rooms_and_direct_messages(running_server, alg):
+    srv, host, port = running_server
+    c1, c2, c3 = AsyncChatClient(), AsyncChatClient(), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg=alg)
+    await c2.connect(host, port, "bob", alg=alg)
+    await c3.connect(host, port, "carol", alg=alg)
+    await c1.join("dev")
+    await c2.join("dev")
+    await asyncio.sleep(0.1)
+    assert {s.username for s in srv.rooms["dev"]} == {"alice", "bob"}
+    for bad in ("", "a:b", "x" * 256):
+        assert not valid_room_name(bad)
+        with pytest.raises(ValueError):
+            await c1.join(bad)
+        await c1.send(f"__ROOM_JOIN__:{bad}") # в обход проверки клиента - сервер тоже не пускает
+    await asyncio.sleep(0.1)
+    assert set(srv.rooms) == {"lobby", "dev"}
+
+    await c1.send_room("dev", "standup")
+    assert await c2.recv(timeout=2.0) == "alice [dev] > standup"
+    await c3.send_direct("alice", "psst")
+    assert await c1.recv(timeout=2.0) == "carol > psst"
+    with pytest.raises(asyncio.TimeoutError):
+        await c3.recv(timeout=0.3)
+    with pytest.raises(asyncio.TimeoutError):
+        await c2.recv(timeout=0.1)
+
+    await c2.leave("dev")
+    await c1.close()
+    await asyncio.sleep(0.1)
+    assert "dev" not in srv.rooms
+    assert "alice" not in srv.by_name
+
+    await c2.close()
+    await c3.close()
+
+
+async def test_long_username_rejected_at_handshake(running_server):
+    srv, host, port = running_server
+    long_name = "ю" * 128 # 256 байт: не помещается в 1 байт длины в конверте и журнале
+    assert valid_username("ю" * 127) and not valid_username(long_name) and not valid_username("")
+    with pytest.raises(ValueError):
+        await AsyncChatClient().connect(host, port, long_name)
+    reader, writer = await asyncio.open_connection(host, port) # клиент без проверки имени
+    codec, framing = await client_negotiate(reader, writer, "plain")
+    await write_message(writer, long_name.encode(), codec, framing)
+    with pytest.raises(asyncio.IncompleteReadError): # сервер закрывает соединение еще до регистрации
+        await asyncio.wait_for(read_framed(reader, framing), timeout=2.0)
+    assert not srv.clients
+    writer.close()
+
+
+async def start_e2e_clients(host, port, names):
+    """E2E клиенты с фоновым чтением: shown - показанные строки, raw - виды полученных конвертов"""
+    clients, shown, raw = {}, {}, {}
+    readers = []
+    for name in names:
+        c = E2EChatClient()
+        await c.connect(host, port, name, alg="dh")
+        clients[name], shown[name], raw[name] = c, [], []
+        base_recv_frame = c.base.recv_frame
+        async def spy(timeout=None, base_recv_frame=base_recv_frame, name=name):
+            ftype, data = await base_recv_frame(timeout)
+            if ftype == FRAME_ENVELOPE:
+                raw[name].append(unpack_envelope(data)[0])
+            return ftype, data
+        c.base.recv_frame = spy
+        async def reader(c=c, name=name):
+            while True:
+                shown[name].append(await c.recv())
+        readers.append(asyncio.create_task(reader()))
+    await asyncio.sleep(0.1) # ключи публикуются в каталог, собеседники запросят их сами
+    return clients, shown, raw, readers
+
+async def stop_e2e_clients(clients, readers):
+    for t in readers:
+        t.cancel()
+    for c in clients.values():
+        await c.close()
+
+async def test_e2e_private_message_routed_to_recipient_only(running_server):
+    _, host, port = running_server
+    clients, shown, raw, readers = await start_e2e_clients(host, port, ("alice", "bob", "carol"))
+
+    await clients["alice"].send_private("bob", "secret")
+    await asyncio.sleep(0.3)
+    assert shown["bob"] == ["alice [E2E] > secret"]
+    assert MSG not in raw["carol"]
+
+    await stop_e2e_clients(clients, readers)
+
+async def test_e2e_group_message_encrypted_once(running_server):
+    _, host, port = running_server
+    clients, shown, raw, readers = await start_e2e_clients(host, port, ("alice", "bob", "carol", "dave"))
+
+    await clients["alice"].send_private_group(["bob", "carol"], "one")
+    await clients["alice"].send_private_group(["bob", "carol"], "two")
+    await asyncio.sleep(0.3)
+    for name in ("bob", "carol"):
+        assert shown[name] == ["alice [E2E] > one", "alice [E2E] > two"]
+        assert raw[name].count(SKEY) == 1 # ключ группы разослан один раз
+        assert raw[name].count(GMSG) == 2
+    assert shown["dave"] == []
+    assert GMSG not in raw["dave"]
+
+    await stop_e2e_clients(clients, readers)
+
+async def test_key_directory_without_broadcast_storm(running_server):
+    srv, host, port = running_server
+    clients, shown, raw, readers = await start_e2e_clients(host, port, ("alice", "bob", "carol"))
+    assert set(srv.keys.keys) == {"alice", "bob", "carol"}
+    assert all(r == [] for r in raw.values()) # подключение не рассылает ключи остальным
+
+    await clients["alice"].fetch_keys() # все ключи одним запросом + подписка на новые
+    await asyncio.sleep(0.2)
+    assert sorted(clients["alice"].e2e.get_users()) == ["bob", "carol"]
+    assert raw["alice"] == [KEY_LIST]
+
+    more, _, more_raw, more_readers = await start_e2e_clients(host, port, ("dave",))
+    await asyncio.sleep(0.2)
+    assert "dave" in clients["alice"].e2e.get_users()
+    assert raw["bob"] == [] and raw["carol"] == []
+
+    await stop_e2e_clients(more, more_readers)
+    await asyncio.sleep(0.2)
+    assert "dave" not in clients["alice"].e2e.get_users()
+    assert "dave" not in srv.keys.keys
+
+    await stop_e2e_clients(clients, readers)
+
+async def test_e2e_keystore_survives_restart(running_server, tmp_path):
+    _, host, port = running_server
+    path = str(tmp_path / "alice.keys")
+    ks = E2EKeyStore(path, b"secret")
+    clients, shown, _, readers = await start_e2e_clients(host, port, ("bob",))
+    alice = E2EChatClient(ks)
+    await alice.connect(host, port, "alice", alg="dh")
+    reader = asyncio.create_task(alice.recv())
+    await alice.send_private("bob", "first")
+    await asyncio.sleep(0.2)
+    public = alice.e2e._Ab
+    reader.cancel()
+    await alice.close()
+    assert len(ks.peers) == 1
+
+    ks2 = E2EKeyStore(path, b"secret")
+    assert ks2.load()
+    assert ks2.identity == ks.identity
+    alice = E2EChatClient(ks2)
+    await alice.connect(host, port, "alice", alg="dh")
+    assert alice.e2e._Ab == public
+    alice.e2e._derive_aead_pair = None # парный ключ должен прийти из хранилища
+    reader = asyncio.create_task(alice.recv())
+    await alice.send_private("bob", "second")
+    await asyncio.sleep(0.2)
+    assert shown["bob"] == ["alice [E2E] > first", "alice [E2E] > second"]
+    with pytest.raises(ValueError):
+        E2EKeyStore(path, b"wrong").load()
+
+    reader.cancel()
+    await alice.close()
+    await stop_e2e_clients(clients, readers)
+
+async def test_lru_dict_evicts_least_recent():
+    d = LRUDict(2)
+    d["a"], d["b"] = 1, 2
+    d["a"]
+    d["c"] = 3
+    assert list(d) == ["a", "c"]
+
+@pytest.mark.parametrize("alg, preference, expected", [
+    ("auto", SERVER_PREFERENCE, "X25519-AESGCM"),
+    ("x25519", (NAME_X25519_CHACHA20, NAME_X25519_AESGCM), "X25519-CHACHA20"),
+    ("auto", (NAME_DHMP14, NAME_X25519_AESGCM), "DH-MODP14"),
+])
+async def test_algorithm_list_negotiation(alg, preference, expected):
+    srv = ChatServer(alg_preference=preference)
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    c1, c2 = AsyncChatClient(), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg=alg)
+    await c2.connect(host, port, "bob", alg="plain")
+    assert c1.codec.name == expected
+    await asyncio.sleep(0.1)
+    assert {s.codec.name for s in srv.clients.values()} == {expected, "PLAIN"}
+    await c1.send("hi")
+    assert await c2.recv(timeout=2.0) == "alice > hi"
+    await c1.close()
+    await c2.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+async def test_baseline_dh_client_keeps_random_nonces():
+    srv = ChatServer()
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    reader, writer = await asyncio.open_connection(host, port)
+    x, A = gen_keypair() # рукопожатие клиента до v2 и списка алгоритмов
+    await write_framed(writer, ALG_DHMP14 + A)
+    B = (await read_framed(reader))[len(ALG_DHMP14R):]
+    aead = AESGCM(derive_key(x, B, A, B))
+    async def send(text):
+        nonce = os.urandom(12) # старый клиент: случайный nonce на каждое сообщение
+        await write_framed(writer, nonce + aead.encrypt(nonce, text.encode(), None))
+    async def recv():
+        data = await asyncio.wait_for(read_framed(reader), timeout=2.0)
+        return aead.decrypt(data[:12], data[12:], None).decode()
+    await send("old")
+    c2 = AsyncChatClient()
+    await c2.connect(host, port, "bob", alg="dh")
+    await asyncio.sleep(0.1)
+    roles = {s.username: s.codec._session._role for s in srv.clients.values()}
+    assert roles == {"old": None, "bob": ROLE_SERVER} # новый клиент по-прежнему со счетчиками
+    await send("hi")
+    assert await c2.recv(timeout=2.0) == "old > hi"
+    await c2.send("hello")
+    assert await recv() == "bob > hello"
+    await c2.close()
+    writer.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+async def test_counter_nonces_reject_replay():
+    key = AESGCM.generate_key(bit_length=256)
+    client = DHModpAESGCMCodec(key, ROLE_CLIENT)
+    server = DHModpAESGCMCodec(key, ROLE_SERVER)
+    m1, m2 = await client.encode(b"one"), await client.encode(b"two")
+    assert m1[:12] != m2[:12]
+    assert await server.decode(memoryview(m1)) == b"one"
+    with pytest.raises(ValueError):
+        await server.decode(m1) # повтор
+    with pytest.raises(ValueError):
+        await client.decode(await client.encode(b"self")) # свое направление
+    tampered = bytearray(m2)
+    tampered[-1] ^= 1
+    with pytest.raises(Exception):
+        await server.decode(tampered)
+    assert await server.decode(m2) == b"two" # неудачная проверка тега не сдвигает счетчик
+
+async def test_sync_codec_path_and_offload():
+    key = AESGCM.generate_key(bit_length=256)
+    client = DHModpAESGCMCodec(key, ROLE_CLIENT)
+    server = DHModpAESGCMCodec(key, ROLE_SERVER)
+    assert sync_codec(client, 100) and sync_codec(PlainCodec(), 100)
+    client.offload_bytes = server.offload_bytes = 1024
+    assert not sync_codec(client, 4096)
+    big = b"x" * 4096
+    # большое сообщение шифруется в пуле потоков, и следующее маленькое может его обогнать
+    task = asyncio.create_task(client.encode(big))
+    await asyncio.sleep(0) # задача взяла номер 0 и ушла в пул
+    m_small = client.encode_sync(b"small")
+    m_big = await task
+    assert server.decode_sync(m_small) == b"small"
+    assert await server.decode(m_big) == big
+    with pytest.raises(ValueError):
+        server.decode_sync(m_small)
+
+@pytest.mark.parametrize("alg", ["dh", "x25519"])
+async def test_large_messages_offloaded(alg):
+    srv = ChatServer(offload_bytes=1024)
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    c1, c2 = AsyncChatClient(offload_bytes=1024), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg=alg)
+    await c2.connect(host, port, "bob", alg=alg)
+    await asyncio.sleep(0.1)
+    text = "я" * 5000
+    await c1.send(text)
+    await c1.send("small")
+    assert await c2.recv(timeout=2.0) == f"alice > {text}"
+    assert await c2.recv(timeout=2.0) == "alice > small"
+    await c1.close()
+    await c2.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+
+@pytest.mark.parametrize("alg", ["dh", "x25519-chacha20"])
+async def test_session_resumption_skips_dh(alg, monkeypatch):
+    srv = ChatServer()
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    c1, c2 = AsyncChatClient(), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg=alg)
+    await c2.connect(host, port, "bob", alg="plain")
+    await asyncio.sleep(0.1)
+    await c2.send("hi")
+    assert await c1.recv(timeout=2.0) == "bob > hi" # вместе с ним пришел билет
+    assert c1.ticket is not None and not c1.resumed
+    await c1.close()
+
+    def no_dh(*args):
+        raise AssertionError("DH during resumption")
+    monkeypatch.setattr("crypto.negotiation.gen_keypair", no_dh)
+    monkeypatch.setattr("crypto.negotiation.x25519_keypair", no_dh)
+    await c1.connect(host, port, "alice", alg=alg)
+    assert c1.resumed and srv.tickets.resumed == 1
+    assert c1.codec.compression.name == NAME_ZLIB_CHAT # сжатие записано в билете
+    await asyncio.sleep(0.1)
+    await c1.send("again")
+    assert await c2.recv(timeout=2.0) == "alice > again"
+    await c2.send("ok")
+    assert await c1.recv(timeout=2.0) == "bob > ok"
+    assert c1.ticket is not None # новый билет на следующее подключение
+    await c1.close()
+    await c2.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+async def test_expired_ticket_falls_back_to_handshake():
+    srv = ChatServer(tickets=TicketKeys(lifetime=0.0))
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    c1, c2 = AsyncChatClient(), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg="x25519")
+    await c2.connect(host, port, "bob", alg="plain")
+    await asyncio.sleep(0.1)
+    await c2.send("hi")
+    assert await c1.recv(timeout=2.0) == "bob > hi"
+    await c1.close()
+    await asyncio.sleep(0.01)
+    await c1.connect(host, port, "alice", alg="x25519")
+    assert not c1.resumed and srv.tickets.rejected == 1
+    await asyncio.sleep(0.1)
+    await c1.send("full")
+    assert await c2.recv(timeout=2.0) == "alice > full"
+    await c1.close()
+    await c2.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+
+async def test_room_history_ring_buffer():
+    h = RoomHistory(size=3)
+    seqs = [h.append("lobby", "alice", f"m{i}".encode()) for i in range(5)]
+    h.append("dev", "bob", b"other")
+    assert seqs == sorted(seqs) and h.last_seq("lobby") == seqs[-1]
+    assert [e[2] for e in h.since("lobby", seqs[2])] == [b"m3", b"m4"]
+    assert [e[2] for e in h.since("lobby", 0)] == [b"m2", b"m3", b"m4"] # старше буфера - только то, что осталось
+    assert [e[2] for e in h.since("lobby", seqs[1], upto=seqs[3])] == [b"m2", b"m3"]
+    assert h.since("nowhere", 0) == []
+
+    w = RoomHistory(worker=1, workers=3) # у каждого воркера своя нумерация
+    s1, s2 = w.append("lobby", "a", b"1"), w.append("lobby", "a", b"2")
+    assert s2 - s1 == 3 and w.owns(s1) and not w.owns(s1 + 1)
+    w.advance(s2 + 10)
+    assert w.owns(w.append("lobby", "a", b"3")) and w.seq > s2 + 10
+
+
+@pytest.mark.parametrize("alg", ["plain", "dh"])
+async def test_reconnect_replays_missed_messages(running_server, alg):
+    _, host, port = running_server
+    c1, c2 = AsyncChatClient(reconnect=True), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg=alg)
+    await c2.connect(host, port, "bob", alg="plain")
+    await c1.join("dev")
+    await c2.join("dev")
+    await asyncio.sleep(0.1)
+    await c2.send("before")
+    assert await c1.recv(timeout=2.0) == "bob > before"
+
+    c1.writer.transport.abort() # обрыв соединения
+    await asyncio.sleep(0.1)
+    await c2.send("missed 1")
+    await c2.send("missed 2")
+    await asyncio.sleep(0.05)
+    assert await c1.recv(timeout=3.0) == "bob > missed 1"
+    assert await c1.recv(timeout=2.0) == "bob > missed 2"
+    assert c1.reconnects == 1 and c1.resumed == (alg != "plain")
+
+    await c2.send_room("dev", "after") # клиент вернулся и в свою комнату
+    assert await c1.recv(timeout=2.0) == "bob [dev] > after"
+    await c1.close()
+    await c2.close()
+
+
+async def test_message_log_segments_and_mmap_reads(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=256, commit_delay=0.001)
+    for seq in range(1, 31):
+        log.append(seq, "a" if seq % 3 else "b", "alice", f"m{seq}".encode())
+    await asyncio.sleep(0.05) # общая запись в потоке журнала
+    assert log.commits >= 1 and log.last_seq == 30
+    assert len(list(tmp_path.glob("*.log"))) > 1
+    assert [e[0] for e in log.read("b")] == [3, 6, 9, 12, 15, 18, 21, 24, 27, 30]
+    assert [e[0] for e in log.read("a", limit=3)] == [26, 28, 29]
+    assert [e[0] for e in log.read("a", before=10, limit=4)] == [4, 5, 7, 8]
+    assert [e[0] for e in log.read("a", after=25)] == [26, 28, 29]
+    await log.close()
+
+    last = sorted(tmp_path.glob("*.log"))[-1]
+    with open(last, "ab") as f:
+        f.write(b"\x00\x01torn") # запись оборвалась без индекса
+    reopened = MessageLog(str(tmp_path), segment_bytes=256, commit_delay=0.001)
+    assert reopened.last_seq == 30
+    reopened.append(31, "b", "bob", b"after restart")
+    await reopened.flush()
+    assert reopened.read("b", after=27) == [(30, "alice", b"m30"), (31, "bob", b"after restart")]
+    await reopened.close()
+
+
+async def test_message_log_room_chain_and_failed_write(tmp_path, monkeypatch):
+    log = MessageLog(str(tmp_path), segment_bytes=4096, commit_delay=0.001)
+    log.append(1, "quiet", "alice", b"q1")
+    for seq in range(2, 399):
+        log.append(seq, "noisy", "bob", b"n")
+    log.append(399, "quiet", "x" * 300, b"too long") # длина отправителя не помещается в 1 байт
+    log.append(400, "quiet", "alice", b"q2")
+    await log.flush() # пропадает только запись 399, а не вся пачка
+    assert len(list(tmp_path.glob("*.log"))) > 1
+    assert await log.history("quiet") == [(1, "alice", b"q1"), (400, "alice", b"q2")]
+    monkeypatch.setattr("msglog.MAX_SCAN", 5) # один запрос проходит не больше MAX_SCAN записей комнаты
+    assert [e[0] for e in log.read("noisy", limit=50)] == list(range(394, 399))
+    monkeypatch.undo()
+
+    commit = log._commit
+    def torn(segment, records, entries, *args):
+        with open(segment.log_path, "ab") as f:
+            f.write(b"".join(records)) # записи легли, индекс - нет
+        raise OSError("disk full")
+    monkeypatch.setattr(log, "_commit", torn)
+    log.append(401, "quiet", "alice", b"lost")
+    await log.flush()
+    assert log.last_seq == 400
+    monkeypatch.setattr(log, "_commit", commit)
+    log.append(402, "quiet", "alice", b"q3")
+    await log.flush()
+    assert [e[0] for e in log.read("quiet")] == [1, 400, 402]
+    await log.close()
+    reopened = MessageLog(str(tmp_path))
+    assert reopened.read("quiet", after=1) == [(400, "alice", b"q2"), (402, "alice", b"q3")]
+    await reopened.close()
+
+
+async def test_late_joiner_scrollback_from_log(tmp_path):
+    log = MessageLog(str(tmp_path), commit_delay=0.001)
+    srv = ChatServer(log=log)
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    c1 = AsyncChatClient()
+    await c1.connect(host, port, "alice", alg="dh")
+    await asyncio.sleep(0.1)
+    for i in range(3):
+        await c1.send(f"old {i}")
+    await asyncio.sleep(0.1)
+
+    late = AsyncChatClient()
+    await late.connect(host, port, "bob", alg="x25519")
+    await late.history()
+    assert [await late.recv(timeout=2.0) for _ in range(3)] == [f"alice > old {i}" for i in range(3)]
+    await late.history(before=srv.history.since("lobby", 0)[1][0]) # страница до второго сообщения
+    assert await late.recv(timeout=2.0) == "alice > old 0"
+
+    await c1.close()
+    await late.close()
+    await srv.close() # журнал дописывается при остановке
+    await server_obj.wait_closed()
+
+
+async def test_server_close_disconnects_clients_before_log(tmp_path):
+    log = MessageLog(str(tmp_path), commit_delay=10.0) # без close() запись ждала бы 10 секунд
+    srv = ChatServer(log=log)
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    c1, c2 = AsyncChatClient(), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg="x25519")
+    await c2.connect(host, port, "bob", alg="plain")
+    await asyncio.sleep(0.1)
+    await c1.send("before close")
+    assert await c2.recv(timeout=2.0) == "alice > before close"
+    await srv.close()
+    assert not srv.clients and not srv._handlers
+    with pytest.raises((asyncio.IncompleteReadError, ConnectionError)): # клиентов отключили
+        await c2.recv(timeout=2.0)
+    with pytest.raises(RuntimeError):
+        log.append(100, "lobby", "alice", b"after close")
+    reopened = MessageLog(str(tmp_path))
+    assert [e[2] for e in reopened.read("lobby")] == [b"alice > before close"]
+    await reopened.close()
+    await c1.close()
+    await c2.close()
+    await server_obj.wait_closed()
+
+
+async def test_histogram_buckets_and_quantile():
+    h = Histogram((0.001, 0.01, 0.1))
+    for v in (0.0005, 0.002, 0.003, 0.05, 2.0):
+        h.observe(v)
+    assert h.counts == [1, 2, 1, 1] and h.count == 5
+    assert h.quantile(0.5) == 0.01 and h.quantile(1.0) == float("inf")
+
+
+async def test_metrics_endpoint(running_server):
+    _, host, port = running_server
+    handshakes = HANDSHAKE_SECONDS.labels("X25519-AESGCM").count
+    fanouts = FANOUT_RECIPIENTS.count
+    metrics_srv = await start_metrics_server("127.0.0.1", 0)
+    c1, c2 = AsyncChatClient(), AsyncChatClient()
+    await c1.connect(host, port, "alice", alg="x25519")
+    await c2.connect(host, port, "bob", alg="plain")
+    await asyncio.sleep(0.1)
+    await c1.send("hi")
+    assert await c2.recv(timeout=2.0) == "alice > hi"
+    assert HANDSHAKE_SECONDS.labels("X25519-AESGCM").count == handshakes + 1
+    assert FANOUT_RECIPIENTS.count == fanouts + 1
+
+    reader, writer = await asyncio.open_connection(*metrics_srv.sockets[0].getsockname()[:2])
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+    response = (await reader.read()).decode()
+    writer.close()
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert "chat_clients 2" in response
+    assert 'chat_handshake_seconds_bucket{alg="X25519-AESGCM",le="+Inf"}' in response
+    assert 'chat_decode_seconds_count{codec="X25519-AESGCM"}' in response
+    assert "# TYPE chat_fanout_seconds histogram" in response
+    assert "chat_fanout_seconds" in REGISTRY.snapshot()
+
+    await c1.close()
+    await c2.close()
+    metrics_srv.close()
+    await metrics_srv.wait_closed()
+
+
+async def test_message_logging_sampled_redacted_off_loop():
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    out = io.StringIO()
+    formatted_in = []
+
+    class Probe:
+        def __str__(self):
+            formatted_in.append(threading.current_thread())
+            return "probe"
+
+    listener = setup_logging(logging.INFO, structured=True, redact=True, handler=logging.StreamHandler(out))
+    try:
+        MESSAGES.received("alice", "secret text")
+        logging.info("lazy %s", Probe())
+        MESSAGES.sample_rate = 0.0
+        MESSAGES.received("alice", "not sampled")
+    finally:
+        listener.stop()
+        MESSAGES.sample_rate, MESSAGES.redact = 1.0, False
+        root.handlers[:] = saved_handlers
+        root.setLevel(saved_level)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["msg"] for r in records] == ["Получено сообщение от alice: <11 chars>", "lazy probe"]
+    assert records[0]["user"] == "alice" and records[0]["chars"] == 11
+    assert formatted_in and formatted_in[0] is not threading.current_thread() # форматирует поток listener
+
+
+async def test_token_bucket_refills():
+    bucket = TokenBucket(rate=10.0, burst=2)
+    now = bucket.stamp
+    assert bucket.take(now) and bucket.take(now) and not bucket.take(now)
+    assert bucket.take(now + 0.15) and not bucket.take(now + 0.15)
+
+
+async def test_rate_limit_per_connection_and_user():
+    srv = ChatServer(admission=Admission(conn_rate=1.0, conn_burst=3, user_rate=1.0, user_burst=4))
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    bot1, bot2, c2 = AsyncChatClient(), AsyncChatClient(), AsyncChatClient()
+    for c, name in ((bot1, "bot"), (bot2, "bot"), (c2, "bob")):
+        await c.connect(host, port, name)
+    await asyncio.sleep(0.1)
+    for i in range(5):
+        await bot1.send(f"a{i}")
+    for i in range(5):
+        await bot2.send(f"b{i}")
+    # три сообщения проходят по ведру подключения bot1, четвертое по имени - одно от bot2
+    assert [await c2.recv(timeout=2.0) for _ in range(4)] == ["bot > a0", "bot > a1", "bot > a2", "bot > b0"]
+    with pytest.raises(asyncio.TimeoutError):
+        await c2.recv(timeout=0.2)
+    assert srv.admission.rejected == {"rate_limited": 6}
+    for c in (bot1, bot2, c2):
+        await c.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+
+async def test_rate_limit_spares_control_frames_and_notifies():
+    srv = ChatServer(admission=Admission(conn_rate=0.01, conn_burst=1, user_rate=None))
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    alice, bob, carol = AsyncChatClient(), AsyncChatClient(), AsyncChatClient()
+    await alice.connect(host, port, "alice")
+    await bob.connect(host, port, "bob")
+    await asyncio.sleep(0.1)
+    for i in range(3):
+        await alice.send(f"m{i}")
+    assert await bob.recv(timeout=2.0) == "alice > m0"
+    with pytest.raises(asyncio.TimeoutError):
+        await bob.recv(timeout=0.2)
+
+    await alice.join("dev") # служебные команды и каталог ключей лимит не тратят
+    await alice.send_envelope(pack_envelope(KEY_FETCH, "", "bob", b""))
+    ftype, data = await alice.recv_frame(timeout=2.0)
+    assert ftype == FRAME_ENVELOPE and unpack_envelope(data)[0] == KEY_LIST
+    assert alice.throttled == 1 # одно уведомление на серию выброшенных
+    assert any(s.username == "alice" for s in srv.rooms["dev"])
+
+    await carol.connect(host, port, "carol", framing=FRAMING_LEGACY)
+    await carol.send("c0")
+    await carol.send("c1")
+    assert await carol.recv(timeout=2.0) == NOTICE_THROTTLED # старому формату - текстом
+    for c in (alice, bob, carol):
+        await c.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+
+async def test_deferred_envelopes_refetch_sender_key(monkeypatch):
+    sent = []
+    class Client:
+        async def send_envelope(self, envelope):
+            sent.append(unpack_envelope(envelope)[:3])
+    manager = E2EModpManager(Client(), "alice")
+    assert await manager.handle_envelope(MSG, "eve", "alice", memoryview(b"x" * 40)) == []
+    assert await manager.handle_envelope(MSG, "eve", "alice", memoryview(b"y" * 40)) == []
+    assert sent == [(KEY_FETCH, "", "eve")] # ответ еще может прийти
+    monkeypatch.setattr("e2e_mobp.KEY_FETCH_TIMEOUT", 0.0) # запрос или ответ потерялся
+    await manager.handle_envelope(MSG, "eve", "alice", memoryview(b"z" * 40))
+    assert sent == [(KEY_FETCH, "", "eve")] * 2
+
+
+async def test_admission_timeouts_and_limits():
+    srv = ChatServer(admission=Admission(max_handshakes=1, handshake_timeout=0.2, idle_timeout=0.3,
+                                         max_frame_size=1024))
+    server_obj = await srv.start("127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    silent_r, silent_w = await asyncio.open_connection(host, port) # молчит и занимает рукопожатие
+    await asyncio.sleep(0.05)
+    extra_r, extra_w = await asyncio.open_connection(host, port)
+    assert await asyncio.wait_for(extra_r.read(), 1.0) == b"" # рукопожатий уже max_handshakes
+    assert await asyncio.wait_for(silent_r.read(), 1.0) == b"" # таймаут рукопожатия
+    for w in (silent_w, extra_w):
+        w.close()
+
+    idle, big = AsyncChatClient(), AsyncChatClient()
+    await idle.connect(host, port, "idle", alg="x25519")
+    await big.connect(host, port, "big", alg="x25519")
+    await big.send("x" * 2000)
+    with pytest.raises((asyncio.IncompleteReadError, ConnectionError)):
+        await big.recv(timeout=1.0)
+    with pytest.raises((asyncio.IncompleteReadError, ConnectionError)):
+        await idle.recv(timeout=1.0)
+    assert srv.admission.rejected == {"handshakes": 1, "handshake_timeout": 1, "frame_size": 1, "idle_timeout": 1}
+    assert not srv.clients
+    await idle.close()
+    await big.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+class _FakeTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.paused = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        pass
+
+async def test_frame_protocol_incremental_parser():
+    frames = []
+    done = asyncio.Event()
+
+    async def handler(reader, writer):
+        frames.append(await reader.readexactly(3))
+        for framing in (FRAMING_V2, FRAMING_V2, FRAMING_LEGACY):
+            frames.append(await read_frame(reader, framing))
+        with pytest.raises(FrameTooLarge):
+            await read_frame(reader, FRAMING_V2, max_size=4)
+        done.set()
+
+    proto = FrameProtocol(handler)
+    transport = _FakeTransport()
+    proto.connection_made(transport)
+    data = (b"ALG" + pack_frame(b"hello", FRAMING_V2, FRAME_ENVELOPE) + pack_frame(b"", FRAMING_V2)
+            + pack_frame("привет".encode("utf-8")) + pack_frame(b"too long", FRAMING_V2))
+    for i in range(len(data)): # по байту: кадры собираются из кусков
+        proto.data_received(data[i:i + 1])
+        await asyncio.sleep(0)
+    await asyncio.wait_for(done.wait(), 1.0)
+    assert frames == [b"ALG", (FRAME_ENVELOPE, b"hello"), (0, b""), (0, "привет".encode("utf-8"))]
+
+    # никто не читает - после 2*READ_LIMIT байт сокет перестает читаться, чтение его возобновляет
+    proto = FrameProtocol(lambda r, w: asyncio.sleep(0))
+    proto.connection_made(transport)
+    big = pack_frame(b"x" * 200_000, FRAMING_V2)
+    proto.data_received(big)
+    assert transport.paused
+    assert await proto.read_frame(FRAMING_V2, len(big)) == (0, b"x" * 200_000)
+    await proto.readexactly(0)
+    reading = asyncio.create_task(proto.readexactly(1))
+    await asyncio.sleep(0)
+    assert not transport.paused
+    proto.data_received(b"!")
+    assert await reading == b"!"
+    proto.data_received(b"\0\0") # обрывок заголовка, затем соединение закрывается
+    proto.connection_lost(None)
+    with pytest.raises(asyncio.IncompleteReadError):
+        await read_frame(proto, FRAMING_V2)
+
+@pytest.mark.parametrize("alg", ["plain", "dh"])
+async def test_compression_negotiated_and_done_once_per_broadcast(running_server, alg, monkeypatch):
+    srv, host, port = running_server
+    chat = COMPRESSIONS[NAME_ZLIB_CHAT]
+    calls = []
+    compress = chat.compress
+    monkeypatch.setattr(chat, "compress",  # b"noise" - как будто сжатие не помогло
+                        lambda data: calls.append(len(data)) or (None if b"noise" in data else compress(data)))
+    sender = AsyncChatClient(compression=())
+    zipped = [AsyncChatClient() for _ in range(3)]
+    only_zlib = AsyncChatClient(compression=(NAME_ZLIB,))
+    plain = AsyncChatClient(compression=())
+    legacy = AsyncChatClient()
+    await sender.connect(host, port, "sender", alg=alg)
+    for i, c in enumerate(zipped):
+        await c.connect(host, port, f"z{i}", alg=alg)
+    await only_zlib.connect(host, port, "zlib", alg=alg)
+    await plain.connect(host, port, "plain", alg=alg)
+    await legacy.connect(host, port, "legacy", alg=alg, framing=FRAMING_LEGACY)
+    assert sender.codec.compression is None
+    assert all(c.codec.compression.name == NAME_ZLIB_CHAT for c in zipped)
+    assert only_zlib.codec.compression.name == NAME_ZLIB
+    assert legacy.codec.compression is None
+    await asyncio.sleep(0.1)
+
+    saved = COMPRESSION_SAVED.value
+    log = "Traceback (most recent call last):\n" + "".join(f'  File "chat.py", line {i}, in run\n' for i in range(200))
+    await sender.send(log)
+    for c in zipped + [only_zlib, plain, legacy]:
+        assert await c.recv(timeout=2.0) == f"sender > {log}"
+    assert len(calls) == 1 # одно сжатие на всех получателей с этим вариантом
+    assert COMPRESSION_SAVED.value - saved > 4 * len(log) // 2
+
+    await sender.send("short") # короче порога - не сжимается
+    for c in zipped + [only_zlib, plain, legacy]:
+        assert await c.recv(timeout=2.0) == "sender > short"
+    assert len(calls) == 1
+
+    noise = "noise " * 200
+    await sender.send(noise) # не сжалось при рассылке - писатели очередей не пробуют снова
+    for c in zipped + [only_zlib, plain, legacy]:
+        assert await c.recv(timeout=2.0) == f"sender > {noise}"
+    assert len(calls) == 2
+    envelope = pack_envelope(MSG, "", "", b"x" * 2000)
+    await sender.send_envelope(envelope) # в конвертах шифротекст, их не сжимаем
+    for c in zipped:
+        ftype, data = await c.recv_frame(timeout=2.0)
+        assert ftype == FRAME_ENVELOPE and unpack_envelope(data)[3] == b"x" * 2000
+    assert len(calls) == 2
+
+    await zipped[0].send(log) # клиент тоже сжимает то, что отправляет
+    assert await plain.recv(timeout=2.0) == f"z0 > {log}"
+    for c in [sender] + zipped + [only_zlib, plain, legacy]:
+        await c.close()
+
+@pytest.mark.parametrize("alg", ["plain", "dh", "auto"])
+async def test_compression_offer_accepted_by_server_without_compression(alg):
+    codecs = []
+    async def old_server(reader, writer): # как сервер v2 до сжатия: PROTO:2 сравнивается целиком
+        assert await read_framed(reader) == PROTO_V2
+        await write_framed(writer, PROTO_V2)
+        hello = await read_framed(reader, FRAMING_V2)
+        codecs.append(await _server_alg(reader, writer, hello, FRAMING_V2, default_executor(), None,
+                                        SERVER_PREFERENCE, None, ()))
+        writer.close()
+    server_obj = await asyncio.start_server(old_server, "127.0.0.1", 0)
+    host, port = server_obj.sockets[0].getsockname()[:2]
+    reader, writer = await asyncio.open_connection(host, port)
+    codec, framing = await client_negotiate(reader, writer, alg, compression=(NAME_ZLIB_CHAT, NAME_ZLIB))
+    await asyncio.sleep(0.05)
+    assert framing == FRAMING_V2 and codec.compression is None and codecs[0].compression is None
+    assert await codecs[0].decode(await codec.encode(b"hello")) == b"hello"
+    writer.close()
+    server_obj.close()
+    await server_obj.wait_closed()
+
+async def test_decompression_bounded_by_frame_limit():
+    chat = COMPRESSIONS[NAME_ZLIB_CHAT]
+    text = CHAT_DICTIONARY * 4
+    packed = chat.compress(text)
+    assert len(packed) < len(text) // 10 # словарь сжимается в ссылки
+    assert chat.decompress(packed, len(text)) == text
+    assert chat.compress(b"x") is None # сжатие не помогло - кадр уходит как есть
+    with pytest.raises(FrameTooLarge):
+        chat.decompress(packed, len(text) - 1)
+    with pytest.raises(ValueError):
+        chat.decompress(packed[:-4], len(text))
+    with pytest.raises(Exception):
+        COMPRESSIONS[NAME_ZLIB].decompress(packed, len(text)) # без словаря не разжать
@@ -0,0 +1,176 @@
+# chat/transport.py
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable
+from common import FrameTooLarge, FRAMING_V2, V2_HEADER, HEADER_LENGTH, FRAME_DATA, MAX_FRAME_SIZE
+
+# Транспорт сервера (ChatServer.start): потоки asyncio или свой Protocol с разбором кадров
+TRANSPORT_STREAMS = "streams"
+TRANSPORT_PROTOCOL = "protocol"
+TRANSPORTS = (TRANSPORT_STREAMS, TRANSPORT_PROTOCOL)
+READ_LIMIT = 64 * 1024 # если никто не читает, а в буфере больше 2*READ_LIMIT, перестаем читать сокет
+
+
+class FrameProtocol(asyncio.Protocol):
+    """Подключение без StreamReader: байты из сокета копятся в одном bytearray,
+    кадр разбирается прямо в нем (заголовок через unpack_from) и вырезается одним копированием.
+
+    Для остального кода объект выглядит как reader: read_frame для кадров (его вызывает
+    common.read_frame) и readexactly. Пишет в сокет FrameWriter - то, что нужно от StreamWriter.
+    handler(reader, writer) запускается задачей на каждое подключение, как у asyncio.start_server.
+    """
+
+    def __init__(self, handler: Callable[["FrameProtocol", "FrameWriter"], Awaitable[None]]) -> None:
+        self._handler = handler
+        self._buf = bytearray() # один буфер на все время подключения, прочитанное удаляется из начала
+        self._need = 0 # сколько байт ждет читатель
+        self._waiter: asyncio.Future | None = None
+        self._eof = False
+        self._exc: BaseException | None = None
+        self._read_paused = False
+        self._write_paused = False
+        self._drain_waiters: deque[asyncio.Future] = deque()
+        self._closed: asyncio.Future | None = None
+        self._task: asyncio.Task | None = None
+        self.transport: asyncio.Transport | None = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        loop = asyncio.get_running_loop()
+        self.transport = transport
+        self._closed = loop.create_future()
+        self._task = loop.create_task(self._handler(self, FrameWriter(transport, self)))
+
+    def data_received(self, data: bytes) -> None:
+        self._buf += data
+        if self._waiter is not None:
+            if len(self._buf) >= self._need:
+                self._wake()
+        elif len(self._buf) > 2 * READ_LIMIT and not self._read_paused:
+            self._read_paused = True
+            self.transport.pause_reading()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wake()
+        return True # писать еще можно, соединение закроет обработчик (как у StreamReaderProtocol)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self._eof = True
+        self._exc = exc
+        self._wake()
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None) if exc is None else waiter.set_exception(exc)
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self) -> None:
+        self._write_paused = True
+
+    def resume_writing(self) -> None:
+        self._write_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _wake(self) -> None:
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait(self, n: int) -> None:
+        """Ждем, пока в буфере наберется n байт"""
+        while len(self._buf) < n:
+            if self._eof:
+                if self._exc is not None:
+                    raise self._exc
+                raise asyncio.IncompleteReadError(bytes(self._buf), n)
+            if self._read_paused:
+                self._read_paused = False
+                self.transport.resume_reading()
+            self._need = n
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+    def _take(self, start: int, end: int) -> bytes:
+        with memoryview(self._buf) as view:
+            data = view[start:end].tobytes()
+        del self._buf[:end] # bytearray сдвигает начало без копирования хвоста
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        if len(self._buf) < n:
+            await self._wait(n)
+        return self._take(0, n)
+
+    async def read_frame(self, framing: int, max_size: int = MAX_FRAME_SIZE) -> tuple[int, bytes]:
+        """То же, что common.read_frame. Если кадр уже целиком в буфере, ожидания нет вовсе"""
+        buf = self._buf
+        hsize = V2_HEADER.size if framing == FRAMING_V2 else HEADER_LENGTH
+        if len(buf) < hsize:
+            await self._wait(hsize)
+        if framing == FRAMING_V2:
+            size, ftype = V2_HEADER.unpack_from(buf)
+        else:
+            size, ftype = int(buf[:HEADER_LENGTH]), FRAME_DATA
+        if size < 0 or size > max_size:
+            raise FrameTooLarge("Invalid frame size")
+        end = hsize + size
+        if len(buf) < end:
+            await self._wait(end)
+        return ftype, self._take(hsize, end)
+
+    async def _drain(self) -> None:
+        if self._closed.done():
+            raise ConnectionResetError("Connection lost")
+        if not self._write_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self._drain_waiters.remove(waiter)
+
+
+class FrameWriter:
+    """Запись в сокет FrameProtocol: часть интерфейса StreamWriter, которой пользуются
+    рукопожатие, ClientSession и close_writer"""
+
+    def __init__(self, transport: asyncio.Transport, protocol: FrameProtocol) -> None:
+        self.transport = transport
+        self._protocol = protocol
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    def writelines(self, data: list) -> None:
+        self.transport.writelines(data)
+
+    async def drain(self) -> None:
+        await self._protocol._drain()
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    async def wait_closed(self) -> None:
+        await asyncio.shield(self._protocol._closed)
+
+    def get_extra_info(self, name: str, default: object = None) -> object:
+        return self.transport.get_extra_info(name, default)
+
+
+def use_uvloop() -> bool:
+    """Цикл событий uvloop для следующих asyncio.run, если он установлен. False - uvloop нет,
+    остается стандартный цикл"""
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True